@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+
+# benchmark.py, measure how long the screens take to draw, without a display
+# Copyright (C) 2019  John Snowdon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Use as follows:
+#
+# ./benchmark.py --pages 6 --buttons 5 --frames 500 --output bench.json
+# ./benchmark.py --compare bench.json
+#
+# The screens are drawn with SDL's dummy video driver (or whatever SDL_VIDEODRIVER
+# is set to), using dummy power monitors and a made-up set of button pages, while
+# a script of actions - taps, page changes, screen switches - is played through the
+# render functions. Results are written as JSON.
+
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import argparse
+import json
+import logging
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+from lib import config
+from lib import buttons
+from lib import gfx
+from lib import render
+from lib.collector import PowerCollector
+from lib.sampler import SystemSampler
+import sdlrfcontroller
+
+from sdl2 import SDL_GetCurrentVideoDriver, SDL_GetRendererInfo, SDL_RendererInfo
+
+# What each action in a script does
+ACTIONS = ["tap", "next", "prev", "power", "status", "monitor", "chart", "metric", "numbers", "page"]
+
+# Played over and over until enough frames have been drawn
+DEFAULT_SCRIPT = ["tap", "tap", "next", "tap", "next", "prev", "power", "power", "status", "status", "monitor", "chart", "chart", "metric", "chart", "numbers", "page"]
+
+def syntheticScreens(pages = 4, per_column = 5, image_ratio = 0.5, seed = 0):
+	""" A config.SCREENS structure of the given size, with buttons using the device images from the assets folder """
+
+	rng = random.Random(seed)
+	nav_images = [os.path.basename(f) for f in config.ASSETS.values()]
+	images = sorted(f for f in os.listdir(config.ASSETS_FOLDER) if f.startswith("btn_") and f.endswith(".bmp") and (f not in nav_images))
+
+	screens = {}
+	for page in range(1, pages + 1):
+		screens[page] = {'BUTTON' : {'L' : {}, 'R' : {}}}
+		for align in ["L", "R"]:
+			for number in range(1, per_column + 1):
+				remote = 0xB0000 + page
+				socket = (number % 4) + 1
+				button = {
+					'text'		: "Bench %s.%s.%s" % (page, align, number),
+					'remote'	: remote,
+					'socket'	: socket,
+					'tags'		: ["bench %s" % align],
+					'poweron'	: [
+						{'remote' : remote, 'socket' : socket, 'action' : "ON"},
+						{'tags' : ["bench R"], 'action' : "ON"},
+					],
+					'poweroff'	: [
+						{'remote' : remote, 'socket' : socket, 'action' : "OFF"},
+					],
+				}
+				if images and (rng.random() < image_ratio):
+					button['image'] = rng.choice(images)
+				screens[page]['BUTTON'][align][number] = button
+	return screens
+
+def percentile(values, p):
+	""" Nearest-rank percentile of a list of numbers """
+
+	if len(values) == 0:
+		return None
+	ordered = sorted(values)
+	rank = max(0, min(len(ordered) - 1, int(round((p / 100.0) * len(ordered) + 0.5)) - 1))
+	return ordered[rank]
+
+def summarise(values, scale = 1000.0):
+	""" Count, mean and percentiles of a list of measurements, multiplied by scale (seconds to ms by default) """
+
+	if len(values) == 0:
+		return {'calls' : 0}
+	return {
+		'calls'	: len(values),
+		'mean'	: round(scale * sum(values) / len(values), 4),
+		'p50'	: round(scale * percentile(values, 50), 4),
+		'p95'	: round(scale * percentile(values, 95), 4),
+		'p99'	: round(scale * percentile(values, 99), 4),
+		'max'	: round(scale * max(values), 4),
+	}
+
+class Probe():
+	""" Records how long each measured function takes, what it uploads to the render texture and what it allocates """
+
+	def __init__(self):
+		self.trace = False
+		self.depth = 0
+		self.reset()
+
+	def reset(self):
+		""" Forget everything measured so far """
+
+		self.times = {}
+		self.allocated = {}
+		self.retained = {}
+		self.upload_calls = 0
+		self.upload_bytes = 0
+		self.frame_uploads = []
+
+	def measure(self, name, function, *args, **kwargs):
+		""" Call a function, recording its time - or, when tracing, its memory use """
+
+		# Only the outermost call is traced, tracemalloc keeps one peak for everything
+		trace = self.trace and (self.depth == 0)
+		if trace:
+			tracemalloc.reset_peak()
+			before = tracemalloc.get_traced_memory()[0]
+		self.depth += 1
+		start = time.perf_counter()
+		try:
+			return function(*args, **kwargs)
+		finally:
+			elapsed = time.perf_counter() - start
+			self.depth -= 1
+			if trace:
+				current, peak = tracemalloc.get_traced_memory()
+				self.allocated.setdefault(name, []).append(peak - before)
+				self.retained.setdefault(name, []).append(current - before)
+			elif not self.trace:
+				self.times.setdefault(name, []).append(elapsed)
+
+	def install(self):
+		""" Wrap gfxData.update() and the texture upload routine, so they are measured wherever they are called from """
+
+		probe = self
+		update = gfx.gfxData.update
+		upload = gfx.uploadRegion
+
+		def timedUpdate(window, *args, **kwargs):
+			before = probe.upload_bytes
+			result = probe.measure("update", update, window, *args, **kwargs)
+			if not probe.trace:
+				probe.frame_uploads.append(probe.upload_bytes - before)
+			return result
+
+		def countedUpload(surface, texture, x, y, w, h):
+			if not probe.trace:
+				probe.upload_calls += 1
+				probe.upload_bytes += w * h * surface.contents.format.contents.BytesPerPixel
+			return upload(surface, texture, x, y, w, h)
+
+		gfx.gfxData.update = timedUpdate
+		gfx.uploadRegion = countedUpload
+
+class Bench():
+	""" Plays a script of actions through the render functions, the same way the main loop would """
+
+	def __init__(self, window = None, energenie = None, probe = None, seed = 0):
+		self.window = window
+		self.probe = probe
+		self.rng = random.Random(seed)
+		self.collector = PowerCollector(energenie = energenie, lock = threading.Lock())
+		self.sampler = SystemSampler()
+		self.page = buttons.getPages()[0]
+		self.power_mode = "ON"
+		self.graph_mode = None
+		self.metrics = list(config.CHART_METRICS.keys())
+		self.graph_metric = config.CHART_DEFAULT_METRIC
+		self.frames = 0
+
+	def drawPage(self, button = None, flash = False):
+		self.probe.measure("renderPage", render.renderPage, self.window, page = self.page, button_clicked = button, flash = flash, power_mode = self.power_mode)
+
+	def drawMonitor(self):
+		self.collector.collect()
+		self.probe.measure("renderPowerMon", render.renderPowerMon, self.window, page = self.page, power_mode = self.power_mode, collector = self.collector, graph_mode = self.graph_mode, graph_metric = self.graph_metric)
+
+	def act(self, action):
+		""" Carry out one scripted action """
+
+		pages = buttons.getPages()
+		if action == "tap":
+			self.drawPage()
+			boxes = self.window.hits.all("deviceClick")
+			if boxes:
+				self.drawPage(button = self.rng.choice(boxes), flash = True)
+			# Let the flash run its course straight away, rather than waiting for it
+			self.window.timeline.finish()
+			self.window.update()
+		elif action == "next":
+			self.page = pages[(pages.index(self.page) + 1) % len(pages)]
+			self.drawPage()
+		elif action == "prev":
+			self.page = pages[(pages.index(self.page) - 1) % len(pages)]
+			self.drawPage()
+		elif action == "power":
+			if self.power_mode == "ON":
+				self.power_mode = "OFF"
+			else:
+				self.power_mode = "ON"
+			self.drawPage()
+		elif action == "status":
+			self.probe.measure("renderStatus", render.renderStatus, self.window, power_mode = self.power_mode, sampler = self.sampler)
+		elif action == "monitor":
+			self.graph_mode = None
+			self.drawMonitor()
+		elif action == "chart":
+			self.graph_mode = "btn_graph"
+			self.drawMonitor()
+		elif action == "metric":
+			self.graph_mode = "btn_graph"
+			self.graph_metric = self.metrics[(self.metrics.index(self.graph_metric) + 1) % len(self.metrics)]
+			self.drawMonitor()
+		elif action == "numbers":
+			self.graph_mode = "btn_graph_numbers"
+			self.drawMonitor()
+		elif action == "page":
+			self.drawPage()
+		self.frames += 1
+
+	def play(self, script = None, frames = 100):
+		""" Repeat the script until the given number of actions have been carried out """
+
+		played = 0
+		while played < frames:
+			self.act(script[played % len(script)])
+			played += 1
+
+def gitRevision():
+	try:
+		return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd = os.path.dirname(os.path.abspath(__file__)), stderr = subprocess.DEVNULL).decode().strip()
+	except Exception:
+		return None
+
+def rendererName(window):
+	info = SDL_RendererInfo()
+	if SDL_GetRendererInfo(window.renderer, info) == 0:
+		return info.name.decode()
+	return None
+
+def loadScript(path = None):
+	""" A script file lists one action per line, blank lines and lines starting with # are ignored """
+
+	if path is None:
+		return DEFAULT_SCRIPT
+	script = []
+	with open(path) as f:
+		for line in f:
+			line = line.strip()
+			if (line == "") or line.startswith("#"):
+				continue
+			if line not in ACTIONS:
+				raise ValueError("Unknown action [%s] in %s, expected one of %s" % (line, path, ", ".join(ACTIONS)))
+			script.append(line)
+	return script
+
+def compare(results = None, baseline = None):
+	""" Print the change in each function's timings from a previous run """
+
+	print("%-16s %10s %10s %10s %10s" % ("function", "p50 (ms)", "change", "p95 (ms)", "change"), file = sys.stderr)
+	for name in sorted(results['functions'].keys()):
+		new = results['functions'][name]
+		old = baseline['functions'].get(name)
+		row = [name, new.get('p50'), "", new.get('p95'), ""]
+		if old and old.get('p50') and old.get('p95'):
+			row[2] = "%+.1f%%" % (100.0 * (new['p50'] - old['p50']) / old['p50'])
+			row[4] = "%+.1f%%" % (100.0 * (new['p95'] - old['p95']) / old['p95'])
+		print("%-16s %10s %10s %10s %10s" % tuple(row), file = sys.stderr)
+
+def main():
+	parser = argparse.ArgumentParser(description = "Measure the frame times of the sdlRFController screens without a display")
+	parser.add_argument("--pages", type = int, default = 4, help = "number of made-up button pages")
+	parser.add_argument("--buttons", type = int, default = 5, help = "buttons in each column of a page")
+	parser.add_argument("--images", type = float, default = 0.5, help = "fraction of buttons drawn from an image rather than text")
+	parser.add_argument("--frames", type = int, default = 340, help = "number of scripted actions to measure")
+	parser.add_argument("--warmup", type = int, default = len(DEFAULT_SCRIPT), help = "actions to play before measuring")
+	parser.add_argument("--script", help = "file of actions to play, one per line: %s" % ", ".join(ACTIONS))
+	parser.add_argument("--seed", type = int, default = 1, help = "seed for the made-up pages, taps and readings")
+	parser.add_argument("--no-alloc", action = "store_true", help = "skip the (slower) allocation measurements")
+	parser.add_argument("--output", help = "write the results to this file rather than stdout")
+	parser.add_argument("--compare", help = "results of an earlier run to compare against")
+	parser.add_argument("--verbose", action = "store_true", help = "show the application log")
+	args = parser.parse_args()
+
+	if not args.verbose:
+		logging.disable(logging.WARNING)
+	script = loadScript(args.script)
+	random.seed(args.seed)
+
+	# Transitions hold each frame for real time, which would swamp the measurements
+	config.TRANSITION_TIME = 0
+	config.SCREENS = syntheticScreens(pages = args.pages, per_column = args.buttons, image_ratio = args.images, seed = args.seed)
+	buttons.registry = None
+	energenie = sdlrfcontroller.load_energenie(elib = False)
+
+	window = gfx.gfxInit()
+	if window is False:
+		print("Unable to open an SDL display", file = sys.stderr)
+		return 1
+
+	probe = Probe()
+	probe.install()
+	bench = Bench(window = window, energenie = energenie, probe = probe, seed = args.seed)
+
+	# Fill the caches and the chart history before measuring
+	bench.play(script = script, frames = args.warmup)
+	probe.reset()
+
+	bench.play(script = script, frames = args.frames)
+
+	if not args.no_alloc:
+		tracemalloc.start()
+		probe.trace = True
+		bench.play(script = script, frames = args.frames)
+		probe.trace = False
+		tracemalloc.stop()
+
+	updates = len(probe.frame_uploads)
+	results = {
+		'meta'	: {
+			'revision'	: gitRevision(),
+			'time'		: time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+			'python'	: platform.python_version(),
+			'machine'	: platform.machine(),
+			'video_driver'	: SDL_GetCurrentVideoDriver().decode(),
+			'renderer'	: rendererName(window),
+			'screen'	: [config.SCREEN_W, config.SCREEN_H, config.SCREEN_BPP],
+			'pages'		: args.pages,
+			'buttons'	: args.pages * args.buttons * 2,
+			'frames'	: args.frames,
+			'seed'		: args.seed,
+			'script'	: script,
+		},
+		'functions'	: {},
+		'uploads'	: {
+			'calls'			: probe.upload_calls,
+			'bytes'			: probe.upload_bytes,
+			'updates'		: updates,
+			'empty_updates'	: len([b for b in probe.frame_uploads if b == 0]),
+			'bytes_per_update'	: summarise(probe.frame_uploads, scale = 1),
+		},
+		'allocations'	: {},
+		'cache'		: {
+			'hits'		: dict(window.cache.hits),
+			'misses'	: dict(window.cache.misses),
+			'evictions'	: dict(window.cache.evictions),
+		},
+	}
+	for name, values in probe.times.items():
+		results['functions'][name] = summarise(values)
+	for name, values in probe.allocated.items():
+		results['allocations'][name] = {
+			'peak_bytes'		: summarise(values, scale = 1),
+			'retained_bytes'	: summarise(probe.retained[name], scale = 1),
+		}
+
+	output = json.dumps(results, indent = 2, sort_keys = True)
+	if args.output:
+		with open(args.output, "w") as f:
+			f.write(output + "\n")
+	else:
+		print(output)
+
+	if args.compare:
+		with open(args.compare) as f:
+			compare(results = results, baseline = json.load(f))
+
+	bench.collector.stop()
+	gfx.gfxClose()
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -17,148 +17,261 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import random
 import time
+from collections import OrderedDict
 
 from lib import config
+from lib import metrics
 from lib.newlog import newlog
+from lib.layout import loadLayout
 
 # Set up a logger for this file
 logger = newlog(__file__)
 
+class TransmitPolicy():
+	""" How many times, and how far apart, a power command is sent to one socket """
+	
+	__slots__ = ('repeats', 'gap', 'jitter', 'burst')
+	
+	def __init__(self, settings = None):
+		policy = dict(config.TRANSMIT_POLICY)
+		if settings:
+			policy.update(settings)
+		self.repeats = max(1, int(policy['repeats']))
+		self.gap = max(0.0, float(policy['gap']))
+		self.jitter = max(0.0, float(policy['jitter']))
+		self.burst = bool(policy['burst'])
+	
+	def send(self, command):
+		""" Transmit a command (device.turn_on / device.turn_off) according to this policy """
+		
+		for r in range(0, self.repeats):
+			command()
+			if (not self.burst) or (r == self.repeats - 1):
+				self.wait()
+	
+	def wait(self):
+		""" Leave the radio quiet for the gap, plus any jitter """
+		
+		gap = self.gap
+		if self.jitter:
+			gap += random.uniform(0, self.jitter)
+		if gap:
+			time.sleep(gap)
+	
+	def __repr__(self):
+		return "<transmit x%s gap %s jitter %s burst %s>" % (self.repeats, self.gap, self.jitter, self.burst)
+
+class ButtonRecord():
+	""" A single device button from the layout. spec is the ButtonSpec it was made from. """
+	
+	__slots__ = ('spec', 'page', 'align', 'number', 'text', 'image', 'remote', 'socket', 'tags', 'poweron', 'poweroff', 'transmit', 'plans')
+	
+	def __init__(self, spec = None):
+		self.spec = spec
+		self.page = spec.page
+		self.align = spec.align
+		self.number = spec.number
+		self.text = spec.text
+		self.image = spec.image
+		self.remote = spec.remote
+		self.socket = spec.socket
+		self.tags = spec.tags
+		self.poweron = spec.poweron
+		self.poweroff = spec.poweroff
+		if spec.transmit:
+			self.transmit = TransmitPolicy(dict(spec.transmit))
+		else:
+			self.transmit = None
+		
+		# Compiled power plans, filled in by compilePlans()
+		self.plans = {}
+		
+	def __repr__(self):
+		return "<button %s.%s.%s %s>" % (self.page, self.align, self.number, self.text)
+
+class DeviceRegistry():
+	""" Every device button in the layout, indexed by (remote, socket), by tag, by page and by name """
+	
+	def __init__(self, layout = None):
+		self.buttons = []
+		self.by_socket = {}
+		self.by_tag = {}
+		self.by_page = {}
+		self.by_name = {}
+		
+		# Radio device handles by (remote, socket), set up by load_energenie()
+		self.devices = {}
+		
+		# Used for any socket whose buttons don't set their own transmit policy
+		self.default_policy = TransmitPolicy()
+		
+		# The layout has already been checked, and buttons with problems left out
+		for page in layout.pages:
+			self.by_page[page] = {"L" : [], "R" : []}
+		for spec in layout.buttons:
+			self.add(ButtonRecord(spec))
+		
+		self.pages = sorted(self.by_page.keys())
+		logger.info("Registry holds %s buttons on %s pages" % (len(self.buttons), len(self.pages)))
+	
+	def add(self, button):
+		""" Add a button to each of the indexes """
+		
+		self.buttons.append(button)
+		self.by_page[button.page][button.align].append(button)
+		self.by_socket.setdefault((button.remote, button.socket), []).append(button)
+		for tag in button.tags:
+			self.by_tag.setdefault(tag, []).append(button)
+		if button.text in self.by_name:
+			logger.warn("More than one button named [%s]" % button.text)
+		else:
+			self.by_name[button.text] = button
+	
+	def sockets(self):
+		""" All of the distinct (remote, socket) pairs used by buttons """
+		
+		return list(self.by_socket.keys())
+	
+	def device(self, remote = None, socket = None):
+		""" The radio device handle for a remote and socket, or None """
+		
+		return self.devices.get((remote, socket))
+	
+	def policy(self, remote = None, socket = None):
+		""" The transmit policy for a remote and socket, from the first button that sets one """
+		
+		for button in self.by_socket.get((remote, socket), []):
+			if button.transmit is not None:
+				return button.transmit
+		return self.default_policy
+
+# The registry is built from the layout the first time it is needed
+registry = None
+
+def getRegistry():
+	""" Return the device registry, building it if necessary """
+	
+	global registry
+	if registry is None:
+		registry = DeviceRegistry(loadLayout())
+	return registry
+
 def getAllButtons():
 	""" Return all buttons / devices """
 	
-	buttons = []
-	for p in getPages():
-		buttons += getButtons(p, "L")
-		buttons += getButtons(p, "R")
-		
-	return buttons
+	return getRegistry().buttons
 
 def getPages():
 	""" Return screen list """
 	
-	screens = list(config.SCREENS.keys())
-	screens.sort()
-	return screens
+	return getRegistry().pages
 	
 def getButtons(page = 1, align = "L"):
 	""" Return the buttons for a screen """
 	
-	buttons = []
-	
-	if page in getPages():
-		try:
-			button_numbers = config.SCREENS[page]['BUTTON'][align].keys()
-			for button_number in button_numbers:
-				button = config.SCREENS[page]['BUTTON'][align][button_number]
-				# Add in the alignment and button number
-				button['align'] = align
-				button['number'] = button_number
-				buttons.append(button)
-		except Exception as e:
-			logger.warn(e)
-			buttons = []
-		
-	return buttons
+	r = getRegistry()
+	if page in r.by_page:
+		return r.by_page[page][align]
+	return []
 
 def getButtonsForTag(tag = None, exclude = None):
 	""" Return all buttons/devices with the matching tag, except those with a title matching exclude """
 	
-	buttons = []
-	for page in getPages():
-		for align in ["L", "R"]:
-			for button_number in config.SCREENS[page]['BUTTON'][align].keys():
-				if tag in config.SCREENS[page]['BUTTON'][align][button_number]['tags']:
-					if config.SCREENS[page]['BUTTON'][align][button_number]['text'] != exclude:
-						buttons.append(config.SCREENS[page]['BUTTON'][align][button_number])
-	return buttons
+	return [b for b in getRegistry().by_tag.get(tag, []) if b.text != exclude]
 
 def getButtonPower(button):
 	""" Return the power state of a device represented by a button """
 	
 	pass
 
-def setButtonPower(energenie = None, button = None, state = "ON"):
-	""" Send a power state message to a device represented by a button """
+def compileButtonPlan(registry = None, button = None, state = "ON"):
+	""" Turn the power actions of a button into a flat, de-duplicated list of (remote, socket, action, device, policy) steps """
 	
-	
-	logger.info("Sending power %s signal" % state)
+	# Any tags were resolved into sockets when the layout was loaded
 	if state == "ON":
+		steps = button.poweron
 		action_type = 'poweron'
 		
 	if state == 'OFF':
+		steps = button.poweroff
 		action_type = 'poweroff'
-		
-	if action_type in button.keys():
-		
-		if len(button[action_type]) > 0:
-			# Unroll the poweron/off action list
-			for action in button[action_type]:
-				
-				# Is it a composite/macro action?
-				if 'tags' in action.keys():
-					logger.debug("Macro action")
-					
-					# Find all of the devices/buttons (except the current one) with this tag
-					buttons = []
-					for t in action['tags']:
-						buttons += getButtonsForTag(tag = t, exclude = button['text'])
-						
-					for b in buttons:
-						logger.debug("Calling %s.%s with %s [%s]" % (b['remote'], b['socket'], action['action'], b['text']))
-						
-						# Create device and send signal
-						if energenie:
-							for d in energenie['buttons']:
-								if (d['remote'] == b['remote']) and (d['socket'] == b['socket']):
-									if action['action'] == "ON":
-										for i in range(0,2):
-											d['device'].turn_on()
-											time.sleep(0.1)
-									if action['action'] == "OFF":
-										for i in range(0,2):
-											d['device'].turn_off()
-											time.sleep(0.1)
-				else:
-					# Single fire action, just call with remote id and socket id
-					logger.debug("Single fire action")
-					logger.debug("Calling %s.%s with %s" % (action['remote'], action['socket'], action['action']))
-					
-					# Create device and send signal
-					if energenie:
-						for d in energenie['buttons']:
-							if (d['remote'] == action['remote']) and (d['socket'] == action['socket']):
-								if action['action'] == "ON":
-									for i in range(0,2):
-										d['device'].turn_on()
-										time.sleep(0.1)
-								if action['action'] == "OFF":
-									for i in range(0,2):
-										d['device'].turn_off()
-										time.sleep(0.1)
+	
+	if steps is None:
+		logger.warn("No %s action defined for [%s]" % (action_type, button.text))
+		steps = []
+	
+	# Attach the device handle to each step
+	plan = []
+	for step in steps:
+		device = registry.device(step[0], step[1])
+		if device is not None:
+			plan.append((step[0], step[1], step[2], device, registry.policy(step[0], step[1])))
+		else:
+			logger.debug("No device for %#x.%s", step[0], step[1])
+	return coalesceSteps(plan)
+
+def coalesceSteps(steps = None):
+	""" Merge a list of (remote, socket, action, device, policy) steps so that each socket is sent only its final state """
+	
+	if steps is None:
+		return []
+	
+	# A later action for the same socket replaces an earlier one (so an OFF cancels a
+	# preceding ON), but keeps the position at which that socket was first seen.
+	remotes = OrderedDict()
+	for step in steps:
+		if config.RADIO_GROUP_REMOTES:
+			group = step[0]
 		else:
-			# No power entries defined, just send a power signal to the defined remote and socket
-			logger.warn("No %s action entries defined - using default remote and socket" % action_type)
-			sent = False
-			for d in energenie['buttons']:
-				if (d['remote'] == button['remote']) and (d['socket'] == button['socket']) and (d['text'] == button['text']):
-					if state == "ON":
-						for i in range(0,2):
-							d['device'].turn_on()
-							time.sleep(0.1)
-						sent = True
-					if state == "OFF":
-						for i in range(0,2):
-							d['device'].turn_off()
-							time.sleep(0.1)
-						sent = True
-			if sent:
-				logger.debug("Sent signal to %s.%s" % (str(hex(d['remote'])), d['socket']))
-			else:
-				logger.warn("Signal not sent to %s.%s" % (str(hex(button['remote'])), button['socket']))
-	else:
-		logger.warn("No %s action defined" % action_type)
+			group = None
+		sockets = remotes.setdefault(group, OrderedDict())
+		sockets[(step[0], step[1])] = step
+	
+	merged = []
+	for sockets in remotes.values():
+		merged += sockets.values()
+	
+	if len(merged) < len(steps):
+		logger.debug("Coalesced %s power steps into %s", len(steps), len(merged))
+	return merged
+
+def compilePlans(registry = None):
+	""" Work out, once, the list of devices every button sends to for each power state """
+	
+	steps = 0
+	for button in registry.buttons:
+		button.plans = {}
+		for state in ["ON", "OFF"]:
+			button.plans[state] = compileButtonPlan(registry = registry, button = button, state = state)
+			steps += len(button.plans[state])
+	logger.info("Compiled %s power steps" % steps)
+	
+	return steps
+
+def sendSteps(energenie = None, steps = None, progress = None):
+	""" Transmit a list of (remote, socket, action, device, policy) steps. This blocks while the radio
+	is transmitting, so should be run by the radio worker thread and not the UI. """
+	
+	if steps is None:
+		steps = []
+	
+	for i, (remote, socket, action, device, policy) in enumerate(steps):
+		logger.debug("Calling %#x.%s with %s %s", remote, socket, action, policy)
+		start = metrics.clock()
+		if action == "ON":
+			policy.send(device.turn_on)
+		if action == "OFF":
+			policy.send(device.turn_off)
+		metrics.since("transmit", start)
+		metrics.count("transmit_%s" % action.lower())
+		
+		# Let the caller know how far through the list of devices we are
+		if progress:
+			progress(i + 1, len(steps))
+	
+	return len(steps)
 	
 def getPowerMonitor(energenie = None):
 	""" Listen for any broadcast power signals """
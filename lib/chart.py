@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+# chart.py, scrolling time-series charts of power monitor readings
+# Copyright (C) 2019  John Snowdon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import ctypes
+import math
+import time
+
+from lib import config
+from lib.newlog import newlog
+
+# SDL routines
+from sdl2 import *
+
+# Set up a logger for this file
+logger = newlog(__file__)
+
+# How many columns back to look for a previous reading to join the newest one to
+CHART_JOIN_COLUMNS = 4
+
+class ScrollingChart():
+	""" A plot of one reading field for every power monitor. Each pixel column covers
+	config.CHART_SECONDS_PER_PX of time, with the newest column on the right. """
+
+	def __init__(self, window = None, rect = None, field = 'real_power', low = 0.0, high = 1.0):
+		self.window = window
+		self.rect = rect
+		self.field = field
+		self.low = low
+		self.high = high
+		self.seconds_per_px = config.CHART_SECONDS_PER_PX
+
+		# The plot is kept on its own surface, in the same format as the backbuffer, so
+		# it can be scrolled in place and copied to the backbuffer unchanged
+		pixel_format = window.backbuffer.contents.format.contents
+		self.surface = SDL_CreateRGBSurfaceWithFormat(0, rect.w, rect.h, pixel_format.BitsPerPixel, pixel_format.format)
+		if not self.surface:
+			logger.error("Unable to create a chart surface")
+			logger.error(SDL_GetError())
+		self.bpp = self.surface.contents.format.contents.BytesPerPixel
+
+		self.background = SDL_MapRGB(self.surface.contents.format, config.CHART_BACKGROUND_COLOUR['r'], config.CHART_BACKGROUND_COLOUR['g'], config.CHART_BACKGROUND_COLOUR['b'])
+		self.colours = []
+		for c in config.CHART_COLOURS:
+			self.colours.append(SDL_MapRGB(self.surface.contents.format, c['r'], c['g'], c['b']))
+
+		# The time column shown at the right hand edge, None until the first draw
+		self.last_column = None
+
+	def free(self):
+		""" Release the chart surface """
+
+		if self.surface:
+			SDL_FreeSurface(self.surface)
+			self.surface = None
+
+	def column(self, timestamp):
+		""" The time column a timestamp falls in """
+
+		return int(timestamp // self.seconds_per_px)
+
+	def scale(self, value):
+		""" The y coordinate of a value on the chart surface """
+
+		h = self.rect.h
+		y = h - 1 - int((value - self.low) / (self.high - self.low) * (h - 1))
+		return min(max(y, 0), h - 1)
+
+	def scroll(self, shift):
+		""" Move the whole plot left by shift columns """
+
+		# A single move of the entire pixel buffer. The pixels which wrap from the start
+		# of one row onto the end of the row above all land in the rightmost shift columns,
+		# which are cleared and drawn again straight afterwards.
+		pitch = self.surface.contents.pitch
+		pixels = self.surface.contents.pixels
+		offset = shift * self.bpp
+		SDL_LockSurface(self.surface)
+		ctypes.memmove(pixels, pixels + offset, (pitch * self.rect.h) - offset)
+		SDL_UnlockSurface(self.surface)
+
+	def draw(self, collector = None, now = None):
+		""" Bring the chart up to date with the collector readings and copy it to the backbuffer """
+
+		if now is None:
+			now = time.time()
+		newest = self.column(now)
+		w = self.rect.w
+
+		if (self.last_column is None) or ((newest - self.last_column) >= w) or (newest < self.last_column):
+			# Nothing we have drawn is still on screen - plot every column
+			first = newest - w + 1
+		else:
+			if newest > self.last_column:
+				self.scroll(newest - self.last_column)
+			# The previous newest column may have had more readings since it was drawn
+			first = self.last_column
+
+		since = (first - CHART_JOIN_COLUMNS) * self.seconds_per_px
+		self.plot(collector.series(field = self.field, since = since), first, newest)
+		self.last_column = newest
+
+		SDL_BlitSurface(self.surface, None, self.window.backbuffer, self.rect)
+		self.window.markDirty(self.rect)
+
+	def plot(self, series = None, first = 0, newest = 0):
+		""" Clear and draw the columns from first to newest, for every monitor """
+
+		x_first = self.rect.w - 1 - (newest - first)
+		SDL_FillRect(self.surface, SDL_Rect(x_first, 0, self.rect.w - x_first, self.rect.h), self.background)
+
+		for m, (times, values) in enumerate(series):
+			colour = self.colours[m % len(self.colours)]
+
+			# Decimate - where more than one reading falls in a column, only its
+			# minimum and maximum are needed to draw it
+			lows = {}
+			highs = {}
+			lasts = {}
+			for t, v in zip(times, values):
+				if math.isnan(v):
+					continue
+				c = self.column(t)
+				if c > newest:
+					continue
+				if c in lows:
+					lows[c] = min(lows[c], v)
+					highs[c] = max(highs[c], v)
+				else:
+					lows[c] = v
+					highs[c] = v
+				lasts[c] = v
+
+			# Start from the most recent reading to the left of the redrawn columns, if
+			# there is one, so that the line joins up with what is already on screen
+			previous = None
+			for c in sorted(lasts.keys()):
+				if c >= first:
+					break
+				previous = lasts[c]
+
+			for c in range(first, newest + 1):
+				if c not in lows:
+					continue
+				low = lows[c]
+				high = highs[c]
+				if previous is not None:
+					low = min(low, previous)
+					high = max(high, previous)
+				previous = lasts[c]
+
+				y_top = self.scale(high)
+				y_bottom = self.scale(low)
+				x = self.rect.w - 1 - (newest - c)
+				SDL_FillRect(self.surface, SDL_Rect(x, y_top, 1, y_bottom - y_top + 1), colour)
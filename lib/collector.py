@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+# collector.py, gather power monitor readings from a background thread
+# Copyright (C) 2019  John Snowdon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import math
+import threading
+import time
+from array import array
+from types import SimpleNamespace
+
+from lib import config
+from lib.newlog import newlog
+from lib.history import RECORD_FIELDS
+
+# Set up a logger for this file
+logger = newlog(__file__)
+
+# The sensor values stored for each reading, in the order they are stored
+READING_FIELDS = ('voltage', 'frequency', 'current', 'apparent_power', 'reactive_power', 'real_power')
+
+class ReadingRing():
+	""" A fixed number of timestamped readings from one power monitor, oldest overwritten first """
+
+	def __init__(self, size = 600):
+		self.size = size
+		self.head = 0
+		self.count = 0
+
+		# One preallocated array per column, missing values are stored as NaN
+		self.times = array('d', [0.0] * size)
+		self.columns = {}
+		for field in READING_FIELDS:
+			self.columns[field] = array('d', [math.nan] * size)
+
+	def append(self, timestamp, readings):
+		""" Store a reading object (anything with the READING_FIELDS attributes) """
+
+		self.times[self.head] = timestamp
+		for field in READING_FIELDS:
+			value = getattr(readings, field, None)
+			if value is None:
+				value = math.nan
+			self.columns[field][self.head] = value
+		self.head = (self.head + 1) % self.size
+		self.count = min(self.count + 1, self.size)
+
+	def latest(self):
+		""" The newest reading, with None for missing values, or None if nothing has been stored """
+
+		if self.count == 0:
+			return None
+		i = (self.head - 1) % self.size
+		values = {'time' : self.times[i]}
+		for field in READING_FIELDS:
+			value = self.columns[field][i]
+			if math.isnan(value):
+				value = None
+			values[field] = value
+		return SimpleNamespace(**values)
+
+	def series(self, field = 'real_power', since = None):
+		""" Copies of the (times, values) of one field, oldest first, optionally only those newer than since """
+
+		# Readings are stored in time order, so walk back from the newest until we pass since
+		times = array('d')
+		values = array('d')
+		for n in range(1, self.count + 1):
+			i = (self.head - n) % self.size
+			if (since is not None) and (self.times[i] <= since):
+				break
+			times.append(self.times[i])
+			values.append(self.columns[field][i])
+		times.reverse()
+		values.reverse()
+		return times, values
+
+class PowerCollector(threading.Thread):
+	""" Listens for power monitor broadcasts in the background and keeps recent readings for each monitor """
+
+	def __init__(self, energenie = None, lock = None, wakeup = None, history = None):
+		super(PowerCollector, self).__init__()
+		self.daemon = True
+		self.energenie = energenie
+
+		# Optional on-disk store that every reading is also written to
+		self.history = history
+		self.interval = config.POWER_LISTEN_TIME
+		self.size = config.POWER_HISTORY_SIZE
+
+		# The radio lock - we can't receive while the radio worker is transmitting
+		self.lock = lock
+
+		# Optional callable used to tell the main loop that something has gone wrong
+		self.wakeup = wakeup
+
+		# Guards the ring buffers, which are read by the UI thread
+		self.data_lock = threading.Lock()
+		self.rings = []
+		for m in energenie['monitors']:
+			self.rings.append(ReadingRing(size = self.size))
+
+		# Incremented every time a new set of readings is stored
+		self.generation = 0
+
+		# Set when the energenie library has failed, the main loop reloads it
+		self.failed = threading.Event()
+		self.shutdown = threading.Event()
+
+	def run(self):
+		while not self.shutdown.wait(self.interval):
+			if self.failed.is_set():
+				continue
+			self.collect()
+
+	def collect(self):
+		""" Drain any broadcasts from the radio, then store the current readings of each monitor """
+
+		energenie = self.energenie
+		if energenie['lib']:
+			# If the radio worker is busy transmitting, try again next time
+			if not self.lock.acquire(blocking = False):
+				return
+			try:
+				energenie['lib'].loop()
+			except Exception as e:
+				logger.warn("Error while running Energenie loop")
+				logger.warn(e)
+				self.failed.set()
+				if self.wakeup:
+					self.wakeup()
+				return
+			finally:
+				self.lock.release()
+
+		now = time.time()
+		stored = []
+		with self.data_lock:
+			for m, (ring, monitor) in enumerate(zip(self.rings, energenie['monitors'])):
+				try:
+					readings = monitor.get_readings()
+				except Exception as e:
+					logger.debug("No power readings for %s [%s]", monitor, e, extra = {'repeating' : True})
+					continue
+				ring.append(now, readings)
+				stored.append((m, readings))
+			self.generation += 1
+
+		# Writing to disk can be slow, so don't keep the UI thread waiting for it
+		if self.history:
+			for m, readings in stored:
+				self.history.add(timestamp = now, monitor = m, readings = readings)
+
+	def restore(self):
+		""" Fill the ring buffers from the on-disk history, so that a restart doesn't lose recent readings """
+
+		if not self.history:
+			return
+		start = time.time() - (self.size * self.interval)
+		with self.data_lock:
+			for m, ring in enumerate(self.rings):
+				for record in self.history.query(start = start, monitor = m):
+					ring.append(record[0], SimpleNamespace(**dict(zip(RECORD_FIELDS, record))))
+		logger.info("Restored power readings from history")
+
+	def reload(self, energenie = None):
+		""" Start using a newly loaded energenie library, keeping the history we already have """
+
+		with self.data_lock:
+			while len(self.rings) < len(energenie['monitors']):
+				self.rings.append(ReadingRing(size = self.size))
+			self.energenie = energenie
+		self.failed.clear()
+
+	def latest(self):
+		""" The newest reading of each monitor (None where there isn't one yet) - used by the UI thread """
+
+		with self.data_lock:
+			return tuple(ring.latest() for ring in self.rings)
+
+	def series(self, field = 'real_power', since = None):
+		""" The (times, values) history of one field for each monitor """
+
+		with self.data_lock:
+			return tuple(ring.series(field = field, since = since) for ring in self.rings)
+
+	def stop(self):
+		logger.info("Shutting down power collector")
+		self.shutdown.set()
@@ -1,19 +1,84 @@
 APPLICATION_NAME = "sdlRFController"
 
-# Time between screen refresh/event checks
-REFRESH_TIME = 0.05
+# Time (in seconds) between redraws of screens that show live data,
+# such as the status and power monitor screens
+SCREEN_REFRESH_TIME = 0.5
 
-# Amount of time (in terms of screen refreshes) until we drop all cached
-# surfaces and fonts and reload them again
-CACHE_CLEAR_TIME = 100
+# Upper limits on the cache of bitmaps, rendered text, glyph atlases and fully
+# drawn pages (in bytes) and open fonts (a count). The least recently used entries
+# are freed first.
+CACHE_BUDGETS = {
+	'image'	: 4 * 1024 * 1024,
+	'text'	: 1 * 1024 * 1024,
+	'glyph'	: 1 * 1024 * 1024,
+	'page'	: 2 * 1024 * 1024,
+	'font'	: 8,
+}
+
+# Characters pre-rendered for live readouts (numbers, units and punctuation). Strings
+# made only of these are drawn a glyph at a time rather than rendered by TrueType.
+GLYPH_CHARSET = " 0123456789.,:;-+%/()abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+# Listen for broadcast messages every N seconds
+POWER_LISTEN_TIME = 1.0
+
+# How many of the most recent readings are kept in memory for each power monitor
+POWER_HISTORY_SIZE = 600
+
+# How often (in seconds) each item of system information on the status screen is read
+SYSTEM_SAMPLE_INTERVALS = {
+	'ip'		: 30,
+	'cpu_speed'	: 2,
+	'cpu_load'	: 1,
+	'cpu_temp'	: 5,
+	'uptime'	: 1,
+	'memory'	: 5,
+	'files'		: 10,
+}
+
+# Network interface whose address is shown on the status screen
+SYSTEM_NETWORK_INTERFACE = "eth0"
 
-# Listen for broadcast messages every N amount of loops
-POWER_LISTEN_TIME = 10
+# Send queued power commands grouped by remote (house code), rather than in
+# the order they are listed for a button. Turn this off if the order in which
+# devices power up matters more than the time it takes.
+RADIO_GROUP_REMOTES = 1
+
+# How power commands are transmitted to a socket, unless a button sets its own
+# 'transmit' entry in SCREENS. Each command is sent 'repeats' times, 'gap' seconds
+# apart plus up to 'jitter' seconds at random. With 'burst' set the repeats are
+# sent back to back and the gap is only left before the next socket.
+TRANSMIT_POLICY = {
+	'repeats'	: 2,
+	'gap'		: 0.1,
+	'jitter'	: 0.0,
+	'burst'		: False,
+}
+
+# With --fake-radio, how many seconds each pretend transmission takes
+FAKE_RADIO_SEND_TIME = 0.02
+
+# Keep counters and latency histograms for input, power commands and screen updates.
+# They are shown on the status screen and written to METRICS_FILE on exit.
+METRICS = 0
+METRICS_FILE = "metrics.json"
 
 # Enable more verbose output
 DEBUG = 0
 INFO = 1
 
+# Log messages are written out by a background thread, so a slow console never holds up
+# the UI. LOG_FILE, if set, gets a copy of everything written to the console. With
+# LOG_STRUCTURED each message is written as one line of JSON instead of plain text.
+LOG_FILE = ""
+LOG_STRUCTURED = 0
+
+# Any one log line marked as repeating (a warning or debug message logged for every event)
+# is written at most LOG_RATE_BURST times in LOG_RATE_INTERVAL seconds, the rest are
+# counted and the count is shown on the next one written. 0 to disable.
+LOG_RATE_BURST = 20
+LOG_RATE_INTERVAL = 1.0
+
 # Screen size
 SCREEN_W = 480
 SCREEN_H = 320
@@ -48,6 +113,13 @@ HIGHLIGHT_COLOUR = {
         'b'     : 180,
 }
 
+# Warning colour, e.g. when a radio command has failed
+ERROR_COLOUR = {
+        'r'     : 220,
+        'g'     : 40,
+        'b'     : 40,
+}
+
 # Image folder
 ASSETS_FOLDER = "./assets/"
 
@@ -101,12 +173,69 @@ MAX_COLS = 2
 BUTTON_WIDTH = 200
 BUTTON_HEIGHT = 60
 
+# Size (in pixels) of the grid cells used to find which button was clicked
+HIT_GRID_SIZE = 40
+
+# Redraws which change more than this many separate regions of the screen
+# are uploaded as one single region instead
+DAMAGE_MAX_RECTS = 8
+
 # How long a button flashes
 BUTTON_FLASH_DELAY = 0.1
 
+# Animated changes between screens - a slide when moving between pages of
+# buttons, a cross-fade when switching to another screen. Set TRANSITION_TIME
+# to 0 to turn them off. Frames are drawn at up to TRANSITION_FPS, and a
+# transition is cut short rather than overrun TRANSITION_TIME on slow hardware.
+# Each of the transitions below may be "slide_left", "slide_right", "fade" or None.
+TRANSITION_TIME = 0.25
+TRANSITION_FPS = 30
+TRANSITION_PAGE_FORWARD = "slide_left"
+TRANSITION_PAGE_BACK = "slide_right"
+TRANSITION_SCREEN = "fade"
+
+# Height of the progress bar drawn on a button while its radio commands are sent
+RADIO_PROGRESS_H = 4
+
+# Power monitor chart - how many seconds of readings each pixel column covers
+CHART_SECONDS_PER_PX = 1.0
+
+# Chart fill, and a line colour for each power monitor, in the same order as POWER_MONITORS
+CHART_BACKGROUND_COLOUR = { 'r' : 20, 'g': 20, 'b': 20}
+CHART_COLOURS = [
+	{ 'r' : 255, 'g': 200, 'b': 0},
+	{ 'r' : 0, 'g': 200, 'b': 255},
+	{ 'r' : 120, 'g': 255, 'b': 80},
+	{ 'r' : 255, 'g': 80, 'b': 200},
+]
+
+# The reading plotted by each of the chart buttons, and the range of its vertical axis
+CHART_METRICS = {
+	'btn_graph_volts'	: { 'field' : 'voltage', 'text' : "Volts", 'min' : 220.0, 'max' : 250.0},
+	'btn_graph_hz'		: { 'field' : 'frequency', 'text' : "Hz", 'min' : 48.0, 'max' : 53.0},
+	'btn_graph_amp'		: { 'field' : 'current', 'text' : "Amps", 'min' : 0.0, 'max' : 13.0},
+	'btn_graph_watt'	: { 'field' : 'real_power', 'text' : "Watts", 'min' : 0.0, 'max' : 3000.0},
+}
+CHART_DEFAULT_METRIC = 'btn_graph_watt'
+
 # How long between presses a button will respond to touchscreen
 BUTTON_BOUNCE_TIME = 0.1
 
+# Touch gestures. A finger which moves no more than GESTURE_TAP_SLOP pixels is a
+# tap, or a long press if it is held for GESTURE_LONG_PRESS_TIME seconds. A mostly
+# sideways movement of at least GESTURE_SWIPE_DISTANCE pixels, within
+# GESTURE_SWIPE_TIME seconds, is a swipe - which moves between pages of buttons.
+GESTURE_TAP_SLOP = 15
+GESTURE_LONG_PRESS_TIME = 0.8
+GESTURE_SWIPE_DISTANCE = 80
+GESTURE_SWIPE_TIME = 0.6
+
+# The buttons can be kept in a file of their own instead of SCREENS below - a Python (.py),
+# TOML (.toml) or JSON (.json) file with a SCREENS entry laid out the same way. It is
+# checked when loaded, then kept ready to use in LAYOUT_CACHE until the file changes.
+LAYOUT_FILE = ""
+LAYOUT_CACHE = "layout.cache"
+
 # A structure defining which buttons should be on which pages
 SCREENS = {
 	# First page
@@ -837,3 +966,13 @@ POWER_MONITORS = {
 		'deviceid'	: 'mon4',
 	},
 }
+
+# Readings from the power monitors are kept on disk, at full resolution and averaged
+# over each minute and each hour. Each tier holds a fixed number of records (one per
+# monitor per period), after which the oldest are overwritten.
+HISTORY_FOLDER = "./history/"
+HISTORY_TIERS = [
+	{ 'name' : "1s", 'resolution' : 1, 'capacity' : len(POWER_MONITORS) * 6 * 3600 },		# 6 hours
+	{ 'name' : "1m", 'resolution' : 60, 'capacity' : len(POWER_MONITORS) * 7 * 1440 },		# 7 days
+	{ 'name' : "1h", 'resolution' : 3600, 'capacity' : len(POWER_MONITORS) * 366 * 24 },	# 1 year
+]
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+# fakeradio.py, a stand-in for the energenie library which only records what it is asked to send
+# Copyright (C) 2019  John Snowdon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+from lib.newlog import newlog
+
+# Set up a logger for this file
+logger = newlog(__file__)
+
+class FakeSocket():
+	""" An ENER002 socket which records each command instead of transmitting it """
+
+	def __init__(self, radio = None, address = None):
+		self.radio = radio
+		self.remote, self.socket = address
+
+	def turn_on(self):
+		self.radio.send(self, "ON")
+
+	def turn_off(self):
+		self.radio.send(self, "OFF")
+
+class FakeMonitor():
+	""" A MIHO004 power monitor with made-up readings """
+
+	def get_readings(self):
+		return SimpleNamespace(
+			voltage = random.uniform(230.0, 241.9),
+			frequency = random.uniform(48.2, 52.7),
+			current = random.uniform(0.2, 13.0),
+			apparent_power = random.uniform(0.0, 300),
+			reactive_power = random.uniform(0.0, 300),
+			real_power = random.uniform(0.0, 300),
+		)
+
+class FakeEnergenie():
+	""" Has the parts of the energenie module interface that load_energenie() and the radio worker use.
+	Each command takes send_time seconds, like a real transmission, and is kept in sends. """
+
+	def __init__(self, send_time = 0.0):
+		self.send_time = send_time
+		self.Devices = SimpleNamespace(ENER002 = lambda address: FakeSocket(radio = self, address = address))
+		self.registry = SimpleNamespace(get = lambda deviceid: FakeMonitor())
+
+		# (time.monotonic(), remote, socket, action) for every command, oldest first
+		self.sends = []
+		self.lock = threading.Lock()
+
+	def init(self):
+		logger.info("Using a fake radio - no power commands will be transmitted")
+
+	def loop(self):
+		pass
+
+	def send(self, device, action):
+		with self.lock:
+			self.sends.append((time.monotonic(), device.remote, device.socket, action))
+		logger.debug("Fake radio %#x.%s %s", device.remote, device.socket, action, extra = {'repeating' : True})
+		if self.send_time:
+			time.sleep(self.send_time)
+
+	def finished(self):
+		logger.info("Fake radio was asked to send %s commands" % len(self.sends))
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+# gestures.py, turn touchscreen and mouse input into taps, long presses and swipes
+# Copyright (C) 2019  John Snowdon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+from collections import namedtuple
+
+from lib import config
+from lib.newlog import newlog
+
+# Set up a logger for this file
+logger = newlog(__file__)
+
+# Kinds of pointer input fed in, the same values as the evdev touchscreen reader uses
+POINTER_DOWN = 1
+POINTER_MOVE = 2
+POINTER_UP = 3
+
+# Gestures handed to the main loop. x and y are screen coordinates of where the finger went down.
+GESTURE_TAP = "tap"
+GESTURE_LONG_PRESS = "long_press"
+GESTURE_SWIPE_LEFT = "swipe_left"
+GESTURE_SWIPE_RIGHT = "swipe_right"
+
+Gesture = namedtuple('Gesture', ['kind', 'x', 'y'])
+
+class GestureRecogniser():
+	""" Follows one finger (or the mouse) from down to up and decides what gesture it made.
+	Timestamps may come from any clock, as long as one touch uses the same clock throughout. """
+
+	def __init__(self):
+		self.gestures = []
+
+		# The touch in progress, if any
+		self.down = False
+		self.start_x = 0
+		self.start_y = 0
+		self.start_time = 0
+		self.moved = False
+		self.held = False
+
+		# Difference between time.monotonic() and the clock of the touch in progress
+		self.offset = 0
+
+		# When the last touch ended, in the clock it was made with
+		self.last_up = None
+
+	def feed(self, kind = None, x = 0, y = 0, timestamp = 0):
+		""" Take one pointer event, in screen coordinates """
+
+		if kind == POINTER_DOWN:
+			# A contact which bounces lifts and lands again straight away
+			if (self.last_up is not None) and (0 <= (timestamp - self.last_up) < config.BUTTON_BOUNCE_TIME):
+				logger.debug("Ignoring touch - possible button bounce [%.2fs < %ss]", timestamp - self.last_up, config.BUTTON_BOUNCE_TIME, extra = {'repeating' : True})
+				self.down = False
+				return
+			self.down = True
+			self.start_x = x
+			self.start_y = y
+			self.start_time = timestamp
+			self.offset = time.monotonic() - timestamp
+			self.moved = False
+			self.held = False
+
+		elif not self.down:
+			# Moves and lifts of a touch we ignored, or never saw go down
+			if kind == POINTER_UP:
+				self.last_up = timestamp
+			return
+
+		elif kind == POINTER_MOVE:
+			if (abs(x - self.start_x) > config.GESTURE_TAP_SLOP) or (abs(y - self.start_y) > config.GESTURE_TAP_SLOP):
+				self.moved = True
+
+		elif kind == POINTER_UP:
+			self.down = False
+			self.last_up = timestamp
+			dx = x - self.start_x
+			dy = y - self.start_y
+			if (abs(dx) >= config.GESTURE_SWIPE_DISTANCE) and (abs(dx) > (2 * abs(dy))) and ((timestamp - self.start_time) <= config.GESTURE_SWIPE_TIME):
+				if dx < 0:
+					self.emit(GESTURE_SWIPE_LEFT)
+				else:
+					self.emit(GESTURE_SWIPE_RIGHT)
+			elif self.moved or (abs(dx) > config.GESTURE_TAP_SLOP) or (abs(dy) > config.GESTURE_TAP_SLOP):
+				# Dragged off the button, or too slow or too short to be a swipe
+				logger.debug("Ignoring touch - moved %s,%s", dx, dy, extra = {'repeating' : True})
+			elif not self.held:
+				self.emit(GESTURE_TAP)
+
+	def emit(self, kind):
+		logger.debug("Gesture [%s] at %s,%s", kind, self.start_x, self.start_y)
+		self.gestures.append(Gesture(kind, self.start_x, self.start_y))
+
+	def deadline(self):
+		""" Seconds until a finger still held down becomes a long press, or None if there is nothing to wait for """
+
+		if (not self.down) or self.held or self.moved:
+			return None
+		return max(0, (self.start_time + self.offset + config.GESTURE_LONG_PRESS_TIME) - time.monotonic())
+
+	def next(self):
+		""" Return the oldest gesture not yet handled, or None """
+
+		if (self.deadline() == 0):
+			self.held = True
+			self.emit(GESTURE_LONG_PRESS)
+
+		if len(self.gestures) == 0:
+			return None
+		return self.gestures.pop(0)
+
+	def pending(self):
+		""" Are there more gestures waiting to be handled? """
+
+		return len(self.gestures) > 0
@@ -21,10 +21,12 @@ import os
 import sys
 import ctypes
 import time
+from collections import OrderedDict
 from sdl2 import *
 from sdl2.sdlttf import *
 
 from lib import config
+from lib import metrics
 from lib.newlog import newlog
 from lib.buttons import getPages, getButtons
 
@@ -34,6 +36,34 @@ from sdl2 import *
 # Set up a logger for this file
 logger = newlog(__file__)
 
+def uploadRegion(surface, texture, x, y, w, h):
+	""" Copy one region of a surface into the same region of a streaming texture in the same pixel format """
+	
+	surface = surface.contents
+	bpp = surface.format.contents.BytesPerPixel
+	pixels = ctypes.c_void_p()
+	pitch = ctypes.c_int()
+	
+	# Copy the region, row by row, into the locked area of the texture
+	if SDL_LockTexture(texture, SDL_Rect(x, y, w, h), ctypes.byref(pixels), ctypes.byref(pitch)) != 0:
+		logger.warn("Unable to lock texture: %s" % SDL_GetError())
+		return False
+	src = surface.pixels + (y * surface.pitch) + (x * bpp)
+	row_bytes = w * bpp
+	if (row_bytes == surface.pitch) and (pitch.value == surface.pitch):
+		ctypes.memmove(pixels.value, src, row_bytes * h)
+	else:
+		for row in range(0, h):
+			ctypes.memmove(pixels.value + (row * pitch.value), src + (row * surface.pitch), row_bytes)
+	SDL_UnlockTexture(texture)
+	return True
+
+def easeOut(progress):
+	""" Start quickly and slow down towards the end """
+	
+	progress = min(max(progress, 0.0), 1.0)
+	return 1 - ((1 - progress) * (1 - progress))
+
 class gfxData():
 	""" Encapsulation of an SDL window/canvas and a hardware dependent renderer """
 	
@@ -54,16 +84,53 @@ class gfxData():
                                   0,
                                   0,
                                   255)
-		self.render_texture = None
 		
-		# Boxes is a list of UI elements and their coordinates (x1,y1 - x2, y2) that can be clicked on or touched.
-		# List refreshed each redraw of the screen and checked each time the SDL input event detects mouse click.
-		# List is populated by each relevant function that draws an element on the screen.
-		self.boxes = []
+		# The render texture lives as long as the window. It is a streaming texture in the same pixel
+		# format as the backbuffer, so that changed regions of the backbuffer can be copied straight
+		# into it each redraw, rather than creating a new texture from the whole backbuffer every time.
+		self.render_texture = SDL_CreateTexture(self.renderer, self.backbuffer.contents.format.contents.format, SDL_TEXTUREACCESS_STREAMING, config.SCREEN_W, config.SCREEN_H)
+		if not self.render_texture:
+			logger.error("Unable to create a streaming render texture")
+			logger.error(SDL_GetError())
+		
+		# Set when old_backbuffer holds a copy of the screen for the next update() to transition from
+		self.transition_ready = False
+		self.transition = None
+		
+		# The outgoing screen is uploaded here for a transition, the renderer then moves or blends
+		# the two textures into each other, so no pixels are mixed by the CPU
+		self.old_texture = SDL_CreateTexture(self.renderer, self.backbuffer.contents.format.contents.format, SDL_TEXTUREACCESS_STREAMING, config.SCREEN_W, config.SCREEN_H)
+		if not self.old_texture:
+			logger.error("Unable to create a transition texture")
+			logger.error(SDL_GetError())
+		
+		# The transition effect being played on the timeline, if any. While it runs it owns the
+		# screen, so update() leaves presenting the new content to its next frame.
+		self.playing = None
 		
-		# Cache of surfaces we've loaded from on-disk bitmaps
-		self.cachedSurfaces = {}
-		self.cachedFonts = {}
+		# Damage list - the regions (x, y, w, h) of the backbuffer which have changed since the last
+		# update() and need to be uploaded to the render texture. The texture starts out empty, so
+		# the whole screen is damaged to begin with.
+		self.damage = [(0, 0, config.SCREEN_W, config.SCREEN_H)]
+		
+		# A key describing what is currently drawn on the backbuffer, set by each render function.
+		# Lets a render function tell whether it needs to redraw the whole screen, or just the
+		# parts of it which have changed.
+		self.layout = None
+		
+		# Hits indexes the UI elements (boxes) and their coordinates (x1,y1 - x2, y2) that can be clicked on or touched.
+		# It is rebuilt each time a screen is laid out, and checked each time the SDL input event detects a click.
+		# Boxes are added by each relevant function that draws an element on the screen.
+		self.hits = HitIndex()
+		
+		# Cache of surfaces we've loaded from on-disk bitmaps, rendered text and open fonts
+		self.cache = SurfaceCache(config.CACHE_BUDGETS)
+		
+		# Effects, such as button flashes and screen transitions, which are still being shown
+		self.timeline = Timeline()
+		
+		# The power monitor chart, kept between redraws so that it can be scrolled rather than redrawn
+		self.chart = None
 		
 		# Store mouse/touchscreen coordinates
 		self.mouse_x = ctypes.c_int(0)
@@ -101,21 +168,12 @@ class gfxData():
 		
 		self.background_colour = SDL_MapRGB(self.backbuffer.contents.format, config.BACKGROUND_COLOUR['r'], config.BACKGROUND_COLOUR['g'], config.BACKGROUND_COLOUR['b'])
 		self.highlight_colour = SDL_MapRGB(self.backbuffer.contents.format, config.HIGHLIGHT_COLOUR['r'], config.HIGHLIGHT_COLOUR['g'], config.HIGHLIGHT_COLOUR['b'])
+		self.error_colour = SDL_MapRGB(self.backbuffer.contents.format, config.ERROR_COLOUR['r'], config.ERROR_COLOUR['g'], config.ERROR_COLOUR['b'])
 	
 	def clearCache(self):
 		""" Free any cached surfaces or fonts """
-		cachedSurfaces = list(self.cachedSurfaces.keys())
-		cachedFonts = list(self.cachedFonts.keys())
-			
-		for s in cachedSurfaces:
-			#logger.debug("Freeing old surface [%s]" % s)
-			SDL_FreeSurface(self.cachedSurfaces[s])
-		self.cachedSurfaces = {}
-		
-		for f in cachedFonts:
-			#logger.debug("Freeing old font [%s]" % f)
-			TTF_CloseFont(self.cachedFonts[f])
-		self.cachedFonts = {}
+		
+		self.cache.clear()
 		
 		#logger.debug("Running Python garbage collection")
 		gc.collect()
@@ -124,7 +182,7 @@ class gfxData():
 		""" Called when a Linux /dev/input/touchscreen event is detected - read the raw x/y values and map to the screen resolution coordinates """
 		
 		
-		logger.debug("Raw Coordinates x:%s y:%s" % (self.touch_x_raw, self.touch_y_raw))
+		logger.debug("Raw Coordinates x:%s y:%s", self.touch_x_raw, self.touch_y_raw, extra = {'repeating' : True})
 		
 		if config.TOUCH['y_min'] > config.TOUCH['y_max']:
 			self.mouse_y.value = int((config.TOUCH['y_min'] - self.touch_y_raw) *  (self.touch_pts_per_ypixel))
@@ -148,52 +206,165 @@ class gfxData():
 		if self.mouse_y.value > config.SCREEN_H:
 			self.mouse_y.value = config.SCREEN_H
 		
-		logger.debug("Coordinates x:%s y:%s" % (self.mouse_x.value, self.mouse_y.value))
+		logger.debug("Coordinates x:%s y:%s", self.mouse_x.value, self.mouse_y.value, extra = {'repeating' : True})
 	
 	def mouseRead(self, event):
 		""" Called whenever an SDL Event of type touchscreen or mouse click is detected, reads and stores pointer position """
 		self.mouse_buttons = SDL_GetMouseState(self.mouse_x, self.mouse_y)
-		logger.debug("Coordinates x:%s y:%s" % (self.mouse_x.value, self.mouse_y.value))
-		logger.debug("Clicks: %s" % event.button.clicks)
+		logger.debug("Coordinates x:%s y:%s", self.mouse_x.value, self.mouse_y.value, extra = {'repeating' : True})
+		logger.debug("Clicks: %s", event.button.clicks)
 	
 	def boxPressed(self):
 		""" Compares the values of the current pointer position with any UI elements we've drawn on scree.
 		If any areas have been clicked then the name of the UI element is returned and the main while-loop
 		event handler can deal with it. """
-		for box in self.boxes:
-			if (self.mouse_x.value >= box["x1"]) and (self.mouse_x.value <= box["x2"]):
-				if (self.mouse_y.value >= box["y1"]) and (self.mouse_y.value <= box["y2"]):
-					logger.debug("Button")
-					return box
-		return False
+		start = metrics.clock()
+		box = self.hits.find(self.mouse_x.value, self.mouse_y.value)
+		metrics.since("hit_test", start)
+		if box:
+			logger.debug("Button")
+		return box
 	
 	def boxPressedByName(self, name = None):
-		""" Return a button from the list of current boxes, if it exists by name """
-		for box in self.boxes:
-			if box['name'] == name:
-				return box
-		return False
+		""" Return a button from the current boxes, if it exists by name """
+		return self.hits.named(name)
 	
-	def update(self, transition = None, reuse_texture = False):
-		""" Redraw the screen """		
+	def addBox(self, box = None):
+		""" Make a box drawn on the current layer clickable """
+		self.hits.add(box)
+	
+	def pushLayer(self, rect = None, modal = True):
+		""" Start a new layer of boxes above the existing ones, e.g. for a popup window """
+		self.hits.push(rect = rect, modal = modal)
+	
+	def markDirty(self, rect = None):
+		""" Record a region of the backbuffer as changed - an SDL_Rect, an (x, y, w, h) tuple, or None for the whole screen """
+		
+		if rect is None:
+			self.damage = [(0, 0, config.SCREEN_W, config.SCREEN_H)]
+			return
+		
+		if isinstance(rect, SDL_Rect):
+			rect = (rect.x, rect.y, rect.w, rect.h)
+		
+		# Constrain to the screen
+		x1 = max(0, rect[0])
+		y1 = max(0, rect[1])
+		x2 = min(config.SCREEN_W, rect[0] + rect[2])
+		y2 = min(config.SCREEN_H, rect[1] + rect[3])
+		if (x2 <= x1) or (y2 <= y1):
+			return
+		
+		# Drop any existing regions which the new one covers, or the new one if it is already covered
+		damage = []
+		for d in self.damage:
+			if (d[0] <= x1) and (d[1] <= y1) and (d[0] + d[2] >= x2) and (d[1] + d[3] >= y2):
+				return
+			if (x1 <= d[0]) and (y1 <= d[1]) and (x2 >= d[0] + d[2]) and (y2 >= d[1] + d[3]):
+				continue
+			damage.append(d)
+		damage.append((x1, y1, x2 - x1, y2 - y1))
+		
+		# Lots of small regions cost more in upload calls than they save - merge them into one
+		if len(damage) > config.DAMAGE_MAX_RECTS:
+			x1 = min(d[0] for d in damage)
+			y1 = min(d[1] for d in damage)
+			x2 = max(d[0] + d[2] for d in damage)
+			y2 = max(d[1] + d[3] for d in damage)
+			damage = [(x1, y1, x2 - x1, y2 - y1)]
+		
+		self.damage = damage
+	
+	def prepareTransition(self, transition = None):
+		""" Keep a copy of the current screen, so that the next update() can transition from it to the new one.
+		If a transition is named, the next update() which has something new to show plays it. """
 		
-		# Without any transitions, just copy backbuffers, then render to texture
-		if reuse_texture:
-			SDL_RenderCopy(self.renderer, self.render_texture, None, None)
-		else:
-			self.render_texture = SDL_CreateTextureFromSurface(self.renderer, self.backbuffer)
-			SDL_RenderCopy(self.renderer, self.render_texture, None, None)
-		SDL_RenderPresent(self.renderer)
-		SDL_DestroyTexture(self.render_texture)		
-				
-		# Lastly, take a copy of the old backbuffer (so we can do effects on it next time round)
 		SDL_BlitSurface(self.backbuffer, None, self.old_backbuffer, None)
+		self.transition_ready = True
+		self.transition = transition
+	
+	def update(self, transition = None):
+		""" Upload the changed regions of the backbuffer and redraw the screen """		
+		
+		start = metrics.clock()
+		
+		# Anything drawn up to now may be evicted from the cache again
+		self.cache.nextFrame()
+		
+		if transition is None:
+			transition = self.transition
+		self.transition = None
+		if transition is not None:
+			if not self.transition_ready:
+				logger.debug("Transition [%s] requested without calling prepareTransition()", transition)
+				transition = None
+			elif (config.TRANSITION_TIME <= 0) or (transition not in TRANSITIONS):
+				transition = None
+		self.transition_ready = False
+		
+		# Nothing has changed since the last redraw
+		if len(self.damage) == 0:
+			return
+		
+		# Don't start a new transition from the middle of an old one
+		if (transition is not None) and (self.playing is not None):
+			self.timeline.finish(self.playing.rect)
+		
+		for (x, y, w, h) in self.damage:
+			uploadRegion(self.backbuffer, self.render_texture, x, y, w, h)
+		self.damage = []
+		
+		if transition is not None:
+			uploadRegion(self.old_backbuffer, self.old_texture, 0, 0, config.SCREEN_W, config.SCREEN_H)
+			self.timeline.add(TransitionEffect(window = self, transition = transition, duration = config.TRANSITION_TIME))
+		elif self.playing is None:
+			SDL_RenderCopy(self.renderer, self.render_texture, None, None)
+			SDL_RenderPresent(self.renderer)
+		metrics.since("frame", start)
+		metrics.count("frames")
+	
+	def drawSlide(self, progress, direction):
+		""" One frame of the new screen pushing the old one off the side - direction is -1 for left, 1 for right """
+		
+		offset = int(config.SCREEN_W * easeOut(progress))
+		SDL_RenderCopy(self.renderer, self.old_texture, None, SDL_Rect(direction * offset, 0, config.SCREEN_W, config.SCREEN_H))
+		SDL_RenderCopy(self.renderer, self.render_texture, None, SDL_Rect(direction * (offset - config.SCREEN_W), 0, config.SCREEN_W, config.SCREEN_H))
+	
+	def drawSlideLeft(self, progress):
+		self.drawSlide(progress, -1)
+	
+	def drawSlideRight(self, progress):
+		self.drawSlide(progress, 1)
+	
+	def drawFade(self, progress):
+		""" One frame of the new screen faded in over the old one """
+		
+		SDL_RenderCopy(self.renderer, self.old_texture, None, None)
+		SDL_SetTextureBlendMode(self.render_texture, SDL_BLENDMODE_BLEND)
+		SDL_SetTextureAlphaMod(self.render_texture, int(255 * progress))
+		SDL_RenderCopy(self.renderer, self.render_texture, None, None)
+		SDL_SetTextureAlphaMod(self.render_texture, 255)
+		SDL_SetTextureBlendMode(self.render_texture, SDL_BLENDMODE_NONE)
 		
 	def clear(self):
 		""" Blank the screen - most likely called at the start of displaying any new page """
 		# Blank the UI element coordinates
-		self.boxes = []
+		self.hits.clear()
+		self.timeline.discard()
+		self.layout = None
+		if self.chart is not None:
+			self.chart.free()
+			self.chart = None
 		SDL_FillRect(self.backbuffer, None, self.background_colour)
+		self.markDirty()
+
+	def restore(self, snapshot = None):
+		""" Put a ScreenSnapshot back on the backbuffer, along with its clickable boxes """
+		
+		self.clear()
+		copyPixels(snapshot.surface, self.backbuffer)
+		for box in snapshot.boxes:
+			self.hits.add(dict(box))
 
 	def sdlWindow(self):
 		return self.window
@@ -204,6 +375,486 @@ class gfxData():
 	def sdlSurface(self):
 		return self.buffer_2
 
+class SurfaceCache():
+	""" A least recently used cache of SDL surfaces and TTF fonts, with a separate budget for each class of object """
+	
+	def __init__(self, budgets = None):
+		
+		# Budgets are in bytes for surfaces ('image' and 'text'), or a number of open fonts ('font')
+		self.budgets = budgets
+		
+		# Each class holds key : [object, size, frame], oldest first
+		self.entries = {}
+		self.used = {}
+		self.hits = {}
+		self.misses = {}
+		self.evictions = {}
+		for c in self.budgets.keys():
+			self.entries[c] = OrderedDict()
+			self.used[c] = 0
+			self.hits[c] = 0
+			self.misses[c] = 0
+			self.evictions[c] = 0
+		
+		# Objects used in the current frame are never evicted, as the
+		# caller may still be holding on to them
+		self.frame = 0
+		
+	def get(self, c, key):
+		""" Return a cached object, or None if it is not in the cache """
+		
+		entry = self.entries[c].get(key)
+		if entry is None:
+			self.misses[c] += 1
+			return None
+		
+		self.hits[c] += 1
+		entry[2] = self.frame
+		self.entries[c].move_to_end(key)
+		return entry[0]
+	
+	def put(self, c, key, obj, size = 1):
+		""" Add an object to the cache, evicting the least recently used objects if over budget """
+		
+		if key in self.entries[c]:
+			self.used[c] -= self.entries[c][key][1]
+			self.free(c, self.entries[c][key][0])
+		self.entries[c][key] = [obj, size, self.frame]
+		self.entries[c].move_to_end(key)
+		self.used[c] += size
+		
+		for old_key in list(self.entries[c].keys()):
+			if self.used[c] <= self.budgets[c]:
+				break
+			if self.entries[c][old_key][2] == self.frame:
+				# Everything left is in use - stay over budget until the next frame
+				break
+			self.remove(c, old_key)
+			self.evictions[c] += 1
+	
+	def remove(self, c, key):
+		""" Free and forget a single cached object """
+		
+		obj, size, frame = self.entries[c].pop(key)
+		self.used[c] -= size
+		self.free(c, obj)
+		
+		# Text surfaces and glyph atlases are keyed on the font they were rendered
+		# with, and that font handle is no longer valid, so they can't be found again
+		if c == "font":
+			for text_c in ["text", "glyph"]:
+				for text_key in [k for k in self.entries[text_c].keys() if k[0] == fontKey(obj)]:
+					self.remove(text_c, text_key)
+	
+	def free(self, c, obj):
+		""" Release the SDL resource behind a cached object """
+		
+		if c == "font":
+			TTF_CloseFont(obj)
+		elif c in ["glyph", "page"]:
+			obj.free()
+		else:
+			SDL_FreeSurface(obj)
+	
+	def nextFrame(self):
+		""" Mark the end of a frame - objects used so far may now be evicted """
+		
+		self.frame += 1
+		
+	def clear(self):
+		""" Free everything in the cache """
+		
+		for c in ["text", "glyph", "page", "image", "font"]:
+			for key in list(self.entries[c].keys()):
+				if key in self.entries[c]:
+					self.remove(c, key)
+	
+	def size(self, c):
+		""" Number of objects of one class held in the cache """
+		
+		return len(self.entries[c])
+	
+	def stats(self):
+		""" Return a dictionary of cache counters for each class of object """
+		
+		stats = {}
+		for c in self.budgets.keys():
+			stats[c] = {
+				'objects'	: len(self.entries[c]),
+				'used'		: self.used[c],
+				'budget'	: self.budgets[c],
+				'hits'		: self.hits[c],
+				'misses'	: self.misses[c],
+				'evictions'	: self.evictions[c],
+			}
+		return stats
+
+def surfaceSize(surface):
+	""" Number of bytes of pixel data held by an SDL surface """
+	
+	return surface.contents.pitch * surface.contents.h
+
+def fontKey(font):
+	""" A hashable identity for an open TTF font handle """
+	
+	return ctypes.cast(font, ctypes.c_void_p).value
+
+class GlyphAtlas():
+	""" Every character of config.GLYPH_CHARSET rendered once, in one font and colour, side by side on a
+	single surface. Strings of those characters are then drawn by copying glyphs, not by TrueType. """
+	
+	def __init__(self, font = None, sdl_colour = None):
+		self.rects = {}
+		self.height = 0
+		
+		glyphs = []
+		w = 0
+		for ch in config.GLYPH_CHARSET:
+			surface = TTF_RenderText_Blended(font, str.encode(ch), sdl_colour)
+			if not surface:
+				continue
+			glyphs.append((ch, surface))
+			w += surface.contents.w
+			self.height = max(self.height, surface.contents.h)
+		
+		self.surface = SDL_CreateRGBSurfaceWithFormat(0, max(w, 1), max(self.height, 1), 32, SDL_PIXELFORMAT_ARGB8888)
+		x = 0
+		for ch, surface in glyphs:
+			# Copy each glyph, alpha and all, rather than blending it onto the atlas
+			SDL_SetSurfaceBlendMode(surface, SDL_BLENDMODE_NONE)
+			rect = SDL_Rect(x, 0, surface.contents.w, surface.contents.h)
+			SDL_BlitSurface(surface, None, self.surface, rect)
+			self.rects[ch] = rect
+			x += surface.contents.w
+			SDL_FreeSurface(surface)
+		SDL_SetSurfaceBlendMode(self.surface, SDL_BLENDMODE_BLEND)
+	
+	def covers(self, text):
+		""" Can this string be drawn from the atlas? """
+		
+		for ch in text:
+			if ch not in self.rects:
+				return False
+		return True
+	
+	def size(self, text):
+		""" Width and height of a string drawn from the atlas """
+		
+		w = 0
+		for ch in text:
+			w += self.rects[ch].w
+		return w, self.height
+	
+	def draw(self, target, text, x, y):
+		""" Draw a string onto a surface, one glyph at a time """
+		
+		for ch in text:
+			rect = self.rects[ch]
+			SDL_BlitSurface(self.surface, rect, target, SDL_Rect(x, y, rect.w, rect.h))
+			x += rect.w
+	
+	def bytes(self):
+		return surfaceSize(self.surface)
+	
+	def free(self):
+		SDL_FreeSurface(self.surface)
+		self.surface = None
+
+class HitLayer():
+	""" The clickable boxes drawn at one level of the screen, indexed by grid cell and by name """
+	
+	__slots__ = ('rect', 'modal', 'cells', 'names', 'boxes')
+	
+	def __init__(self, rect = None, modal = False):
+		# A layer hides the layers below it, either everywhere (modal) or just inside its rect (x1, y1, x2, y2)
+		self.rect = rect
+		self.modal = modal
+		self.cells = {}
+		self.names = {}
+		self.boxes = []
+	
+	def covers(self, x, y):
+		if self.modal:
+			return True
+		if self.rect is None:
+			return False
+		return (x >= self.rect[0]) and (x <= self.rect[2]) and (y >= self.rect[1]) and (y <= self.rect[3])
+
+class HitIndex():
+	""" Finds the box under a point by looking in a uniform grid of screen cells, top layer first """
+	
+	def __init__(self):
+		self.cell_size = config.HIT_GRID_SIZE
+		self.clear()
+	
+	def clear(self):
+		""" Forget every box on every layer """
+		
+		self.layers = [HitLayer()]
+	
+	def push(self, rect = None, modal = True):
+		""" Start a new top layer. Rect is an SDL_Rect or (x, y, w, h) tuple. """
+		
+		if rect is not None:
+			if isinstance(rect, SDL_Rect):
+				rect = (rect.x, rect.y, rect.w, rect.h)
+			rect = (rect[0], rect[1], rect[0] + rect[2], rect[1] + rect[3])
+		self.layers.append(HitLayer(rect = rect, modal = modal))
+	
+	def add(self, box = None):
+		""" Index a box on the top layer """
+		
+		layer = self.layers[-1]
+		layer.boxes.append(box)
+		if box['name'] not in layer.names:
+			layer.names[box['name']] = box
+		for cx in range(int(box['x1'] // self.cell_size), int(box['x2'] // self.cell_size) + 1):
+			for cy in range(int(box['y1'] // self.cell_size), int(box['y2'] // self.cell_size) + 1):
+				layer.cells.setdefault((cx, cy), []).append(box)
+	
+	def find(self, x, y):
+		""" The box under a point, or False """
+		
+		cell = (int(x // self.cell_size), int(y // self.cell_size))
+		for layer in reversed(self.layers):
+			for box in layer.cells.get(cell, []):
+				if (x >= box["x1"]) and (x <= box["x2"]) and (y >= box["y1"]) and (y <= box["y2"]):
+					return box
+			if layer.covers(x, y):
+				return False
+		return False
+	
+	def named(self, name = None):
+		""" The first box with a given name which isn't hidden by a modal layer, or False """
+		
+		for layer in reversed(self.layers):
+			if name in layer.names:
+				return layer.names[name]
+			if layer.modal:
+				return False
+		return False
+	
+	def all(self, name = None):
+		""" Every box with a given name, on any layer """
+		
+		return [box for layer in self.layers for box in layer.boxes if box['name'] == name]
+	
+	def boxes(self):
+		""" Every box on the bottom layer """
+		
+		return list(self.layers[0].boxes)
+
+# Transitions that update() can play, by name
+TRANSITIONS = {
+	'slide_left'	: gfxData.drawSlideLeft,
+	'slide_right'	: gfxData.drawSlideRight,
+	'fade'		: gfxData.drawFade,
+}
+
+class FlashEffect():
+	""" Highlight a region of the screen for a moment, then put back whatever was there """
+	
+	def __init__(self, window = None, rect = None, duration = 0.2):
+		self.window = window
+		self.rect = rect
+		self.duration = duration
+		self.end = None
+		
+		pixel_format = window.backbuffer.contents.format.contents
+		self.saved = SDL_CreateRGBSurfaceWithFormat(0, rect.w, rect.h, pixel_format.BitsPerPixel, pixel_format.format)
+	
+	def start(self, now):
+		""" Keep a copy of the region, then highlight it """
+		
+		SDL_BlitSurface(self.window.backbuffer, self.rect, self.saved, None)
+		SDL_FillRect(self.window.backbuffer, self.rect, self.window.highlight_colour)
+		self.window.markDirty(self.rect)
+		self.end = now + self.duration
+	
+	def step(self, now):
+		""" Returns True once the effect is over """
+		
+		if now >= self.end:
+			self.finish()
+			return True
+		return False
+	
+	def deadline(self):
+		return self.end
+	
+	def underneath(self, draw = None):
+		""" Call draw() to change the backbuffer beneath the highlight, so that the change is
+		what gets put back once the flash is over """
+		
+		if not self.saved:
+			draw()
+			return
+		SDL_BlitSurface(self.saved, None, self.window.backbuffer, self.rect)
+		draw()
+		SDL_BlitSurface(self.window.backbuffer, self.rect, self.saved, None)
+		SDL_FillRect(self.window.backbuffer, self.rect, self.window.highlight_colour)
+		self.window.markDirty(self.rect)
+	
+	def finish(self):
+		""" Put the region back as it was """
+		
+		if self.saved:
+			SDL_BlitSurface(self.saved, None, self.window.backbuffer, self.rect)
+			self.window.markDirty(self.rect)
+		self.discard()
+	
+	def discard(self):
+		""" Forget the effect without drawing anything, e.g. when the screen it was on has gone """
+		
+		if self.saved:
+			SDL_FreeSurface(self.saved)
+			self.saved = None
+
+class TransitionEffect():
+	""" Animate the whole screen from the old content to the new, one frame each time the timeline
+	is advanced, taking no longer than duration """
+	
+	def __init__(self, window = None, transition = None, duration = 0.25):
+		self.window = window
+		self.transition = transition
+		self.duration = duration
+		self.draw = TRANSITIONS[transition]
+		self.rect = SDL_Rect(0, 0, config.SCREEN_W, config.SCREEN_H)
+		self.begin = None
+		self.end = None
+		self.next_frame = None
+		self.frames = 0
+	
+	def start(self, now):
+		""" Show the first frame """
+		
+		self.begin = now
+		self.end = now + self.duration
+		self.window.playing = self
+		self.drawFrame(now)
+	
+	def drawFrame(self, now):
+		SDL_RenderClear(self.window.renderer)
+		self.draw(self.window, (now - self.begin) / self.duration)
+		SDL_RenderPresent(self.window.renderer)
+		self.frames += 1
+		
+		# A slow frame just means the next one is further along
+		self.next_frame = now + (1.0 / config.TRANSITION_FPS)
+	
+	def step(self, now):
+		""" Draw the next frame if it is due, returns True once the effect is over """
+		
+		if now >= self.end:
+			self.finish()
+			return True
+		if now >= self.next_frame:
+			self.drawFrame(now)
+		return False
+	
+	def deadline(self):
+		return min(self.next_frame, self.end)
+	
+	def finish(self):
+		""" Show the new screen as it is now """
+		
+		SDL_RenderCopy(self.window.renderer, self.window.render_texture, None, None)
+		SDL_RenderPresent(self.window.renderer)
+		logger.debug("Transition [%s] drew %s frames in %.3fs", self.transition, self.frames, time.monotonic() - self.begin)
+		self.discard()
+	
+	def discard(self):
+		""" Stop owning the screen, so that the next update() shows whatever is there """
+		
+		if self.window.playing is self:
+			self.window.playing = None
+
+class Timeline():
+	""" Effects in progress on the backbuffer. The main loop advances them between handling input,
+	so nothing has to sleep while an effect is shown. """
+	
+	def __init__(self):
+		self.effects = []
+	
+	def add(self, effect = None):
+		""" Start an effect, replacing any effect already running on an overlapping region """
+		
+		self.finish(effect.rect)
+		effect.start(time.monotonic())
+		self.effects.append(effect)
+	
+	def advance(self):
+		""" Move every effect on, returning True if any of them changed the screen """
+		
+		now = time.monotonic()
+		changed = False
+		for effect in list(self.effects):
+			if effect.step(now):
+				self.effects.remove(effect)
+				changed = True
+		return changed
+	
+	def busy(self):
+		return len(self.effects) > 0
+	
+	def overlapping(self, rect = None):
+		""" The effects running on any part of rect """
+		
+		return [effect for effect in self.effects if SDL_HasIntersection(effect.rect, rect)]
+	
+	def remaining(self):
+		""" Seconds until the last effect ends, 0 if none are running """
+		
+		if len(self.effects) == 0:
+			return 0
+		return max(0, max(e.deadline() for e in self.effects) - time.monotonic())
+	
+	def next(self):
+		""" Seconds until the next effect needs to be advanced, or None if none are running """
+		
+		if len(self.effects) == 0:
+			return None
+		return max(0, min(e.deadline() for e in self.effects) - time.monotonic())
+	
+	def finish(self, rect = None):
+		""" End any effects overlapping rect (or all of them) straight away """
+		
+		for effect in list(self.effects):
+			if (rect is None) or SDL_HasIntersection(effect.rect, rect):
+				effect.finish()
+				self.effects.remove(effect)
+	
+	def discard(self):
+		""" Drop every effect without drawing anything """
+		
+		for effect in self.effects:
+			effect.discard()
+		self.effects = []
+
+class ScreenSnapshot():
+	""" A copy of the whole backbuffer and the clickable boxes drawn on it, to be put back on screen later """
+	
+	def __init__(self, window = None, signature = None):
+		pixel_format = window.backbuffer.contents.format.contents
+		self.surface = SDL_CreateRGBSurfaceWithFormat(0, config.SCREEN_W, config.SCREEN_H, pixel_format.BitsPerPixel, pixel_format.format)
+		copyPixels(window.backbuffer, self.surface)
+		self.boxes = [dict(box) for box in window.hits.boxes()]
+		
+		# Whatever the caller needs to tell if the snapshot is out of date
+		self.signature = signature
+	
+	def bytes(self):
+		return surfaceSize(self.surface)
+	
+	def free(self):
+		SDL_FreeSurface(self.surface)
+		self.surface = None
+
+def copyPixels(source, target):
+	""" Copy the pixels of one surface to another of the same size and format """
+	
+	ctypes.memmove(target.contents.pixels, source.contents.pixels, surfaceSize(source))
+
 class GarbageCleaner():
 	""" Capture and clean up sdl surfaces, textures and images """
 	
@@ -302,41 +953,69 @@ def gfxClose():
 def gfxLoadBMP(window = None, filename = None):
 	""" Load a bitmap file from disk, or from an already cached surface object """
 	
-	if filename in window.cachedSurfaces.keys():
-		#logger.debug("Surface cache hit for bitmap [%s]" % filename)
-		surface = window.cachedSurfaces[filename]
-		
-	else:
+	surface = window.cache.get("image", filename)
+	if surface is None:
 		#logger.debug("Loading bitmap from disk [%s]" % filename)
 		surface = SDL_LoadBMP(str.encode(filename))
-		window.cachedSurfaces[filename] = surface
+		if surface:
+			window.cache.put("image", filename, surface, surfaceSize(surface))
+		else:
+			logger.warn("Unable to load bitmap [%s]" % filename)
 	return surface
 
 def gfxGetText(window, font, pt, sdl_colour, colour, text):
 	""" Generate a text surface, or load from an already cached text surface object """
 	
-	k = str(font) + str(pt) + str(colour) + str(text)
-	if k in window.cachedSurfaces.keys():
-		#logger.debug("Surface cache hit for text [%s:%s:%s:%s]" % (font, pt, str(colour), text))
-		surface = window.cachedSurfaces[k]
-	else:
+	k = (fontKey(font), pt, str(colour), text)
+	surface = window.cache.get("text", k)
+	if surface is None:
 		#logger.debug("Generating text surface from string [%s]" % text)
 		surface = TTF_RenderText_Blended(font, str.encode(text), sdl_colour)
-		window.cachedSurfaces[k] = surface
+		if surface:
+			window.cache.put("text", k, surface, surfaceSize(surface))
 	return surface
 
+def gfxGetAtlas(window, font, pt, sdl_colour, colour):
+	""" Return the glyph atlas for a font and colour, building it the first time it is used """
+	
+	k = (fontKey(font), pt, str(colour))
+	atlas = window.cache.get("glyph", k)
+	if atlas is None:
+		atlas = GlyphAtlas(font = font, sdl_colour = sdl_colour)
+		window.cache.put("glyph", k, atlas, atlas.bytes())
+	return atlas
+
+def gfxDrawText(window, font, pt, sdl_colour, colour, text, x, y):
+	""" Draw a frequently changing string onto the backbuffer from a glyph atlas, and return
+	its width and height. Strings with characters not in the atlas are rendered as normal. """
+	
+	atlas = gfxGetAtlas(window, font, pt, sdl_colour, colour)
+	if atlas.covers(text):
+		atlas.draw(window.backbuffer, text, x, y)
+		return atlas.size(text)
+	
+	surface = TTF_RenderText_Blended(font, str.encode(text), sdl_colour)
+	if not surface:
+		return 0, 0
+	w = surface.contents.w
+	h = surface.contents.h
+	SDL_BlitSurface(surface, None, window.backbuffer, SDL_Rect(x, y, w, h))
+	SDL_FreeSurface(surface)
+	return w, h
+
 def gfxGetFont(window, font, pt):
 	""" Load a font from disk, or from an already cached font object """
 	
-	k = str(font) + str(pt)
-	if k in window.cachedFonts.keys():
-		#logger.debug("Font cache hit for font [%s:%s]" % (font, pt))
-		font = window.cachedFonts[k]
-	else:
+	k = (font, pt)
+	font_object = window.cache.get("font", k)
+	if font_object is None:
 		#logger.debug("Loading font from disk [%s]" % font)
-		font = TTF_OpenFont(str.encode(font), pt)
-		window.cachedFonts[k] = font
-	return font
+		font_object = TTF_OpenFont(str.encode(font), pt)
+		if font_object:
+			window.cache.put("font", k, font_object)
+		else:
+			logger.warn("Unable to load font [%s]" % font)
+	return font_object
 	
 
 def gfxSplashScreen(window = None):
@@ -352,6 +1031,8 @@ def gfxSplashScreen(window = None):
 	
 	# Copy texture to display
 	SDL_BlitSurface(image_surface, None, window.backbuffer, None)
+	window.layout = None
+	window.markDirty()
 	
 	# Destroy SDL surface
 	g.cleanUp()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+
+# history.py, an on-disk store of power monitor readings
+# Copyright (C) 2019  John Snowdon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import math
+import mmap
+import os
+import struct
+import threading
+
+from lib import config
+from lib.newlog import newlog
+
+# Set up a logger for this file
+logger = newlog(__file__)
+
+# One reading: timestamp, monitor number, then the six sensor values in the
+# order of collector.READING_FIELDS. Missing values are stored as NaN.
+RECORD = struct.Struct('<dIffffff')
+RECORD_FIELDS = ('time', 'monitor', 'voltage', 'frequency', 'current', 'apparent_power', 'reactive_power', 'real_power')
+SENSOR_FIELDS = RECORD_FIELDS[2:]
+
+# File header: magic, version, record size, capacity (records), total records ever written
+HEADER = struct.Struct('<4sIIIQ')
+MAGIC = b'SRFH'
+VERSION = 1
+
+class HistoryTier():
+	""" A fixed size, memory mapped file of readings at one resolution. New records are only
+	ever written after the newest one; once the file is full they replace the oldest. """
+
+	def __init__(self, path = None, resolution = 1, capacity = 86400):
+		self.path = path
+		self.resolution = resolution
+		self.capacity = capacity
+		size = HEADER.size + (capacity * RECORD.size)
+
+		new = (not os.path.exists(path)) or (os.path.getsize(path) != size)
+		self.f = open(path, 'a+b')
+		self.f.truncate(size)
+		self.mm = mmap.mmap(self.f.fileno(), size)
+
+		if not new:
+			magic, version, record_size, capacity, count = HEADER.unpack_from(self.mm, 0)
+			if (magic != MAGIC) or (version != VERSION) or (record_size != RECORD.size) or (capacity != self.capacity):
+				logger.warn("History file %s is not in the expected format, starting it again" % path)
+				new = True
+		if new:
+			self.count = 0
+			self.writeHeader()
+		else:
+			self.count = HEADER.unpack_from(self.mm, 0)[4]
+		logger.debug("History tier %s holds %s records" % (path, min(self.count, self.capacity)))
+
+	def writeHeader(self):
+		HEADER.pack_into(self.mm, 0, MAGIC, VERSION, RECORD.size, self.capacity, self.count)
+
+	def offset(self, i):
+		""" File position of the i'th record ever written """
+
+		return HEADER.size + ((i % self.capacity) * RECORD.size)
+
+	def oldest(self):
+		""" Index of the oldest record still held """
+
+		return max(0, self.count - self.capacity)
+
+	def append(self, record):
+		""" Write one record (a tuple in RECORD_FIELDS order) after the newest """
+
+		RECORD.pack_into(self.mm, self.offset(self.count), *record)
+		# The record is in place before the count says it exists
+		self.count += 1
+		self.writeHeader()
+
+	def timestamp(self, i):
+		return struct.unpack_from('<d', self.mm, self.offset(i))[0]
+
+	def search(self, timestamp):
+		""" Index of the first record held at or after timestamp """
+
+		low = self.oldest()
+		high = self.count
+		while low < high:
+			mid = (low + high) // 2
+			if self.timestamp(mid) < timestamp:
+				low = mid + 1
+			else:
+				high = mid
+		return low
+
+	def range(self, start = None, end = None, monitor = None):
+		""" Records with start <= timestamp < end, optionally for one monitor only, oldest first """
+
+		if start is None:
+			i = self.oldest()
+		else:
+			i = self.search(start)
+		records = []
+		while i < self.count:
+			record = RECORD.unpack_from(self.mm, self.offset(i))
+			if (end is not None) and (record[0] >= end):
+				break
+			if (monitor is None) or (record[1] == monitor):
+				records.append(record)
+			i += 1
+		return records
+
+	def first(self):
+		""" Timestamp of the oldest record held, or None """
+
+		if self.count == 0:
+			return None
+		return self.timestamp(self.oldest())
+
+	def flush(self):
+		self.mm.flush()
+
+	def close(self):
+		self.mm.flush()
+		self.mm.close()
+		self.f.close()
+
+class Rollup():
+	""" Running average of one monitor's readings over the current period of a tier """
+
+	__slots__ = ('period', 'sums', 'counts')
+
+	def __init__(self, period = None):
+		self.period = period
+		self.sums = [0.0] * len(SENSOR_FIELDS)
+		self.counts = [0] * len(SENSOR_FIELDS)
+
+	def add(self, values):
+		for f, v in enumerate(values):
+			if not math.isnan(v):
+				self.sums[f] += v
+				self.counts[f] += 1
+
+	def means(self):
+		values = []
+		for f in range(0, len(SENSOR_FIELDS)):
+			if self.counts[f]:
+				values.append(self.sums[f] / self.counts[f])
+			else:
+				values.append(math.nan)
+		return values
+
+class HistoryStore():
+	""" Readings from every power monitor, at full resolution and rolled up into coarser tiers """
+
+	def __init__(self, folder = None, tiers = None):
+		if folder is None:
+			folder = config.HISTORY_FOLDER
+		if tiers is None:
+			tiers = config.HISTORY_TIERS
+		if not os.path.exists(folder):
+			os.makedirs(folder)
+
+		self.tiers = []
+		for tier in tiers:
+			path = os.path.join(folder, "power_%s.dat" % tier['name'])
+			self.tiers.append(HistoryTier(path = path, resolution = tier['resolution'], capacity = tier['capacity']))
+
+		# Partial periods of the rolled up tiers, by (tier number, monitor)
+		self.rollups = {}
+		self.restoreRollups()
+
+		# Written by the collector thread, read by the UI or an exporter
+		self.lock = threading.Lock()
+
+	def restoreRollups(self):
+		""" Rebuild the partial periods from the newest full resolution readings, so that the
+		readings taken before a restart still count towards the periods they belong to """
+
+		if (len(self.tiers) < 2) or (self.tiers[0].count == 0):
+			return
+		newest = self.tiers[0].timestamp(self.tiers[0].count - 1)
+
+		for t in range(1, len(self.tiers)):
+			tier = self.tiers[t]
+
+			# A monitor's unfinished period is the newest one, or the one before if it has
+			# been quiet since then
+			start = (int(newest // tier.resolution) - 1) * tier.resolution
+
+			# The newest period already written out for each monitor
+			written = {}
+			for record in tier.range(start = start):
+				written[record[1]] = max(written.get(record[1], -1), int(record[0] // tier.resolution))
+
+			for record in self.tiers[0].range(start = start):
+				monitor = record[1]
+				period = int(record[0] // tier.resolution)
+				if period <= written.get(monitor, -1):
+					continue
+				rollup = self.rollups.get((t, monitor))
+				if (rollup is None) or (rollup.period < period):
+					rollup = Rollup(period = period)
+					self.rollups[(t, monitor)] = rollup
+				rollup.add(record[2:])
+
+		logger.debug("Restored %s partial history periods", len(self.rollups))
+
+	def add(self, timestamp = None, monitor = 0, readings = None):
+		""" Store one reading object (anything with the collector.READING_FIELDS attributes) """
+
+		values = []
+		for field in SENSOR_FIELDS:
+			value = getattr(readings, field, None)
+			if value is None:
+				value = math.nan
+			values.append(value)
+
+		with self.lock:
+			if len(self.tiers) == 0:
+				return
+			self.tiers[0].append((timestamp, monitor, *values))
+
+			# Average into each coarser tier, writing out a period once a reading arrives from the next one
+			for t in range(1, len(self.tiers)):
+				tier = self.tiers[t]
+				period = int(timestamp // tier.resolution)
+				rollup = self.rollups.get((t, monitor))
+				if (rollup is not None) and (rollup.period != period):
+					tier.append((rollup.period * tier.resolution, monitor, *rollup.means()))
+					rollup = None
+				if rollup is None:
+					rollup = Rollup(period = period)
+					self.rollups[(t, monitor)] = rollup
+				rollup.add(values)
+
+	def tierFor(self, start = None, resolution = None):
+		""" The finest tier which is at least as coarse as resolution, and still holds readings from start """
+
+		for tier in self.tiers:
+			if (resolution is not None) and (tier.resolution < resolution):
+				continue
+			# A tier which has never been full still holds everything written to it
+			if (start is None) or (tier.count <= tier.capacity) or (tier.first() <= start):
+				return tier
+		return self.tiers[-1]
+
+	def query(self, start = None, end = None, monitor = None, resolution = None):
+		""" Records (tuples in RECORD_FIELDS order) between start and end, from the most detailed tier that covers them """
+
+		with self.lock:
+			if len(self.tiers) == 0:
+				return []
+			tier = self.tierFor(start = start, resolution = resolution)
+			return tier.range(start = start, end = end, monitor = monitor)
+
+	def flush(self):
+		with self.lock:
+			for tier in self.tiers:
+				tier.flush()
+
+	def close(self):
+		logger.info("Closing power history")
+		with self.lock:
+			for tier in self.tiers:
+				tier.close()
+			self.tiers = []
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+
+# layout.py, load, check and compile the layout of buttons on each page
+# Copyright (C) 2019  John Snowdon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# The layout is config.SCREENS, or a SCREENS entry in config.LAYOUT_FILE - which may be
+# Python (.py), TOML (.toml) or JSON (.json). It is checked once, when loaded, so that a
+# mistyped setting is reported at startup rather than when its button is pressed. The
+# tags in each button's power actions are resolved into a list of sockets at the same
+# time. A layout read from a file is kept in config.LAYOUT_CACHE, and used from there
+# until the file changes.
+
+import json
+import os
+import pickle
+import runpy
+import time
+from collections import namedtuple
+
+from lib import config
+from lib.newlog import newlog
+
+# Set up a logger for this file
+logger = newlog(__file__)
+
+# Change whenever the records below change, so that older snapshots are not used
+LAYOUT_VERSION = 1
+
+# One power command: send action ("ON" or "OFF") to a socket on a remote
+PowerStep = namedtuple('PowerStep', ['remote', 'socket', 'action'])
+
+# A device button. poweron and poweroff are tuples of PowerStep with any tags already
+# resolved, or None if the button doesn't define them. transmit is a tuple of
+# (setting, value) pairs overriding config.TRANSMIT_POLICY, or None.
+ButtonSpec = namedtuple('ButtonSpec', ['page', 'align', 'number', 'text', 'image', 'remote', 'socket', 'tags', 'poweron', 'poweroff', 'transmit'])
+
+# Everything loaded: where from, the buttons in page/column/number order, the page
+# numbers, and a description of each problem found
+Layout = namedtuple('Layout', ['source', 'buttons', 'pages', 'problems'])
+
+# The settings a button may have, and the settings of one of its power actions
+BUTTON_SETTINGS = ['text', 'image', 'remote', 'socket', 'tags', 'poweron', 'poweroff', 'transmit']
+ACTION_SETTINGS = ['remote', 'socket', 'tags', 'action']
+
+# Energenie sockets are numbered 1 - 4 on each remote, 0 is every socket at once
+SOCKETS = range(0, 5)
+
+class LayoutError(Exception):
+	""" The layout could not be read at all """
+	pass
+
+def isInt(value):
+	return isinstance(value, int) and not isinstance(value, bool)
+
+def isTextList(value):
+	return isinstance(value, (list, tuple)) and all(isinstance(t, str) for t in value)
+
+def number(key):
+	""" Page and button numbers are dictionary keys - strings in TOML and JSON """
+
+	if isInt(key):
+		return key
+	if isinstance(key, str) and key.isdigit():
+		return int(key)
+	return None
+
+def checkButton(where = None, settings = None, problems = None):
+	""" Check the settings of one button, adding anything wrong to problems. Returns False if the button can't be used. """
+
+	if not isinstance(settings, dict):
+		problems.append("%s: should be a dictionary of settings" % where)
+		return False
+
+	usable = True
+	for key in settings.keys():
+		if key not in BUTTON_SETTINGS:
+			problems.append("%s: unknown setting '%s'" % (where, key))
+
+	if (not isinstance(settings.get('text'), str)) or (settings.get('text') == ""):
+		problems.append("%s: 'text' must be set" % where)
+		usable = False
+	if not isInt(settings.get('remote')):
+		problems.append("%s: 'remote' must be a number" % where)
+		usable = False
+	if settings.get('socket') not in SOCKETS:
+		problems.append("%s: 'socket' must be 0 - 4" % where)
+		usable = False
+	if not isinstance(settings.get('image'), (str, type(None))):
+		problems.append("%s: 'image' must be a filename" % where)
+	if not isTextList(settings.get('tags', [])):
+		problems.append("%s: 'tags' must be a list of names" % where)
+		usable = False
+
+	for key in ['poweron', 'poweroff']:
+		if not isinstance(settings.get(key, []), (list, tuple, type(None))):
+			problems.append("%s: '%s' must be a list of actions" % (where, key))
+			usable = False
+
+	transmit = settings.get('transmit')
+	if transmit:
+		if not isinstance(transmit, dict):
+			problems.append("%s: 'transmit' must be a dictionary of settings" % where)
+			usable = False
+		else:
+			for key, value in transmit.items():
+				if key not in config.TRANSMIT_POLICY:
+					problems.append("%s: unknown transmit setting '%s'" % (where, key))
+				elif (not isinstance(value, (int, float))) or (value < 0):
+					problems.append("%s: transmit '%s' must be a positive number" % (where, key))
+					usable = False
+
+	return usable
+
+def checkAction(where = None, action = None, problems = None):
+	""" Check one poweron / poweroff entry, adding anything wrong to problems. Returns False if it can't be used. """
+
+	if not isinstance(action, dict):
+		problems.append("%s: should be a dictionary" % where)
+		return False
+
+	usable = True
+	for key in action.keys():
+		if key not in ACTION_SETTINGS:
+			problems.append("%s: unknown setting '%s'" % (where, key))
+	if action.get('action') not in ["ON", "OFF"]:
+		problems.append("%s: 'action' must be \"ON\" or \"OFF\"" % where)
+		usable = False
+	if 'tags' in action:
+		if not isTextList(action['tags']):
+			problems.append("%s: 'tags' must be a list of names" % where)
+			usable = False
+	else:
+		if not isInt(action.get('remote')):
+			problems.append("%s: 'remote' must be a number, or 'tags' set instead" % where)
+			usable = False
+		if action.get('socket') not in SOCKETS:
+			problems.append("%s: 'socket' must be 0 - 4" % where)
+			usable = False
+	return usable
+
+def resolveActions(where = None, settings = None, state = "ON", by_tag = None, problems = None):
+	""" Turn a button's poweron or poweroff list into a tuple of PowerStep, or None if it has none """
+
+	if state == "ON":
+		action_type = 'poweron'
+	else:
+		action_type = 'poweroff'
+
+	actions = settings.get(action_type)
+	if actions is None:
+		return None
+
+	# No power entries defined, just send a power signal to the button's own remote and socket
+	if len(actions) == 0:
+		return (PowerStep(settings['remote'], settings['socket'], state), )
+
+	steps = []
+	for i, action in enumerate(actions):
+		action_where = "%s %s %s" % (where, action_type, i + 1)
+		if not checkAction(where = action_where, action = action, problems = problems):
+			continue
+
+		# Is it a composite/macro action?
+		if 'tags' in action:
+			# All of the devices/buttons (except this one) with this tag
+			for t in action['tags']:
+				if t not in by_tag:
+					problems.append("%s: no button has the tag '%s'" % (action_where, t))
+				for b in by_tag.get(t, []):
+					if b['text'] != settings['text']:
+						steps.append(PowerStep(b['remote'], b['socket'], action['action']))
+		else:
+			steps.append(PowerStep(action['remote'], action['socket'], action['action']))
+	return tuple(steps)
+
+def compileLayout(screens = None, source = "config.SCREENS"):
+	""" Check a SCREENS structure and turn it into a Layout. Buttons which can't be used are left out. """
+
+	problems = []
+	if not isinstance(screens, dict):
+		raise LayoutError("%s: SCREENS should be a dictionary of pages" % source)
+
+	# Pages, then buttons, in the order they appear on screen
+	pages = []
+	usable = []
+	for page_key in screens.keys():
+		page = number(page_key)
+		if page is None:
+			problems.append("page %s: page numbers must be whole numbers" % page_key)
+			continue
+		pages.append((page, page_key))
+	pages.sort()
+
+	for (page, page_key) in pages:
+		for align in ["L", "R"]:
+			try:
+				column = screens[page_key]['BUTTON'][align]
+			except Exception as e:
+				problems.append("page %s: has no %s buttons [%s]" % (page, align, e))
+				continue
+
+			numbered = []
+			for number_key in column.keys():
+				n = number(number_key)
+				if n is None:
+					problems.append("page %s %s %s: button numbers must be whole numbers" % (page, align, number_key))
+					continue
+				numbered.append((n, number_key))
+
+			for (n, number_key) in sorted(numbered):
+				where = "page %s %s %s" % (page, align, n)
+				settings = column[number_key]
+				if isinstance(settings, dict) and settings.get('text'):
+					where = "%s [%s]" % (where, settings['text'])
+				if checkButton(where = where, settings = settings, problems = problems):
+					usable.append((where, page, align, n, settings))
+
+	# Every usable button, by tag
+	by_tag = {}
+	for (where, page, align, n, settings) in usable:
+		for tag in settings.get('tags', []):
+			by_tag.setdefault(tag, []).append(settings)
+
+	buttons = []
+	for (where, page, align, n, settings) in usable:
+		transmit = settings.get('transmit')
+		if transmit:
+			transmit = tuple(sorted((k, v) for (k, v) in transmit.items() if k in config.TRANSMIT_POLICY))
+		else:
+			transmit = None
+
+		buttons.append(ButtonSpec(
+			page = page,
+			align = align,
+			number = n,
+			text = settings['text'],
+			image = settings.get('image'),
+			remote = settings['remote'],
+			socket = settings['socket'],
+			tags = tuple(settings.get('tags', [])),
+			poweron = resolveActions(where = where, settings = settings, state = "ON", by_tag = by_tag, problems = problems),
+			poweroff = resolveActions(where = where, settings = settings, state = "OFF", by_tag = by_tag, problems = problems),
+			transmit = transmit,
+		))
+
+	return Layout(source = source, buttons = tuple(buttons), pages = tuple(p[0] for p in pages), problems = tuple(problems))
+
+def readLayoutFile(path = None):
+	""" Read SCREENS from a Python, TOML or JSON file """
+
+	extension = os.path.splitext(path)[1].lower()
+	try:
+		if extension == ".py":
+			values = runpy.run_path(path)
+		elif extension == ".toml":
+			try:
+				import tomllib
+			except ImportError:
+				# Before Python 3.11
+				import tomli as tomllib
+			with open(path, 'rb') as f:
+				values = tomllib.load(f)
+		elif extension == ".json":
+			with open(path) as f:
+				values = json.load(f)
+		else:
+			raise LayoutError("%s: layout files must end in .py, .toml or .json" % path)
+	except LayoutError:
+		raise
+	except Exception as e:
+		raise LayoutError("%s: unable to read [%s]" % (path, e))
+
+	if 'SCREENS' not in values:
+		raise LayoutError("%s: has no SCREENS" % path)
+	return values['SCREENS']
+
+def snapshotKey(path = None):
+	""" What a snapshot must have been made from to be used - changes whenever the file does, or
+	the transmit settings that buttons are checked against """
+
+	try:
+		s = os.stat(path)
+	except Exception as e:
+		raise LayoutError("%s: unable to read [%s]" % (path, e))
+	return (LAYOUT_VERSION, os.path.abspath(path), s.st_mtime_ns, s.st_size, tuple(sorted(config.TRANSMIT_POLICY.keys())))
+
+def loadSnapshot(path = None, key = None):
+	""" The Layout kept in a snapshot file, if it was made from the same layout file """
+
+	try:
+		with open(path, 'rb') as f:
+			snapshot = pickle.load(f)
+		if snapshot['key'] == key:
+			return snapshot['layout']
+	except FileNotFoundError:
+		pass
+	except Exception as e:
+		logger.warn("Ignoring layout snapshot %s [%s]", path, e)
+	return None
+
+def saveSnapshot(path = None, key = None, layout = None):
+	try:
+		with open(path + ".tmp", 'wb') as f:
+			pickle.dump({'key' : key, 'layout' : layout}, f, protocol = pickle.HIGHEST_PROTOCOL)
+		os.replace(path + ".tmp", path)
+	except Exception as e:
+		logger.warn("Unable to save layout snapshot %s [%s]", path, e)
+
+def loadLayout():
+	""" Load the button layout, from config.LAYOUT_FILE if set or else config.SCREENS, and report any problems with it """
+
+	start = time.monotonic()
+	if config.LAYOUT_FILE:
+		key = snapshotKey(config.LAYOUT_FILE)
+		layout = loadSnapshot(config.LAYOUT_CACHE, key)
+		if layout is None:
+			layout = compileLayout(readLayoutFile(config.LAYOUT_FILE), source = config.LAYOUT_FILE)
+			saveSnapshot(config.LAYOUT_CACHE, key, layout)
+		else:
+			logger.debug("Layout loaded from snapshot %s", config.LAYOUT_CACHE)
+	else:
+		# Already in memory - there's nothing to be gained from a snapshot
+		layout = compileLayout(config.SCREENS)
+
+	for problem in layout.problems:
+		logger.warn("Layout %s - %s", layout.source, problem)
+	logger.info("Loaded %s buttons on %s pages from %s in %.1fms", len(layout.buttons), len(layout.pages), layout.source, (time.monotonic() - start) * 1000)
+
+	return layout
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+# metrics.py, counters and latency histograms for the busy parts of the application
+# Copyright (C) 2019  John Snowdon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Use as follows:
+#
+# from lib import metrics
+#
+# start = metrics.clock()
+# ...
+# metrics.since("frame", start)
+# metrics.count("frames")
+#
+# With config.METRICS off, clock() returns 0 without reading the time and the
+# other calls return straight away.
+#
+
+import json
+import threading
+import time
+
+from lib import config
+from lib.newlog import newlog
+
+# Set up a logger for this file
+logger = newlog(__file__)
+
+# Values are kept in whole microseconds. Below HISTOGRAM_SUB_BUCKETS each value has its own
+# bucket, above it each power of two is split into HISTOGRAM_SUB_BUCKETS / 2 buckets - so
+# a bucket is never more than about 6% wider than the values in it.
+HISTOGRAM_SUB_BUCKETS = 32
+HISTOGRAM_SHIFT = HISTOGRAM_SUB_BUCKETS.bit_length() - 1
+
+# How many powers of two are covered, anything larger goes in the last bucket
+HISTOGRAM_MAX_EXPONENT = 32
+
+class Histogram():
+	""" Counts latencies in log-linear buckets, like an HDR histogram. Recording is a few integer
+	operations and never allocates. Use since() rather than record(), so that it is locked. """
+
+	__slots__ = ('name', 'counts', 'total', 'sum', 'max')
+
+	def __init__(self, name = None):
+		self.name = name
+		self.counts = [0] * ((HISTOGRAM_MAX_EXPONENT + 2) * (HISTOGRAM_SUB_BUCKETS // 2))
+		self.total = 0
+		self.sum = 0
+		self.max = 0
+
+	def record(self, us):
+		""" Add one value, in whole microseconds """
+
+		if us < 0:
+			us = 0
+		exponent = us.bit_length() - HISTOGRAM_SHIFT
+		if exponent <= 0:
+			index = us
+		else:
+			index = (exponent * (HISTOGRAM_SUB_BUCKETS // 2)) + (us >> exponent)
+		if index >= len(self.counts):
+			index = len(self.counts) - 1
+		self.counts[index] += 1
+		self.total += 1
+		self.sum += us
+		if us > self.max:
+			self.max = us
+
+	def bucketValue(self, index):
+		""" The smallest value which lands in a bucket """
+
+		if index < HISTOGRAM_SUB_BUCKETS:
+			return index
+		exponent = (index // (HISTOGRAM_SUB_BUCKETS // 2)) - 1
+		return (index - (exponent * (HISTOGRAM_SUB_BUCKETS // 2))) << exponent
+
+	def percentile(self, p):
+		""" The value, in microseconds, that p percent of the recorded values are no larger than """
+
+		if self.total == 0:
+			return None
+		wanted = max(1, int(self.total * p / 100.0 + 0.5))
+		seen = 0
+		for index, n in enumerate(self.counts):
+			seen += n
+			if seen >= wanted:
+				return min(self.bucketValue(index), self.max)
+		return self.max
+
+	def summary(self):
+		""" Count, mean, percentiles and maximum in milliseconds """
+
+		if self.total == 0:
+			return { 'count' : 0 }
+		return {
+			'count'	: self.total,
+			'mean'	: round(self.sum / self.total / 1000.0, 3),
+			'p50'	: self.percentile(50) / 1000.0,
+			'p90'	: self.percentile(90) / 1000.0,
+			'p99'	: self.percentile(99) / 1000.0,
+			'max'	: self.max / 1000.0,
+		}
+
+# Everything recorded so far, by name. The UI and radio threads both record, and
+# the UI thread reads - so adding to or reading from these holds the lock.
+counters = {}
+histograms = {}
+lock = threading.Lock()
+
+def clock():
+	""" The time to measure a latency from, or 0 when metrics are off """
+
+	if not config.METRICS:
+		return 0
+	return time.monotonic()
+
+def count(name, n = 1):
+	""" Add n to a counter """
+
+	if not config.METRICS:
+		return
+	with lock:
+		counters[name] = counters.get(name, 0) + n
+
+def since(name, start):
+	""" Record the time from start, a value from clock(), until now """
+
+	if (not config.METRICS) or (not start):
+		return
+	us = int((time.monotonic() - start) * 1000000)
+	with lock:
+		h = histograms.get(name)
+		if h is None:
+			h = histograms[name] = Histogram(name)
+		h.record(us)
+
+def histogram(name = None):
+	""" A histogram by name, or None if nothing has been recorded in it """
+
+	return histograms.get(name)
+
+def snapshot():
+	""" All the counters and histogram summaries, as a dict """
+
+	with lock:
+		return {
+			'counters' : dict(counters),
+			'histograms' : dict((name, h.summary()) for name, h in histograms.items()),
+		}
+
+def dump(path = None):
+	""" Write everything recorded so far, including the raw histogram buckets, to a JSON file """
+
+	if path is None:
+		path = config.METRICS_FILE
+	data = snapshot()
+	data['buckets'] = {}
+	with lock:
+		for name, h in histograms.items():
+			data['buckets'][name] = dict((h.bucketValue(i), n) for i, n in enumerate(h.counts) if n)
+	try:
+		with open(path, 'w') as f:
+			json.dump(data, f, indent = 2, sort_keys = True)
+		logger.info("Metrics written to %s", path)
+	except Exception as e:
+		logger.warn("Unable to write metrics to %s [%s]", path, e)
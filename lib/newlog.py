@@ -21,17 +21,189 @@
 # from newlog import newlog
 #
 # logger = newlog(__file__)
-# logger.debug("something")
+# logger.debug("something happened to %s", thing)
 # logger.error("boom!")
 #
+# Pass values as arguments rather than formatting the message with % - then nothing
+# is formatted unless the message is going to be written, and the formatting is
+# done by the logging thread rather than the caller. As the arguments are formatted
+# later, don't pass anything which the caller is about to change.
+#
+# Extra values for structured (LOG_STRUCTURED) output can be added with:
+#
+# logger.info("Power job sent", extra = {'fields' : {'remote' : remote, 'socket' : socket}})
+#
+# A warning or debug message logged over and over, e.g. for every touch event, can be
+# marked as repeating - then it is rate limited (see config.LOG_RATE_BURST):
+#
+# logger.debug("Touch event [%s]", event, extra = {'repeating' : True})
+#
 
 # Standard libraries
+import atexit
+import json
 import logging
+import logging.handlers
 import os
+import queue
+import threading
+import time
 
 # Settings
 from lib import config
 
+class LazyQueueHandler(logging.handlers.QueueHandler):
+	""" Queues log records as they are, leaving all formatting to the logging thread """
+	
+	def prepare(self, record):
+		return record
+
+class RateLimiter(logging.Filter):
+	""" Lets each repeating log call site through at most burst times per interval seconds, counting
+	the rest. Only warnings and below which are marked as repeating are limited. """
+	
+	def __init__(self, burst = 0, interval = 1.0):
+		super(RateLimiter, self).__init__()
+		self.burst = burst
+		self.interval = interval
+		self.lock = threading.Lock()
+		
+		# (pathname, lineno) : [start of the current interval, messages let through, messages dropped, last dropped record]
+		self.sites = {}
+	
+	def filter(self, record):
+		if (not self.burst) or (record.levelno > logging.WARNING) or (not getattr(record, 'repeating', False)):
+			return True
+		
+		key = (record.pathname, record.lineno)
+		now = time.monotonic()
+		with self.lock:
+			site = self.sites.get(key)
+			if (site is None) or ((now - site[0]) >= self.interval):
+				if site is not None and site[2]:
+					record.suppressed = site[2]
+				self.sites[key] = [now, 1, 0, None]
+				return True
+			if site[1] < self.burst:
+				site[1] += 1
+				return True
+			site[2] += 1
+			site[3] = record
+			return False
+	
+	def pending(self):
+		""" The last dropped record of each call site which has dropped any since it was last let
+		through, carrying the count of the others - so that no count goes unreported """
+		
+		records = []
+		with self.lock:
+			for site in self.sites.values():
+				if site[2]:
+					record = site[3]
+					record.suppressed = site[2] - 1
+					records.append(record)
+					site[2] = 0
+					site[3] = None
+		return records
+
+class TextFormatter(logging.Formatter):
+	""" The usual one line of text, with a note of how many similar lines were dropped """
+	
+	def format(self, record):
+		text = super(TextFormatter, self).format(record)
+		suppressed = getattr(record, 'suppressed', 0)
+		if suppressed:
+			text += " [%s similar messages suppressed]" % suppressed
+		return text
+
+class StructuredFormatter(logging.Formatter):
+	""" One JSON object per line, including any 'fields' passed in extra """
+	
+	def format(self, record):
+		entry = {
+			'time'		: record.created,
+			'level'		: record.levelname,
+			'file'		: record.filename,
+			'line'		: record.lineno,
+			'function'	: record.funcName,
+			'thread'	: record.threadName,
+			'message'	: record.getMessage(),
+		}
+		fields = getattr(record, 'fields', None)
+		if fields:
+			entry['fields'] = fields
+		suppressed = getattr(record, 'suppressed', 0)
+		if suppressed:
+			entry['suppressed'] = suppressed
+		if record.exc_info:
+			entry['exception'] = self.formatException(record.exc_info)
+		return json.dumps(entry, default = str)
+
+# Shared by every logger - records are queued by the caller and written out by the listener thread
+log_handler = None
+log_listener = None
+log_limiter = None
+
+def newlogHandler():
+	""" Create the queue, its listener thread and the console (and file) handlers, once """
+	
+	global log_handler
+	global log_listener
+	global log_limiter
+	
+	if log_handler is not None:
+		return log_handler
+	
+	# Set the format of the message
+	# asctime = datetime of the event
+	# levelname = DEBUG/INFO/WARNING/ERROR etc..
+	# filename = the name of the script generating the log
+	# lineno = the line in the script generating the log
+	# funcname = the name of the method or class generating the log
+	# message = the output being displayed
+	if config.LOG_STRUCTURED:
+		format = StructuredFormatter()
+	else:
+		format = TextFormatter('[%(asctime)s][%(filename)20s:%(lineno)4s][%(funcName)16s][%(levelname)8s]: %(message)s')
+	
+	handlers = [logging.StreamHandler()]
+	error = None
+	if config.LOG_FILE:
+		try:
+			handlers.append(logging.FileHandler(config.LOG_FILE))
+		except Exception as e:
+			error = e
+	for h in handlers:
+		h.setFormatter(format)
+	
+	log_queue = queue.SimpleQueue()
+	log_handler = LazyQueueHandler(log_queue)
+	log_limiter = RateLimiter(burst = config.LOG_RATE_BURST, interval = config.LOG_RATE_INTERVAL)
+	log_handler.addFilter(log_limiter)
+	log_listener = logging.handlers.QueueListener(log_queue, *handlers)
+	log_listener.start()
+	
+	# Write out anything still queued when the application exits
+	atexit.register(newlogClose)
+	
+	if error:
+		newlog(__file__).warn("Unable to open log file %s [%s]", config.LOG_FILE, error)
+	
+	return log_handler
+
+def newlogClose():
+	""" Wait for every queued message to be written and stop the logging thread. Call before
+	replacing the process (e.g. os.execl), as that skips the exit handlers. """
+	
+	global log_listener
+	
+	if log_listener is not None:
+		# Write out the messages still being held back, along with how many were dropped
+		for record in log_limiter.pending():
+			log_handler.enqueue(record)
+		log_listener.stop()
+		log_listener = None
+
 def newlog(name, logging_level = None, raven = True):
 	""" Configure a new Python standard logger with sensible values for time, filename etc. """
 	
@@ -52,22 +224,8 @@ def newlog(name, logging_level = None, raven = True):
 			else:
 					logger.setLevel(logging.WARNING)
 	
-	# Set the output to console for now
-	logger.addHandler(logging.StreamHandler())
-	
-	# Set the format of the message
-	# asctime = datetime of the event
-	# levelname = DEBUG/INFO/WARNING/ERROR etc..
-	# filename = the name of the script generating the log
-	# lineno = the line in the script generating the log
-	# funcname = the name of the method or class generating the log
-	# message = the output being displayed
-	format = logging.Formatter('[%(asctime)s][%(filename)20s:%(lineno)4s][%(funcName)16s][%(levelname)8s]: %(message)s')
-
 	# Enable *only* this logger to output, override any existing handler
-	basic_logger = logging.StreamHandler()
-	basic_logger.setFormatter(format)
 	logger.handlers = []
-	logger.addHandler(basic_logger)	
+	logger.addHandler(newlogHandler())
 	
-	return logger
\ No newline at end of file
+	return logger
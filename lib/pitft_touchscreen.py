@@ -22,6 +22,9 @@
 
 from lib.newlog import newlog
 
+# Set up a logger for this file
+logger = newlog(__file__)
+
 try:
     import evdev
 except ImportError:
@@ -33,23 +36,115 @@ except ImportError:
     logger.fatal("")
     raise(ImportError("Evdev package not found."))
 import threading
-try:
-    # python 3.5+
-    import queue
-except ImportError:
-    # python 2.7
-    import Queue as queue
 
-# Set up a logger for this file
-logger = newlog(__file__)
+# Kinds of touch event. A drag only ever produces one pending TOUCH_MOVE, holding
+# the latest position - intermediate positions are not kept.
+TOUCH_DOWN = 1
+TOUCH_MOVE = 2
+TOUCH_UP = 3
+
+# How many unread touch events are kept before the oldest are dropped
+TOUCH_RING_SIZE = 32
+
+
+class TouchEvent(object):
+    """ One touch event - raw device coordinates and the evdev timestamp """
+
+    __slots__ = ('kind', 'x', 'y', 'time')
+
+    def __init__(self, kind=None, x=None, y=None, time=None):
+        self.kind = kind
+        self.x = x
+        self.y = y
+        self.time = time
+
+    def __repr__(self):
+        return "TouchEvent(kind=%s, x=%s, y=%s, time=%s)" % (self.kind, self.x, self.y, self.time)
+
+
+class TouchState(object):
+    """ The state of the touchscreen as built up from evdev events between SYN_REPORTs """
+
+    __slots__ = ('x', 'y', 'touch', 'id', 'down', 'last_x', 'last_y', 'dropping')
+
+    def __init__(self):
+        self.x = None
+        self.y = None
+        self.touch = None
+        self.id = None
+        # Whether we have reported the finger as down
+        self.down = False
+        # Position of the last event reported
+        self.last_x = None
+        self.last_y = None
+        self.dropping = False
+
+    def touching(self):
+        """ Is a finger on the screen? Uses whatever the device reports - BTN_TOUCH, a tracking id, or just a position """
+        if self.touch is not None:
+            return self.touch > 0
+        if self.id is not None:
+            return self.id != -1
+        return self.x is not None
+
+
+class TouchRing(object):
+    """ A fixed number of preallocated touch events, written by the reader thread and read by the UI """
+
+    def __init__(self, size=TOUCH_RING_SIZE):
+        self.size = size
+        self.slots = [TouchEvent() for i in range(size)]
+        self.head = 0
+        self.count = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def push(self, kind, x, y, time):
+        """ Store an event, returning False if it was merged into a move that hasn't been read yet """
+        with self.lock:
+            if (kind == TOUCH_MOVE) and (self.count > 0):
+                last = self.slots[(self.head + self.count - 1) % self.size]
+                if last.kind == TOUCH_MOVE:
+                    last.x = x
+                    last.y = y
+                    last.time = time
+                    return False
+            if self.count == self.size:
+                # Full - lose the oldest event
+                self.head = (self.head + 1) % self.size
+                self.count -= 1
+                self.dropped += 1
+            event = self.slots[(self.head + self.count) % self.size]
+            event.kind = kind
+            event.x = x
+            event.y = y
+            event.time = time
+            self.count += 1
+            return True
+
+    def pop(self):
+        """ Return a copy of the oldest unread event, or None """
+        with self.lock:
+            if self.count == 0:
+                return None
+            event = self.slots[self.head]
+            self.head = (self.head + 1) % self.size
+            self.count -= 1
+            return TouchEvent(event.kind, event.x, event.y, event.time)
+
+    def empty(self):
+        return self.count == 0
+
 
 # Class for handling events from piTFT
 class pitft_touchscreen(threading.Thread):
-    def __init__(self, device_path="/dev/input/touchscreen", grab=False):
+    def __init__(self, device_path="/dev/input/touchscreen", grab=False, wakeup=None):
         super(pitft_touchscreen, self).__init__()
         self.device_path = device_path
         self.grab = grab
-        self.events = queue.Queue()
+        # Optional callable used to tell the main loop that events are waiting
+        self.wakeup = wakeup
+        self.events = TouchRing()
         self.shutdown = threading.Event()
 
     def is_enabled(self):
@@ -60,7 +155,7 @@ class pitft_touchscreen(threading.Thread):
             return True
         except Exception as ex:
             logger.warn("Touchscreen device not found [%s]" % self.device_path)
-            False
+            return False
 
     def run(self):
         thread_process = threading.Thread(target=self.process_device)
@@ -86,59 +181,57 @@ class pitft_touchscreen(threading.Thread):
         finally:
             if device is None:
                 self.shutdown.set()
-             
+
         # Loop for getting evdev events
-        event = {'time': None, 'id': None, 'x': None, 'y': None, 'touch': None}
-        dropping = False
-        while not self.shutdown.is_set():
-            for input_event in device.read_loop():
-                if input_event.type == evdev.ecodes.EV_ABS:
-                    if input_event.code == evdev.ecodes.ABS_X:
-                        event['x'] = input_event.value
-                    elif input_event.code == evdev.ecodes.ABS_Y:
-                        event['y'] = input_event.value
-                    elif input_event.code == evdev.ecodes.ABS_MT_TRACKING_ID:
-                        event['id'] = input_event.value
-                        if input_event.value == -1:
-                            event['x'] = None
-                            event['y'] = None
-                            event['touch'] = None
-                    elif input_event.code == evdev.ecodes.ABS_MT_POSITION_X:
-                        pass
-                    elif input_event.code == evdev.ecodes.ABS_MT_POSITION_Y:
-                        pass
-                elif input_event.type == evdev.ecodes.EV_KEY:
-                    event['touch'] = input_event.value
-                elif input_event.type == evdev.ecodes.SYN_REPORT:
-                    if dropping:
-                        event['x'] = None
-                        event['y'] = None
-                        event['touch'] = None
-                        dropping = False
-                    else:
-                        event['time'] = input_event.timestamp()
-                        self.events.put(event)
-                        e = event
-                        event = {'x': e['x'], 'y': e['y']}
-                        try:
-                            event['id'] = e['id']
-                        except KeyError:
-                            event['id'] = None
-                        try:
-                            event['touch'] = e['touch']
-                        except KeyError:
-                            event['touch'] = None
-                elif input_event.type == evdev.ecodes.SYN_DROPPED:
-                    dropping = True
+        state = TouchState()
+        for input_event in device.read_loop():
+            if self.shutdown.is_set():
+                break
+            if input_event.type == evdev.ecodes.EV_ABS:
+                if input_event.code == evdev.ecodes.ABS_X:
+                    state.x = input_event.value
+                elif input_event.code == evdev.ecodes.ABS_Y:
+                    state.y = input_event.value
+                elif input_event.code == evdev.ecodes.ABS_MT_TRACKING_ID:
+                    state.id = input_event.value
+            elif input_event.type == evdev.ecodes.EV_KEY:
+                state.touch = input_event.value
+            elif input_event.type == evdev.ecodes.SYN_REPORT:
+                if state.dropping:
+                    # Events were lost - wait for the next complete report
+                    state.dropping = False
+                else:
+                    self.report(state, input_event.timestamp())
+            elif input_event.type == evdev.ecodes.SYN_DROPPED:
+                state.dropping = True
         if self.grab:
             device.ungrab()
 
-    def get_event(self):
-        if not self.events.empty():
-            event = self.events.get()
-            yield event
+    def report(self, state, timestamp):
+        """ Turn the touch state at a SYN_REPORT into a down, move or up event, if anything has changed """
+        if state.touching():
+            if not state.down:
+                kind = TOUCH_DOWN
+                state.down = True
+            elif (state.x == state.last_x) and (state.y == state.last_y):
+                return
+            else:
+                kind = TOUCH_MOVE
+        elif state.down:
+            kind = TOUCH_UP
+            state.down = False
         else:
-            yield None
+            return
+        state.last_x = state.x
+        state.last_y = state.y
+
+        # Only wake the main loop for a new event, not one merged into a move it hasn't read yet
+        if self.events.push(kind, state.x, state.y, timestamp) and self.wakeup:
+            self.wakeup()
+
+    def get_event(self):
+        """ Return the oldest unread TouchEvent, or None """
+        return self.events.pop()
 
     def queue_empty(self):
         return self.events.empty()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+# radio.py, send RF power commands from a background thread
+# Copyright (C) 2019  John Snowdon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import queue
+import threading
+
+from lib import metrics
+from lib.newlog import newlog
+from lib.buttons import coalesceSteps, sendSteps
+
+# Set up a logger for this file
+logger = newlog(__file__)
+
+class RadioJob():
+	""" A request to set the power state of the devices behind one button """
+
+	def __init__(self, button = None, state = "ON", input_time = 0):
+		self.button = button
+		self.state = state
+
+		# When the input which asked for this job arrived, from metrics.clock()
+		self.input_time = input_time
+
+		# One of: queued, sending, done, failed
+		self.status = "queued"
+		self.sent = 0
+		self.total = 0
+		self.error = None
+
+class RadioWorker(threading.Thread):
+	""" Owns the radio - sends queued power jobs one at a time, so that the UI thread never waits on a transmission """
+
+	def __init__(self, energenie = None, wakeup = None):
+		super(RadioWorker, self).__init__()
+		self.daemon = True
+		self.energenie = energenie
+
+		# Optional callable used to tell the main loop that a job has changed state
+		self.wakeup = wakeup
+
+		# Held while transmitting, anything else using the radio must take it too
+		self.lock = threading.Lock()
+
+		self.jobs = queue.Queue()
+		self.results = queue.Queue()
+		self.shutdown = threading.Event()
+
+	def submit(self, button = None, state = "ON", input_time = 0):
+		""" Queue a power job for a button and return straight away """
+
+		job = RadioJob(button = button, state = state, input_time = input_time)
+		self.jobs.put(job)
+		return job
+
+	def batch(self, job):
+		""" Collect this job along with any others already waiting, so they can be sent as one """
+
+		jobs = [job]
+		while True:
+			try:
+				job = self.jobs.get_nowait()
+			except queue.Empty:
+				break
+			if job is None:
+				# Finish this batch, then stop
+				self.shutdown.set()
+				break
+			jobs.append(job)
+		return jobs
+
+	def run(self):
+		while not self.shutdown.is_set():
+			job = self.jobs.get()
+			if job is None:
+				break
+
+			jobs = self.batch(job)
+			steps = []
+			for job in jobs:
+				job.status = "sending"
+				self.report(job)
+				steps += job.button.plans[job.state]
+			if len(jobs) > 1:
+				logger.info("Sending %s queued power jobs together", len(jobs))
+
+			# Merge the plans, so that a socket shared between jobs is only sent its final state
+			steps = coalesceSteps(steps)
+			try:
+				with self.lock:
+					start = metrics.clock()
+					for job in jobs:
+						metrics.since("input_to_radio", job.input_time)
+					sendSteps(energenie = self.energenie, steps = steps, progress = lambda sent, total: self.progress(jobs, sent, total))
+				for job in jobs:
+					metrics.since("power_job", start)
+				status = "done"
+				error = None
+			except Exception as e:
+				logger.warn("Error while sending power signals")
+				logger.warn(e)
+				status = "failed"
+				error = e
+			for job in jobs:
+				job.status = status
+				job.error = error
+				self.report(job)
+
+	def progress(self, jobs, sent, total):
+		""" Called by sendSteps after each device has been sent its signal """
+
+		for job in jobs:
+			job.sent = sent
+			job.total = total
+			self.report(job)
+
+	def report(self, job):
+		""" Pass a job back to the UI thread """
+
+		self.results.put(job)
+		if self.wakeup:
+			self.wakeup()
+
+	def completed(self):
+		""" Return all of the jobs which have changed state since the last call - used by the UI thread """
+
+		jobs = []
+		while not self.results.empty():
+			try:
+				jobs.append(self.results.get_nowait())
+			except queue.Empty:
+				break
+		return jobs
+
+	def stop(self, timeout = 5.0):
+		""" Send any jobs already queued, and wait up to timeout seconds for the thread to end """
+
+		logger.info("Shutting down radio worker")
+		self.jobs.put(None)
+		self.join(timeout)
+		if self.is_alive():
+			logger.warn("Radio worker still sending after %ss", timeout)
@@ -19,16 +19,16 @@
 import os
 import sys
 import ctypes
-import time
-import datetime
-import psutil
 from sdl2 import *
 from sdl2.sdlttf import *
 
 from lib import config
+from lib import metrics
 from lib.newlog import newlog
 from lib.buttons import getPages, getButtons
-from lib.gfx import GarbageCleaner, gfxLoadBMP, gfxGetText, gfxGetFont
+from lib.gfx import GarbageCleaner, ScreenSnapshot, FlashEffect, gfxLoadBMP, gfxGetText, gfxGetFont, gfxDrawText
+from lib.chart import ScrollingChart
+from lib.sampler import SystemSnapshot
 
 # SDL routines
 import sdl2
@@ -37,19 +37,27 @@ from sdl2 import *
 # Set up a logger for this file
 logger = newlog(__file__)
 
-def renderFlash(window = None, page = None, button_clicked = None, power_mode = "ON", screen = None, energenie = None, graph_mode = None):
+def renderFlash(window = None, page = None, button_clicked = None, power_mode = "ON", screen = None, collector = None, graph_mode = None, graph_metric = None, sampler = None):
 	""" Flash a button on a page """
 	
 	if screen == "page":
 		renderPage(window, page = page, button_clicked = button_clicked, flash = True, power_mode = power_mode)
-	if screen == "status":
-		renderStatus(window, button_clicked = button_clicked, flash = True, power_mode = power_mode)
-	if screen == "monitor":
-		renderPowerMon(window, page = page, button_clicked = button_clicked, flash = True, power_mode = power_mode, energenie = energenie, graph_mode = graph_mode)
+	else:
+		# Status and monitor screens are already on screen, just flash the button on them
+		renderButtonFlash(window, button_clicked)
 	window.update()
 	
 	return True
 
+def renderButtonFlash(window = None, button = None):
+	""" Highlight a button now - the main loop puts it back once the flash has run its course """
+	
+	if (button is None) or (button is False):
+		return False
+	select_rect = SDL_Rect(button['x1'], button['y1'], button['x2'] - button['x1'], button['y2'] - button['y1'])
+	window.timeline.add(FlashEffect(window = window, rect = select_rect, duration = config.BUTTON_FLASH_DELAY * 2))
+	return True
+
 def renderButtonBar(window = None, button_clicked = None, flash = False, power_mode = "ON"):
 	""" Display the navigation / button bar along the bottom of the screen - common to all screens """
 	
@@ -87,7 +95,7 @@ def renderButtonBar(window = None, button_clicked = None, flash = False, power_m
 	button['x2'] = x_pos + btn_back.contents.w
 	button['y1'] = y_pos
 	button['y2'] = y_pos + btn_back.contents.h
-	window.boxes.append(button)
+	window.addBox(button)
 	
 	# Put the power meter button at the bottom
 	x_pos = x_pos + btn_meter.contents.w + x_spacing # previous button, plus an offset
@@ -101,7 +109,7 @@ def renderButtonBar(window = None, button_clicked = None, flash = False, power_m
 	button['x2'] = x_pos + btn_meter.contents.w
 	button['y1'] = y_pos
 	button['y2'] = y_pos + btn_meter.contents.h
-	window.boxes.append(button)
+	window.addBox(button)
 
 	
 	# Splat the config/status buttons at the bottom
@@ -116,7 +124,7 @@ def renderButtonBar(window = None, button_clicked = None, flash = False, power_m
 	button['x2'] = x_pos + btn_config.contents.w
 	button['y1'] = y_pos
 	button['y2'] = y_pos + btn_config.contents.h
-	window.boxes.append(button)
+	window.addBox(button)
 	
 		# Splat the power mode buttons at the bottom
 	x_pos = x_pos + btn_back.contents.w + x_spacing # previous button, plus an offset
@@ -130,7 +138,7 @@ def renderButtonBar(window = None, button_clicked = None, flash = False, power_m
 	button['x2'] = x_pos + btn_power.contents.w
 	button['y1'] = y_pos
 	button['y2'] = y_pos + btn_power.contents.h
-	window.boxes.append(button)
+	window.addBox(button)
 	
 	# Splat the restart buttons at the bottom
 	x_pos = x_pos + btn_restart.contents.w + x_spacing # previous button, plus an offset
@@ -144,7 +152,7 @@ def renderButtonBar(window = None, button_clicked = None, flash = False, power_m
 	button['x2'] = x_pos + btn_restart.contents.w
 	button['y1'] = y_pos
 	button['y2'] = y_pos + btn_restart.contents.h
-	window.boxes.append(button)
+	window.addBox(button)
 	
 	# Splat the forward nav buttons at the bottom
 	x_pos = x_pos + btn_fwd.contents.w + x_spacing # previous button, plus an offset
@@ -159,12 +167,41 @@ def renderButtonBar(window = None, button_clicked = None, flash = False, power_m
 	button['x2'] = x_pos + btn_fwd.contents.w
 	button['y1'] = y_pos
 	button['y2'] = y_pos + btn_fwd.contents.h
-	window.boxes.append(button)
+	window.addBox(button)
 	
 	g.cleanUp()
 	
 	return True
 
+def renderPowerButton(window = None, power_mode = "ON"):
+	""" Redraw just the power mode indicator of an existing button bar """
+	
+	button = window.boxPressedByName(name = "btn_power")
+	if button is False:
+		return False
+	
+	if power_mode == "ON":
+		button['image'] = config.ASSETS['power_on']
+	if power_mode == "OFF":
+		button['image'] = config.ASSETS['power_off']
+	btn_power = gfxLoadBMP(window, button['image'])
+	
+	pow_rect = SDL_Rect(button['x1'], button['y1'], button['x2'] - button['x1'], button['y2'] - button['y1'])
+	window.timeline.finish(pow_rect)
+	SDL_FillRect(window.backbuffer, pow_rect, window.background_colour)
+	SDL_BlitSurface(btn_power, None, window.backbuffer, pow_rect)
+	window.markDirty(pow_rect)
+	
+	return True
+
+def renderClearArea(window = None, rect = None):
+	""" Blank one region of the screen, ready for its contents to be drawn again """
+	
+	SDL_FillRect(window.backbuffer, rect, window.background_colour)
+	window.markDirty(rect)
+	
+	return True
+
 def renderConfirmWindow(window = None, header = None, text = None):
 	""" Show a semi-transparent overlay window with a Yes/No confirmation option """
 	
@@ -179,8 +216,8 @@ def renderConfirmWindow(window = None, header = None, text = None):
 	
 	g = GarbageCleaner()
 	
-	# Remove any existing buttons so that they cannot be clicked
-	window.boxes = []
+	# The popup's buttons go on a layer of their own, hiding the buttons of the page underneath
+	window.pushLayer(rect = SDL_Rect(config.SCREEN_POPUP_X, config.SCREEN_POPUP_Y, config.SCREEN_POPUP_W, config.SCREEN_POPUP_H), modal = True)
 	
 	# We don't call a window.clear() as we want to preserve what is shown below
 	
@@ -211,6 +248,10 @@ def renderConfirmWindow(window = None, header = None, text = None):
 		overlay_rect = SDL_Rect(config.SCREEN_POPUP_X, config.SCREEN_POPUP_Y, overlay_surface.contents.w, overlay_surface.contents.h)
 		SDL_FillRect(overlay_surface, None , 0x00000000) # ARGB format
 		SDL_BlitSurface(overlay_surface, None, window.backbuffer, overlay_rect)
+	
+	# Only the overlay area changes, the page underneath is left as it is
+	window.markDirty(SDL_Rect(config.SCREEN_POPUP_X, config.SCREEN_POPUP_Y, config.SCREEN_POPUP_W + 1, config.SCREEN_POPUP_H + 1))
+	window.layout = ("confirm", header)
 
 	# Print the header in reverse text in the overlay box
 	if header is not None:
@@ -250,7 +291,7 @@ def renderConfirmWindow(window = None, header = None, text = None):
 	button['x2'] = x_pos + btn_confirm.contents.w
 	button['y1'] = y_pos
 	button['y2'] = y_pos + btn_confirm.contents.h
-	window.boxes.append(button)
+	window.addBox(button)
 	
 	# Splat the cancel nav buttons at the bottom of the overlay
 	x_pos = ((x_pos + config.SCREEN_POPUP_W) - btn_cancel.contents.w) - 10
@@ -265,32 +306,38 @@ def renderConfirmWindow(window = None, header = None, text = None):
 	button['x2'] = x_pos + btn_cancel.contents.w
 	button['y1'] = y_pos
 	button['y2'] = y_pos + btn_cancel.contents.h
-	window.boxes.append(button)
-	
-	window.update()
-	time.sleep(0.1)
+	window.addBox(button)
 	
 	if bytes.decode(driver_name) != "RPI":
-		# Redraw on the existing renderer
-		SDL_SetRenderDrawColor(window.renderer, config.HIGHLIGHT_COLOUR['r'], config.HIGHLIGHT_COLOUR['g'], config.HIGHLIGHT_COLOUR['b'], SDL_ALPHA_OPAQUE)
-		SDL_RenderDrawLine(window.renderer, config.SCREEN_POPUP_X, config.SCREEN_POPUP_Y, config.SCREEN_POPUP_X + config.SCREEN_POPUP_W, config.SCREEN_POPUP_Y);
-		SDL_RenderDrawLine(window.renderer, config.SCREEN_POPUP_X, config.SCREEN_POPUP_Y + config.SCREEN_POPUP_H, config.SCREEN_POPUP_X + config.SCREEN_POPUP_W, config.SCREEN_POPUP_Y + config.SCREEN_POPUP_H);
-		SDL_RenderDrawLine(window.renderer, config.SCREEN_POPUP_X, config.SCREEN_POPUP_Y, config.SCREEN_POPUP_X, config.SCREEN_POPUP_Y + config.SCREEN_POPUP_H);
-		SDL_RenderDrawLine(window.renderer, config.SCREEN_POPUP_X + config.SCREEN_POPUP_W, config.SCREEN_POPUP_Y, config.SCREEN_POPUP_X + config.SCREEN_POPUP_W, config.SCREEN_POPUP_Y + config.SCREEN_POPUP_H);
-		window.update(reuse_texture = True)
+		# Draw a border around the overlay. This goes into the backbuffer along with everything
+		# else, as the render texture is kept between redraws.
+		SDL_FillRect(window.backbuffer, SDL_Rect(config.SCREEN_POPUP_X, config.SCREEN_POPUP_Y, config.SCREEN_POPUP_W + 1, 1), window.highlight_colour)
+		SDL_FillRect(window.backbuffer, SDL_Rect(config.SCREEN_POPUP_X, config.SCREEN_POPUP_Y + config.SCREEN_POPUP_H, config.SCREEN_POPUP_W + 1, 1), window.highlight_colour)
+		SDL_FillRect(window.backbuffer, SDL_Rect(config.SCREEN_POPUP_X, config.SCREEN_POPUP_Y, 1, config.SCREEN_POPUP_H + 1), window.highlight_colour)
+		SDL_FillRect(window.backbuffer, SDL_Rect(config.SCREEN_POPUP_X + config.SCREEN_POPUP_W, config.SCREEN_POPUP_Y, 1, config.SCREEN_POPUP_H + 1), window.highlight_colour)
+	
+	window.update()
 	
 	g.cleanUp()
 
-def renderStatus(window = None, button_clicked = None, flash = False, power_mode = "ON"):
+def renderStatus(window = None, button_clicked = None, flash = False, power_mode = "ON", sampler = None):
 	""" Display system info / status """
 	
 	logger.debug("Loading status screen")
 	
 	g = GarbageCleaner()
-	window.clear()
+	layout = ("status", power_mode)
+	
+	if window.layout != layout:
+		window.clear()
 		
-	# Render nav buttons
-	renderButtonBar(window = window, button_clicked = button_clicked, flash = flash, power_mode = power_mode)
+		# Render nav buttons
+		renderButtonBar(window = window, button_clicked = button_clicked, flash = flash, power_mode = power_mode)
+		window.layout = layout
+	else:
+		# Only the information above the button bar changes between redraws
+		bar = window.boxPressedByName(name = "btn_config")
+		renderClearArea(window, SDL_Rect(0, 0, config.SCREEN_W, bar['y1']))
 	
 	# Load font
 	font = gfxGetFont(window, config.FONT_INFO, config.FONT_INFO_PT)
@@ -340,20 +387,15 @@ def renderStatus(window = None, button_clicked = None, flash = False, power_mode
 	SDL_BlitSurface(text_surface, None, window.backbuffer, btn_rect)
 	
 	# Surfaces cached in memory
-	text_cached_surfaces = "Surfaces: %s" % len(window.cachedSurfaces.keys())
-	text_surface = TTF_RenderText_Blended(font, str.encode(text_cached_surfaces), font_colour)
-	g.regS(text_surface)
+	cache_stats = window.cache.stats()
+	text_cached_surfaces = "Surfaces: %s (%s evicted)" % (cache_stats['image']['objects'] + cache_stats['text']['objects'], cache_stats['image']['evictions'] + cache_stats['text']['evictions'])
 	y_pos = y_pos + text_surface.contents.h + 5
-	btn_rect = SDL_Rect(x_pos, y_pos, text_surface.contents.w, text_surface.contents.h)
-	SDL_BlitSurface(text_surface, None, window.backbuffer, btn_rect)
+	w, h = gfxDrawText(window, font, config.FONT_INFO_PT, font_colour, config.FONT_INFO_COLOUR, text_cached_surfaces, x_pos, y_pos)
 	
 	# Fonts open
-	text_cached_fonts = "Open Fonts: %s" % len(window.cachedFonts.keys())
-	text_surface = TTF_RenderText_Blended(font, str.encode(text_cached_fonts), font_colour)
-	g.regS(text_surface)
-	y_pos = y_pos + text_surface.contents.h + 5
-	btn_rect = SDL_Rect(x_pos, y_pos, text_surface.contents.w, text_surface.contents.h)
-	SDL_BlitSurface(text_surface, None, window.backbuffer, btn_rect)
+	text_cached_fonts = "Open Fonts: %s" % cache_stats['font']['objects']
+	y_pos = y_pos + h + 5
+	w, h = gfxDrawText(window, font, config.FONT_INFO_PT, font_colour, config.FONT_INFO_COLOUR, text_cached_fonts, x_pos, y_pos)
 	
 	################################################
 	
@@ -361,66 +403,36 @@ def renderStatus(window = None, button_clicked = None, flash = False, power_mode
 	x_pos = int(config.SCREEN_W / 2) + 5
 	y_pos = 5
 	
-	# IP Address
-	na = psutil.net_if_addrs()['eth0'][0][1]
-	#ns = psutil.net_if_stats()
-	text_ip = "IP: %s" % na
-	text_surface = TTF_RenderText_Blended(font, str.encode(text_ip), font_colour)
-	g.regS(text_surface)
-	btn_rect = SDL_Rect(x_pos, y_pos, text_surface.contents.w, text_surface.contents.h)
-	SDL_BlitSurface(text_surface, None, window.backbuffer, btn_rect)
-	
-	# CPU frequency
-	cpu_speed = int(int(open("/sys/devices/system/cpu/cpu0/cpufreq/scaling_cur_freq").read().split('\n')[0]) / 1000)
-	text_cpu_speed = "CPU Speed: %s MHz" % cpu_speed
-	y_pos = y_pos + text_surface.contents.h + 5
-	btn_rect = SDL_Rect(x_pos, y_pos, text_surface.contents.w, text_surface.contents.h)
-	text_surface = TTF_RenderText_Blended(font, str.encode(text_cpu_speed), font_colour)
-	g.regS(text_surface)
-	SDL_BlitSurface(text_surface, None, window.backbuffer, btn_rect)
-	
-	# CPU load
-	text_cpu = "CPU Load: %3s%%" % int(psutil.cpu_percent(interval = (0.5))) 
-	y_pos = y_pos + text_surface.contents.h + 5
-	btn_rect = SDL_Rect(x_pos, y_pos, text_surface.contents.w, text_surface.contents.h)
-	text_surface = TTF_RenderText_Blended(font, str.encode(text_cpu), font_colour)
-	g.regS(text_surface)
-	SDL_BlitSurface(text_surface, None, window.backbuffer, btn_rect)
-	
-	# CPU temp
-	temp = int(int(open("/sys/class/thermal/thermal_zone0/temp").read()) / 1000)
-	text_temp = "CPU Temp: %s C" % temp
-	y_pos = y_pos + text_surface.contents.h + 5
-	btn_rect = SDL_Rect(x_pos, y_pos, text_surface.contents.w, text_surface.contents.h)
-	text_surface = TTF_RenderText_Blended(font, str.encode(text_temp), font_colour)
-	g.regS(text_surface)
-	SDL_BlitSurface(text_surface, None, window.backbuffer, btn_rect)
-	
-	# Uptime
-	ts = int(int(time.mktime(datetime.datetime.now().timetuple())) - psutil.boot_time())
-	text_time = "Uptime: %s sec" % ts
-	y_pos = y_pos + text_surface.contents.h + 5
-	btn_rect = SDL_Rect(x_pos, y_pos, text_surface.contents.w, text_surface.contents.h)
-	text_surface = TTF_RenderText_Blended(font, str.encode(text_time), font_colour)
-	g.regS(text_surface)
-	SDL_BlitSurface(text_surface, None, window.backbuffer, btn_rect)
-	
-	# Current RAM use
-	process = psutil.Process(os.getpid())
-	text_memory_size = "Process: %s kbytes" % int(process.memory_info().rss / 1024)
-	y_pos = y_pos + text_surface.contents.h + 5
-	btn_rect = SDL_Rect(x_pos, y_pos, text_surface.contents.w, text_surface.contents.h)
-	text_surface = TTF_RenderText_Blended(font, str.encode(text_memory_size), font_colour)
-	g.regS(text_surface)
-	SDL_BlitSurface(text_surface, None, window.backbuffer, btn_rect)
-	
-	# Number of open files
-	text_files = "Files: %s" % len(psutil.Process(os.getpid()).open_files())
-	y_pos = y_pos + text_surface.contents.h + 5
-	btn_rect = SDL_Rect(x_pos, y_pos, text_surface.contents.w, text_surface.contents.h)
-	text_surface = TTF_RenderText_Blended(font, str.encode(text_files), font_colour)
-	g.regS(text_surface)
-	SDL_BlitSurface(text_surface, None, window.backbuffer, btn_rect)
+	# System information is read in the background by the sampler, we just show the latest values
+	if sampler is not None:
+		system = sampler.snapshot
+	else:
+		system = SystemSnapshot(None, None, None, None, None, None, None)
+	
+	lines = [
+		("IP: %s", system.ip),
+		("CPU Speed: %s MHz", system.cpu_speed),
+		("CPU Load: %3s%%", system.cpu_load),
+		("CPU Temp: %s C", system.cpu_temp),
+		("Uptime: %s sec", system.uptime),
+		("Process: %s kbytes", system.memory),
+		("Files: %s", system.files),
+	]
+	for (text, value) in lines:
+		if value is None:
+			value = "n/a"
+		w, h = gfxDrawText(window, font, config.FONT_INFO_PT, font_colour, config.FONT_INFO_COLOUR, text % value, x_pos, y_pos)
+		y_pos = y_pos + h + 5
+	
+	# Median and 99th percentile latencies, across both columns
+	if config.METRICS:
+		for (text, name, x_pos) in [("Frame", "frame", 5), ("Tap to RF", "input_to_radio", int(config.SCREEN_W / 2) + 5)]:
+			hist = metrics.histogram(name)
+			if (hist is None) or (hist.total == 0):
+				value = "n/a"
+			else:
+				value = "%.1f/%.1f ms" % (hist.percentile(50) / 1000.0, hist.percentile(99) / 1000.0)
+			gfxDrawText(window, font, config.FONT_INFO_PT, font_colour, config.FONT_INFO_COLOUR, "%s: %s" % (text, value), x_pos, y_pos)
 	
 	# Total clicks
 	# Kernel ver	
@@ -429,22 +441,94 @@ def renderStatus(window = None, button_clicked = None, flash = False, power_mode
 	window.update()
 	return True
 
-def renderPage(window = None, page = 1, button_clicked = None, flash = False, power_mode = "ON"):
-	""" Display a page of clickable buttons """
+def renderDeviceButton(window = None, button = None, x_pos = None, y_pos = None):
+	""" Draw a single device button and return its clickable box """
+	
+	# Is there a bitmap for this button?
+	if button.image and (os.path.exists(config.ASSETS_FOLDER + button.image)):
+		blit_button = gfxLoadBMP(window, config.ASSETS_FOLDER + button.image)
+		btn_rect = SDL_Rect(x_pos, y_pos, blit_button.contents.w, blit_button.contents.h)
+		SDL_FillRect(window.backbuffer, btn_rect, window.background_colour)
+		SDL_BlitSurface(blit_button, None, window.backbuffer, btn_rect)
+	else:
+		# Display default button
+		blit_button = gfxLoadBMP(window, config.ASSETS['btn_default'])
+		btn_rect = SDL_Rect(x_pos, y_pos, blit_button.contents.w, blit_button.contents.h)
+		SDL_FillRect(window.backbuffer, btn_rect, window.background_colour)
+		SDL_BlitSurface(blit_button, None, window.backbuffer, btn_rect)
+		
+		# Display text on button
+		font = gfxGetFont(window, config.FONT_BUTTON, config.FONT_BUTTON_PT)
+		font_colour = pixels.SDL_Color(config.FONT_BUTTON_COLOUR['r'], config.FONT_BUTTON_COLOUR['g'], config.FONT_BUTTON_COLOUR['b'])
+		text_surface = gfxGetText(window, font, config.FONT_BUTTON_PT, font_colour, config.FONT_BUTTON_COLOUR, button.text)
+		text_rect = SDL_Rect(x_pos + int((blit_button.contents.w - text_surface.contents.w) / 2), y_pos + int((blit_button.contents.h - text_surface.contents.h) / 2), text_surface.contents.w, text_surface.contents.h)
+		SDL_BlitSurface(text_surface, None, window.backbuffer, text_rect)
 	
-	logger.debug("Loading page %s" % page)
+	window.markDirty(btn_rect)
 	
-	g = GarbageCleaner()
-	window.clear()
+	# The area of this button, for clicks
+	box = {}
+	box['name'] = "deviceClick"
+	box['button'] = button
+	box['image'] = button.image
+	box['text'] = button.text
+	box['x1'] = x_pos
+	box['x2'] = x_pos + blit_button.contents.w
+	box['y1'] = y_pos
+	box['y2'] = y_pos + blit_button.contents.h
+	
+	return box
+
+def renderRadioJob(window = None, job = None):
+	""" Show the progress of a radio job on the button which started it, if that button is on screen """
+	
+	if (window.layout is None) or (window.layout[0] != "page"):
+		return False
+	boxes = [b for b in window.hits.all("deviceClick") if b['button'] is job.button]
+	if len(boxes) == 0:
+		return False
+	button = boxes[0]
+	
+	# A flash on the button would put back what was there before, so draw beneath it instead
+	btn_rect = SDL_Rect(button['x1'], button['y1'], button['x2'] - button['x1'], button['y2'] - button['y1'])
+	flashes = [e for e in window.timeline.overlapping(btn_rect) if isinstance(e, FlashEffect)]
+	if len(flashes) > 0:
+		flashes[0].underneath(lambda: renderRadioJobBar(window, job = job, button = button))
+	else:
+		renderRadioJobBar(window, job = job, button = button)
+	
+	return True
+
+def renderRadioJobBar(window = None, job = None, button = None):
+	""" Draw the state of a radio job along the bottom of its button """
+	
+	w = button['x2'] - button['x1']
+	bar_rect = SDL_Rect(button['x1'], button['y2'] - config.RADIO_PROGRESS_H, w, config.RADIO_PROGRESS_H)
+	
+	if job.status == "done":
+		# All sent - put the button back as it was
+		renderDeviceButton(window, button = job.button, x_pos = button['x1'], y_pos = button['y1'])
 		
-	# Render nav buttons
-	renderButtonBar(window = window, button_clicked = button_clicked, flash = flash, power_mode = power_mode)
+	elif job.status == "failed":
+		# Leave a warning bar across the button until it is next redrawn
+		SDL_FillRect(window.backbuffer, bar_rect, window.error_colour)
+		window.markDirty(bar_rect)
+		
+	else:
+		# Still sending - fill in the bar by the fraction of devices done so far
+		SDL_FillRect(window.backbuffer, bar_rect, window.background_colour)
+		if job.total > 0:
+			done_rect = SDL_Rect(bar_rect.x, bar_rect.y, int(w * job.sent / job.total), bar_rect.h)
+			SDL_FillRect(window.backbuffer, done_rect, window.highlight_colour)
+		window.markDirty(bar_rect)
+
+def renderPageButtons(window = None, page = 1, button_clicked = None, flash = False, power_mode = "ON"):
+	""" Draw a page of device buttons, and the button bar, from scratch """
 	
-	btn_surface = gfxLoadBMP(window, config.ASSETS['btn_default'])
+	window.clear()
 	
-	# Load font
-	font = gfxGetFont(window, config.FONT_BUTTON, config.FONT_BUTTON_PT)
-	font_colour = pixels.SDL_Color(config.FONT_BUTTON_COLOUR['r'], config.FONT_BUTTON_COLOUR['g'], config.FONT_BUTTON_COLOUR['b'])
+	# Render nav buttons
+	renderButtonBar(window = window, button_clicked = button_clicked, flash = flash, power_mode = power_mode)
 	
 	# Try to load the button configuration for this page
 	y_pos = 0
@@ -455,7 +539,7 @@ def renderPage(window = None, page = 1, button_clicked = None, flash = False, po
 		y_pos = 0
 		buttons = getButtons(page, alignment)
 		for button in buttons:
-			#logger.debug("Button %s.%s.%s:%s" % (page, button['align'], button['number'], button['text']))
+			#logger.debug("Button %s.%s.%s:%s" % (page, button.align, button.number, button.text))
 	
 			# Left
 			if alignment == "L":
@@ -465,175 +549,195 @@ def renderPage(window = None, page = 1, button_clicked = None, flash = False, po
 			if alignment == "R":
 				x_pos = x_right
 				
-			# Is there a bitmap for this button?
-			if button['image'] and (os.path.exists(config.ASSETS_FOLDER + button['image'])):
-				new_btn_surface = gfxLoadBMP(window, config.ASSETS_FOLDER + button['image'])
-				blit_button = new_btn_surface
-				btn_rect = SDL_Rect(x_pos, y_pos, blit_button.contents.w, blit_button.contents.h)
-				SDL_BlitSurface(blit_button, None, window.backbuffer, btn_rect)
-				
-				# Register this button as available on the page for clicks
-				button['name'] = "deviceClick"
-				button['x1'] = x_pos
-				button['x2'] = x_pos + blit_button.contents.w
-				button['y1'] = y_pos
-				button['y2'] = y_pos + blit_button.contents.h
-				window.boxes.append(button)
-			else:
-				# Display default button
-				blit_button = btn_surface
-				btn_rect = SDL_Rect(x_pos, y_pos, blit_button.contents.w, blit_button.contents.h)
-				SDL_BlitSurface(blit_button, None, window.backbuffer, btn_rect)
-				
-				# Register this button as available on the page for clicks
-				button['name'] = "deviceClick"
-				button['x1'] = x_pos
-				button['x2'] = x_pos + blit_button.contents.w
-				button['y1'] = y_pos
-				button['y2'] = y_pos + blit_button.contents.h
-				window.boxes.append(button)
-				
-				# Display text on button
-				text_surface = gfxGetText(window, font, config.FONT_BUTTON_PT, font_colour, config.FONT_BUTTON_COLOUR, button['text'])
-				btn_rect = SDL_Rect(x_pos + int((blit_button.contents.w - text_surface.contents.w) / 2), y_pos + int((blit_button.contents.h - text_surface.contents.h) / 2), text_surface.contents.w, text_surface.contents.h)
-				SDL_BlitSurface(text_surface, None, window.backbuffer, btn_rect)
+			window.addBox(renderDeviceButton(window, button = button, x_pos = x_pos, y_pos = y_pos))
 			
 			y_pos += config.BUTTON_HEIGHT + 5
+	
+	return True
 
-	# Are we flashing a clicked button?
-	if flash and (button_clicked is not None):
-		# Render standard screen
-		logger.info("normal screen")
-		window.update()
-		time.sleep(config.BUTTON_FLASH_DELAY)
-		
-		# Turn clicked button a different colour
-		select_rect = SDL_Rect(button_clicked['x1'], button_clicked['y1'], button_clicked['x2'] - button_clicked['x1'], button_clicked['y2'] - button_clicked['y1'])
-		SDL_FillRect(window.backbuffer, select_rect, window.highlight_colour)
-
-		# Re-render screen
-		logger.info("flash screen")
-		window.update()
-		time.sleep(config.BUTTON_FLASH_DELAY * 2)
-		
-		# Render standard button content again
-		SDL_FillRect(window.backbuffer, select_rect, window.background_colour)
-		
-		# 1. We have an image:
-		if button_clicked['image']:
-			old_btn_surface = gfxLoadBMP(window, config.ASSETS_FOLDER + button_clicked['image'])
-			SDL_BlitSurface(old_btn_surface, None, window.backbuffer, select_rect)
+def fileSignature(files = None):
+	""" Modification times of a list of files, None for any that are missing """
+	
+	signature = []
+	for f in files:
+		try:
+			signature.append(os.stat(f).st_mtime_ns)
+		except OSError:
+			signature.append(None)
+	return tuple(signature)
+
+# Modification times of the font and the images used on every page, read once
+static_signature = None
+
+def pageSignature(page = 1):
+	""" Modification times of every file a page is drawn from - if any of them change, a cached
+	copy of the page is out of date. Only the page's own button images are checked each time. """
+	
+	global static_signature
+	if static_signature is None:
+		static_signature = fileSignature([config.FONT_BUTTON] + list(config.ASSETS.values()))
+	
+	files = []
+	for alignment in ["L", "R"]:
+		for button in getButtons(page, alignment):
+			if button.image:
+				files.append(config.ASSETS_FOLDER + button.image)
+	
+	return static_signature + fileSignature(files)
+
+def renderPage(window = None, page = 1, button_clicked = None, flash = False, power_mode = "ON"):
+	""" Display a page of clickable buttons """
+	
+	logger.debug("Loading page %s", page)
+	
+	g = GarbageCleaner()
+	layout = ("page", page, power_mode)
+	
+	if window.layout == layout:
+		# This page is already on screen, there is nothing to redraw
+		pass
+	
+	elif (window.layout is not None) and (window.layout[:2] == layout[:2]):
+		# Same page, only the power mode has changed
+		renderPowerButton(window, power_mode)
+		window.layout = layout
 		
+	else:
+		signature = pageSignature(page)
+		snapshot = window.cache.get("page", (page, power_mode))
+		if (snapshot is not None) and (snapshot.signature == signature):
+			# This page has been drawn before, and nothing it is drawn from has changed
+			window.restore(snapshot)
+			window.layout = layout
 		else:
-			# 2. We don't have an image - render text again
-			SDL_BlitSurface(btn_surface, None, window.backbuffer, select_rect)
-			text_surface = gfxGetText(window, font, config.FONT_BUTTON_PT, font_colour, config.FONT_BUTTON_COLOUR, button_clicked['text'])
-			btn_rect = SDL_Rect(select_rect.x + int((select_rect.w - text_surface.contents.w) / 2), select_rect.y + int((select_rect.h - text_surface.contents.h) / 2), text_surface.contents.w, text_surface.contents.h)
-			SDL_BlitSurface(text_surface, None, window.backbuffer, btn_rect)
+			renderPageButtons(window = window, page = page, button_clicked = button_clicked, flash = flash, power_mode = power_mode)
+			window.layout = layout
+			
+			# Keep a copy of the finished page for the next time it is shown
+			snapshot = ScreenSnapshot(window = window, signature = signature)
+			window.cache.put("page", (page, power_mode), snapshot, snapshot.bytes())
+
+	# Are we flashing a clicked button?
+	if flash and (button_clicked is not None):
+		renderButtonFlash(window, button_clicked)
 		
-	# 3.
-	logger.info("normal screen")
 	window.update()
 	g.cleanUp()
 	
 	return page
 	
-def renderPowerMon(window = None, page = 1, button_clicked = None, flash = False, power_mode = "ON", energenie = None, graph_mode = None):
+def renderPowerMon(window = None, page = 1, button_clicked = None, flash = False, power_mode = "ON", collector = None, graph_mode = None, graph_metric = None):
 	""" Display a page of power consumption figures """
 	
-	logger.debug("Loading power monitor %s" % page)
+	logger.debug("Loading power monitor %s", page)
 	
 	g = GarbageCleaner()
-	window.clear()
+	if graph_metric not in config.CHART_METRICS:
+		graph_metric = config.CHART_DEFAULT_METRIC
+	layout = ("monitor", graph_mode, graph_metric, power_mode)
+	
+	if window.layout != layout:
+		window.clear()
 
-	# Add the standard button bar
-	renderButtonBar(window = window, button_clicked = button_clicked, flash = flash, power_mode = power_mode)
+		# Add the standard button bar
+		renderButtonBar(window = window, button_clicked = button_clicked, flash = flash, power_mode = power_mode)
 
-	# Add the graph option button bar
-	btn_graph = gfxLoadBMP(window, config.ASSETS['btn_graph'])
-	btn_graph_numbers = gfxLoadBMP(window, config.ASSETS['btn_graph_numbers'])
-	btn_graph_watt = gfxLoadBMP(window, config.ASSETS['btn_graph_watt'])
-	btn_graph_hz = gfxLoadBMP(window, config.ASSETS['btn_graph_hz'])
-	btn_graph_volts = gfxLoadBMP(window, config.ASSETS['btn_graph_volts'])
-	btn_graph_amp = gfxLoadBMP(window, config.ASSETS['btn_graph_amp'])
+		# Add the graph option button bar
+		btn_graph = gfxLoadBMP(window, config.ASSETS['btn_graph'])
+		btn_graph_numbers = gfxLoadBMP(window, config.ASSETS['btn_graph_numbers'])
+		btn_graph_watt = gfxLoadBMP(window, config.ASSETS['btn_graph_watt'])
+		btn_graph_hz = gfxLoadBMP(window, config.ASSETS['btn_graph_hz'])
+		btn_graph_volts = gfxLoadBMP(window, config.ASSETS['btn_graph_volts'])
+		btn_graph_amp = gfxLoadBMP(window, config.ASSETS['btn_graph_amp'])
 
-	# Place the graph option buttons above the main button bar at the bottom
-	x_spacing = 5
-	x_pos = x_spacing
-	y_pos = config.SCREEN_H - (2 * btn_graph_numbers.contents.h) - 2
-	graph_rect = SDL_Rect(x_pos, y_pos, btn_graph_numbers.contents.w, btn_graph_numbers.contents.h)
-	SDL_BlitSurface(btn_graph_numbers, None, window.backbuffer, graph_rect)
-	# Register nav buttons as available on the page for clicks
-	button = {}
-	button['name'] = "btn_graph_numbers"
-	button['image'] =  config.ASSETS['btn_graph_numbers']
-	button['x1'] = x_pos
-	button['x2'] = x_pos + btn_graph_numbers.contents.w
-	button['y1'] = y_pos
-	button['y2'] = y_pos + btn_graph_numbers.contents.h
-	window.boxes.append(button)
-
-	x_pos = x_pos + btn_graph_numbers.contents.w + x_spacing # previous button, plus an offset
-	meter_rect = SDL_Rect(x_pos, y_pos, btn_graph.contents.w, btn_graph.contents.h)
-	SDL_BlitSurface(btn_graph, None, window.backbuffer, meter_rect)
-	button = {}
-	button['name'] = "btn_graph"
-	button['image'] =  config.ASSETS['btn_graph']
-	button['x1'] = x_pos
-	button['x2'] = x_pos + btn_graph.contents.w
-	button['y1'] = y_pos
-	button['y2'] = y_pos + btn_graph.contents.h
-	window.boxes.append(button)
-
-	# Load graph buttons if in graph mode
-	if graph_mode in ["btn_graph"]:
-		x_pos = x_pos + btn_graph.contents.w + x_spacing # previous button, plus an offset
-		meter_rect = SDL_Rect(x_pos, y_pos, btn_graph_volts.contents.w, btn_graph_volts.contents.h)
-		SDL_BlitSurface(btn_graph_volts, None, window.backbuffer, meter_rect)
+		# Place the graph option buttons above the main button bar at the bottom
+		x_spacing = 5
+		x_pos = x_spacing
+		y_pos = config.SCREEN_H - (2 * btn_graph_numbers.contents.h) - 2
+		graph_rect = SDL_Rect(x_pos, y_pos, btn_graph_numbers.contents.w, btn_graph_numbers.contents.h)
+		SDL_BlitSurface(btn_graph_numbers, None, window.backbuffer, graph_rect)
+		# Register nav buttons as available on the page for clicks
 		button = {}
-		button['name'] = "btn_graph_volts"
-		button['image'] =  config.ASSETS['btn_graph_volts']
+		button['name'] = "btn_graph_numbers"
+		button['image'] =  config.ASSETS['btn_graph_numbers']
 		button['x1'] = x_pos
-		button['x2'] = x_pos + btn_graph_volts.contents.w
+		button['x2'] = x_pos + btn_graph_numbers.contents.w
 		button['y1'] = y_pos
-		button['y2'] = y_pos + btn_graph_volts.contents.h
-		window.boxes.append(button)
-		
+		button['y2'] = y_pos + btn_graph_numbers.contents.h
+		window.addBox(button)
+
 		x_pos = x_pos + btn_graph_numbers.contents.w + x_spacing # previous button, plus an offset
-		meter_rect = SDL_Rect(x_pos, y_pos, btn_graph_hz.contents.w, btn_graph_hz.contents.h)
-		SDL_BlitSurface(btn_graph_hz, None, window.backbuffer, meter_rect)
+		meter_rect = SDL_Rect(x_pos, y_pos, btn_graph.contents.w, btn_graph.contents.h)
+		SDL_BlitSurface(btn_graph, None, window.backbuffer, meter_rect)
 		button = {}
-		button['name'] = "btn_graph_hz"
-		button['image'] =  config.ASSETS['btn_graph_hz']
+		button['name'] = "btn_graph"
+		button['image'] =  config.ASSETS['btn_graph']
 		button['x1'] = x_pos
-		button['x2'] = x_pos + btn_graph_hz.contents.w
+		button['x2'] = x_pos + btn_graph.contents.w
 		button['y1'] = y_pos
-		button['y2'] = y_pos + btn_graph_hz.contents.h
-		window.boxes.append(button)
+		button['y2'] = y_pos + btn_graph.contents.h
+		window.addBox(button)
+
+		# Load graph buttons if in graph mode
+		if graph_mode in ["btn_graph"]:
+			x_pos = x_pos + btn_graph.contents.w + x_spacing # previous button, plus an offset
+			meter_rect = SDL_Rect(x_pos, y_pos, btn_graph_volts.contents.w, btn_graph_volts.contents.h)
+			SDL_BlitSurface(btn_graph_volts, None, window.backbuffer, meter_rect)
+			button = {}
+			button['name'] = "btn_graph_volts"
+			button['image'] =  config.ASSETS['btn_graph_volts']
+			button['x1'] = x_pos
+			button['x2'] = x_pos + btn_graph_volts.contents.w
+			button['y1'] = y_pos
+			button['y2'] = y_pos + btn_graph_volts.contents.h
+			window.addBox(button)
 		
-		x_pos = x_pos + btn_graph_hz.contents.w + x_spacing # previous button, plus an offset
-		meter_rect = SDL_Rect(x_pos, y_pos, btn_graph_amp.contents.w, btn_graph_amp.contents.h)
-		SDL_BlitSurface(btn_graph_amp, None, window.backbuffer, meter_rect)
-		button = {}
-		button['name'] = "btn_graph_amp"
-		button['image'] =  config.ASSETS['btn_graph_amp']
-		button['x1'] = x_pos
-		button['x2'] = x_pos + btn_graph_amp.contents.w
-		button['y1'] = y_pos
-		button['y2'] = y_pos + btn_graph_amp.contents.h
-		window.boxes.append(button)
+			x_pos = x_pos + btn_graph_numbers.contents.w + x_spacing # previous button, plus an offset
+			meter_rect = SDL_Rect(x_pos, y_pos, btn_graph_hz.contents.w, btn_graph_hz.contents.h)
+			SDL_BlitSurface(btn_graph_hz, None, window.backbuffer, meter_rect)
+			button = {}
+			button['name'] = "btn_graph_hz"
+			button['image'] =  config.ASSETS['btn_graph_hz']
+			button['x1'] = x_pos
+			button['x2'] = x_pos + btn_graph_hz.contents.w
+			button['y1'] = y_pos
+			button['y2'] = y_pos + btn_graph_hz.contents.h
+			window.addBox(button)
 		
-		x_pos = x_pos + btn_graph_amp.contents.w + x_spacing # previous button, plus an offset
-		meter_rect = SDL_Rect(x_pos, y_pos, btn_graph_watt.contents.w, btn_graph_watt.contents.h)
-		SDL_BlitSurface(btn_graph_watt, None, window.backbuffer, meter_rect)
-		button = {}
-		button['name'] = "btn_graph_watt"
-		button['image'] =  config.ASSETS['btn_graph_watt']
-		button['x1'] = x_pos
-		button['x2'] = x_pos + btn_graph_watt.contents.w
-		button['y1'] = y_pos
-		button['y2'] = y_pos + btn_graph_watt.contents.h
-		window.boxes.append(button)
+			x_pos = x_pos + btn_graph_hz.contents.w + x_spacing # previous button, plus an offset
+			meter_rect = SDL_Rect(x_pos, y_pos, btn_graph_amp.contents.w, btn_graph_amp.contents.h)
+			SDL_BlitSurface(btn_graph_amp, None, window.backbuffer, meter_rect)
+			button = {}
+			button['name'] = "btn_graph_amp"
+			button['image'] =  config.ASSETS['btn_graph_amp']
+			button['x1'] = x_pos
+			button['x2'] = x_pos + btn_graph_amp.contents.w
+			button['y1'] = y_pos
+			button['y2'] = y_pos + btn_graph_amp.contents.h
+			window.addBox(button)
+		
+			x_pos = x_pos + btn_graph_amp.contents.w + x_spacing # previous button, plus an offset
+			meter_rect = SDL_Rect(x_pos, y_pos, btn_graph_watt.contents.w, btn_graph_watt.contents.h)
+			SDL_BlitSurface(btn_graph_watt, None, window.backbuffer, meter_rect)
+			button = {}
+			button['name'] = "btn_graph_watt"
+			button['image'] =  config.ASSETS['btn_graph_watt']
+			button['x1'] = x_pos
+			button['x2'] = x_pos + btn_graph_watt.contents.w
+			button['y1'] = y_pos
+			button['y2'] = y_pos + btn_graph_watt.contents.h
+			window.addBox(button)
+			
+			# The chart fills the space above the graph option buttons, below a line for its legend
+			metric = config.CHART_METRICS[graph_metric]
+			chart_rect = SDL_Rect(5, 25, config.SCREEN_W - 10, y_pos - 30)
+			window.chart = ScrollingChart(window, rect = chart_rect, field = metric['field'], low = metric['min'], high = metric['max'])
+		
+		window.layout = layout
+	elif graph_mode not in ["btn_graph"]:
+		# Only the readings above the graph option buttons change between redraws
+		bar = window.boxPressedByName(name = "btn_graph_numbers")
+		renderClearArea(window, SDL_Rect(0, 0, config.SCREEN_W, bar['y1']))
 
 	# Load font
 	font = gfxGetFont(window, config.FONT_MONITOR, config.FONT_MONITOR_PT)
@@ -711,25 +815,25 @@ def renderPowerMon(window = None, page = 1, button_clicked = None, flash = False
 		x_col2 = x_col1 + col_width
 		x_col3 = x_col2 + col_width
 		x_col4 = x_col3 + col_width
-		logger.debug("Column 1 starts at %s" % x_col1)
+		logger.debug("Column 1 starts at %s", x_col1, extra = {'repeating' : True})
 		y = 5
 		text_surface = gfxGetText(window, font, config.FONT_MONITOR_PT, font_colour, config.FONT_MONITOR_COLOUR, "A")
 		text_rect = SDL_Rect(x_col1, y, text_surface.contents.w, text_surface.contents.h)
 		SDL_BlitSurface(text_surface, None, window.backbuffer, text_rect)
 		
-		logger.debug("Column 2 starts at %s" % x_col2)
+		logger.debug("Column 2 starts at %s", x_col2, extra = {'repeating' : True})
 		y = 5
 		text_surface = gfxGetText(window, font, config.FONT_MONITOR_PT, font_colour, config.FONT_MONITOR_COLOUR, "B")
 		text_rect = SDL_Rect(x_col2, y, text_surface.contents.w, text_surface.contents.h)
 		SDL_BlitSurface(text_surface, None, window.backbuffer, text_rect)
 	
-		logger.debug("Column 3 starts at %s" % x_col3)
+		logger.debug("Column 3 starts at %s", x_col3, extra = {'repeating' : True})
 		y = 5
 		text_surface = gfxGetText(window, font, config.FONT_MONITOR_PT, font_colour, config.FONT_MONITOR_COLOUR, "C")
 		text_rect = SDL_Rect(x_col3, y, text_surface.contents.w, text_surface.contents.h)
 		SDL_BlitSurface(text_surface, None, window.backbuffer, text_rect)
 	
-		logger.debug("Column 4 starts at %s" % x_col4)
+		logger.debug("Column 4 starts at %s", x_col4, extra = {'repeating' : True})
 		y = 5
 		text_surface = gfxGetText(window, font, config.FONT_MONITOR_PT, font_colour, config.FONT_MONITOR_COLOUR, "D")
 		text_rect = SDL_Rect(x_col4, y, text_surface.contents.w, text_surface.contents.h)
@@ -743,10 +847,14 @@ def renderPowerMon(window = None, page = 1, button_clicked = None, flash = False
 		##########################################
 		
 		x_col = x_col1
-		if (energenie is not None) and ("monitors" in energenie.keys()):
-			for power_monitor in energenie['monitors']:
+		if collector is not None:
+			for power in collector.latest():
+				
+				if power is None:
+					# Nothing heard from this monitor yet
+					x_col += col_width
+					continue
 				
-				power = power_monitor.get_readings()
 				if power.voltage != None:
 					voltage = "%sv" % power.voltage
 				else:
@@ -774,21 +882,38 @@ def renderPowerMon(window = None, page = 1, button_clicked = None, flash = False
 				
 				for sensor in [voltage, frequency, current, apparent_power, reactive_power, real_power]:
 				
-					text_value_surface = TTF_RenderText_Blended(font_s, str.encode(str(sensor)), font_colour)
-					g.regS(text_value_surface)
-					text_value_rect = SDL_Rect(x_col, y, text_value_surface.contents.w, text_value_surface.contents.h)
-					SDL_BlitSurface(text_value_surface, None, window.backbuffer, text_value_rect)
+					gfxDrawText(window, font_s, config.FONT_MONITOR_PT, font_colour, config.FONT_MONITOR_COLOUR, str(sensor), x_col, y)
 					
 					y = y + text_sensor_surface.contents.h + 5
 		
 				x_col += col_width
 			
-	#elif graph is "":
-	#	pass
+	elif graph_mode in ["btn_graph"]:
+		
+		#######################################
+		#
+		# Scrolling chart of one metric for
+		# each sensor monitor device
+		#
+		#######################################
+		
+		if window.chart.last_column is None:
+			# New chart - label it with the metric, its range and a key to the colour of each monitor
+			metric = config.CHART_METRICS[graph_metric]
+			label = "%s %s - %s" % (metric['text'], metric['min'], metric['max'])
+			text_surface = gfxGetText(window, font_s, config.FONT_MONITOR_PT, font_colour, config.FONT_MONITOR_COLOUR, label)
+			x = 5
+			SDL_BlitSurface(text_surface, None, window.backbuffer, SDL_Rect(x, 2, text_surface.contents.w, text_surface.contents.h))
+			x = x + text_surface.contents.w + 15
+			for m, name in enumerate(["A", "B", "C", "D"]):
+				c = config.CHART_COLOURS[m % len(config.CHART_COLOURS)]
+				text_surface = gfxGetText(window, font_s, config.FONT_MONITOR_PT, pixels.SDL_Color(c['r'], c['g'], c['b']), c, name)
+				SDL_BlitSurface(text_surface, None, window.backbuffer, SDL_Rect(x, 2, text_surface.contents.w, text_surface.contents.h))
+				x = x + text_surface.contents.w + 10
+		
+		window.chart.draw(collector)
 
 	window.update()
 	g.cleanUp()
 	
-	time.sleep(0.25)
-	
 	return True
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+# replay.py, record the input to the main loop and play it back again
+# Copyright (C) 2019  John Snowdon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import ctypes
+import struct
+import threading
+import time
+
+from lib.newlog import newlog
+from lib.pitft_touchscreen import TouchRing, TOUCH_UP
+
+# SDL routines
+from sdl2 import *
+
+# Set up a logger for this file
+logger = newlog(__file__)
+
+# File header: magic, version
+HEADER = struct.Struct('<4sI')
+MAGIC = b'SRFI'
+VERSION = 1
+
+# One input event: seconds since recording started, source, event type, then up to
+# three signed and one unsigned value whose meaning depends on the type
+RECORD = struct.Struct('<dBIiiiI')
+SOURCE_SDL = 0
+SOURCE_TOUCH = 1
+
+# Finger positions are fractions of the screen, stored as integers
+FINGER_SCALE = 1000000
+
+# Input which can complete an action - used to measure how long the action then takes
+ACTION_EVENTS = [(SOURCE_SDL, SDL_KEYDOWN), (SOURCE_SDL, SDL_MOUSEBUTTONUP), (SOURCE_SDL, SDL_FINGERUP), (SOURCE_TOUCH, TOUCH_UP)]
+
+def encodeSDL(event):
+	""" The (type, a, b, c, d) values of an SDL event, or None if it isn't one we record """
+
+	t = event.type
+	if t == SDL_KEYDOWN:
+		return (t, event.key.keysym.sym, 0, 0, 0)
+	if t in [SDL_MOUSEBUTTONDOWN, SDL_MOUSEBUTTONUP]:
+		return (t, event.button.x, event.button.y, event.button.button, event.button.which)
+	if t == SDL_MOUSEMOTION:
+		return (t, event.motion.x, event.motion.y, event.motion.state, event.motion.which)
+	if t in [SDL_FINGERDOWN, SDL_FINGERMOTION, SDL_FINGERUP]:
+		return (t, int(event.tfinger.x * FINGER_SCALE), int(event.tfinger.y * FINGER_SCALE), event.tfinger.fingerId & 0x7FFFFFFF, 0)
+	if t == SDL_QUIT:
+		return (t, 0, 0, 0, 0)
+	return None
+
+def decodeSDL(t, a, b, c, d):
+	""" Build an SDL event from recorded values """
+
+	event = SDL_Event()
+	event.type = t
+	if t == SDL_KEYDOWN:
+		event.key.keysym.sym = a
+	elif t in [SDL_MOUSEBUTTONDOWN, SDL_MOUSEBUTTONUP]:
+		event.button.x = a
+		event.button.y = b
+		event.button.button = c
+		event.button.which = d
+	elif t == SDL_MOUSEMOTION:
+		event.motion.x = a
+		event.motion.y = b
+		event.motion.state = c
+		event.motion.which = d
+	elif t in [SDL_FINGERDOWN, SDL_FINGERMOTION, SDL_FINGERUP]:
+		event.tfinger.x = a / FINGER_SCALE
+		event.tfinger.y = b / FINGER_SCALE
+		event.tfinger.fingerId = c
+	return event
+
+class InputRecorder():
+	""" Writes every SDL and touchscreen input event the main loop sees to a file """
+
+	def __init__(self, path = None):
+		self.path = path
+		self.f = open(path, 'wb')
+		self.f.write(HEADER.pack(MAGIC, VERSION))
+		self.start = time.monotonic()
+		self.count = 0
+		logger.info("Recording input to %s" % path)
+
+	def write(self, source, values):
+		self.f.write(RECORD.pack(time.monotonic() - self.start, source, *values))
+		self.count += 1
+
+	def sdl(self, event):
+		""" Record an SDL event, if it is a kind of input """
+
+		values = encodeSDL(event)
+		if values is not None:
+			self.write(SOURCE_SDL, values)
+
+	def touch(self, event):
+		""" Record a TouchEvent from the touchscreen reader, in raw device coordinates """
+
+		self.write(SOURCE_TOUCH, (event.kind, event.x, event.y, 0, 0))
+
+	def close(self):
+		self.f.close()
+		logger.info("Recorded %s input events to %s" % (self.count, self.path))
+
+def loadRecording(path = None):
+	""" Read a recording, returning a list of (time, source, type, a, b, c, d) tuples """
+
+	with open(path, 'rb') as f:
+		data = f.read()
+	magic, version = HEADER.unpack_from(data, 0)
+	if (magic != MAGIC) or (version != VERSION):
+		raise ValueError("%s is not an input recording" % path)
+	records = []
+	for offset in range(HEADER.size, len(data) - RECORD.size + 1, RECORD.size):
+		records.append(RECORD.unpack_from(data, offset))
+	return records
+
+class InputReplayer(threading.Thread):
+	""" Plays a recording back into the main loop at its original pace, or faster. Takes the
+	place of the touchscreen reader, so that recorded touches come back the same way. """
+
+	def __init__(self, path = None, speed = 1.0, wakeup = None):
+		super(InputReplayer, self).__init__()
+		self.daemon = True
+		self.records = loadRecording(path)
+		self.speed = speed
+		self.wakeup = wakeup
+		self.events = TouchRing()
+		self.shutdown = threading.Event()
+
+		# When (time.monotonic()) each input that can complete an action was played
+		self.actions = []
+		logger.info("Replaying %s input events from %s at %sx speed" % (len(self.records), path, speed))
+
+	def run(self):
+		start = time.monotonic()
+		quit_seen = False
+		for (t, source, kind, a, b, c, d) in self.records:
+			delay = start + (t / self.speed) - time.monotonic()
+			if (delay > 0) and self.shutdown.wait(delay):
+				return
+			if source == SOURCE_SDL:
+				SDL_PushEvent(ctypes.byref(decodeSDL(kind, a, b, c, d)))
+				quit_seen = quit_seen or (kind == SDL_QUIT)
+			else:
+				if self.events.push(kind, a, b, time.monotonic()) and self.wakeup:
+					self.wakeup()
+			if (source, kind) in ACTION_EVENTS:
+				self.actions.append(time.monotonic())
+
+		# Give the last actions time to finish, then leave the application
+		if not quit_seen:
+			self.shutdown.wait(1.0)
+			event = SDL_Event()
+			event.type = SDL_QUIT
+			SDL_PushEvent(ctypes.byref(event))
+		logger.info("Replay finished")
+
+	def is_enabled(self):
+		return True
+
+	def get_event(self):
+		""" Return the oldest replayed TouchEvent not yet read, or None """
+		return self.events.pop()
+
+	def queue_empty(self):
+		return self.events.empty()
+
+	def stop(self):
+		self.shutdown.set()
+
+def actionLatencies(actions = None, sends = None):
+	""" Seconds from each input to the first radio transmission that followed it, for the inputs which caused one """
+
+	latencies = []
+	sends = sorted(sends)
+	i = 0
+	for n, action in enumerate(actions):
+		following = None
+		if n + 1 < len(actions):
+			following = actions[n + 1]
+		while (i < len(sends)) and (sends[i] < action):
+			i += 1
+		# Only a transmission before the next input can have been caused by this one
+		if (i < len(sends)) and ((following is None) or (sends[i] < following)):
+			latencies.append(sends[i] - action)
+	return latencies
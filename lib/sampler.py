@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+# sampler.py, gather system information for the status screen in the background
+# Copyright (C) 2019  John Snowdon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import threading
+import time
+from collections import namedtuple
+
+import psutil
+
+from lib import config
+from lib.newlog import newlog
+
+# Set up a logger for this file
+logger = newlog(__file__)
+
+# The metrics shown on the status screen - any of them may be None if it can't be read
+SystemSnapshot = namedtuple('SystemSnapshot', ['ip', 'cpu_speed', 'cpu_load', 'cpu_temp', 'uptime', 'memory', 'files'])
+
+class SystemSampler(threading.Thread):
+	""" Refreshes each system metric at its own interval, publishing the results as a SystemSnapshot """
+
+	def __init__(self):
+		super(SystemSampler, self).__init__()
+		self.daemon = True
+		self.shutdown = threading.Event()
+		self.process = psutil.Process(os.getpid())
+		self.boot_time = psutil.boot_time()
+
+		self.readers = {
+			'ip'		: self.readIP,
+			'cpu_speed'	: self.readCPUSpeed,
+			'cpu_load'	: self.readCPULoad,
+			'cpu_temp'	: self.readCPUTemp,
+			'uptime'	: self.readUptime,
+			'memory'	: self.readMemory,
+			'files'		: self.readFiles,
+		}
+
+		# Metrics which have failed once, so that we only warn about each of them once
+		self.failed = set()
+
+		# The first cpu_percent() call only starts measuring
+		psutil.cpu_percent(interval = None)
+
+		# Take every reading once, so the status screen has something to show straight away
+		self.due = {}
+		values = {}
+		for metric in SystemSnapshot._fields:
+			values[metric] = self.read(metric)
+			self.due[metric] = time.monotonic() + config.SYSTEM_SAMPLE_INTERVALS[metric]
+
+		# Replaced, never modified, so the UI thread can read it without a lock
+		self.snapshot = SystemSnapshot(**values)
+
+	def read(self, metric):
+		""" Take one reading, returning None if it isn't available on this system """
+
+		try:
+			return self.readers[metric]()
+		except Exception as e:
+			if metric not in self.failed:
+				logger.warn("Unable to read system %s [%s]", metric, e, extra = {'repeating' : True})
+				self.failed.add(metric)
+			return None
+
+	def readIP(self):
+		return psutil.net_if_addrs()[config.SYSTEM_NETWORK_INTERFACE][0][1]
+
+	def readCPUSpeed(self):
+		with open("/sys/devices/system/cpu/cpu0/cpufreq/scaling_cur_freq") as f:
+			return int(int(f.read().split('\n')[0]) / 1000)
+
+	def readCPULoad(self):
+		# Load since the previous call, rather than blocking to measure it
+		return int(psutil.cpu_percent(interval = None))
+
+	def readCPUTemp(self):
+		with open("/sys/class/thermal/thermal_zone0/temp") as f:
+			return int(int(f.read()) / 1000)
+
+	def readUptime(self):
+		return int(time.time() - self.boot_time)
+
+	def readMemory(self):
+		return int(self.process.memory_info().rss / 1024)
+
+	def readFiles(self):
+		return len(self.process.open_files())
+
+	def run(self):
+		while not self.shutdown.is_set():
+			now = time.monotonic()
+			changed = {}
+			for metric in SystemSnapshot._fields:
+				if self.due[metric] <= now:
+					changed[metric] = self.read(metric)
+					self.due[metric] = now + config.SYSTEM_SAMPLE_INTERVALS[metric]
+			if changed:
+				self.snapshot = self.snapshot._replace(**changed)
+
+			self.shutdown.wait(max(0, min(self.due.values()) - time.monotonic()))
+
+	def stop(self):
+		logger.info("Shutting down system sampler")
+		self.shutdown.set()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+# scheduler.py, block the main event loop until there is something to do
+# Copyright (C) 2019  John Snowdon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import ctypes
+import math
+import threading
+import time
+
+from lib.newlog import newlog
+
+# SDL routines
+from sdl2 import *
+
+# Set up a logger for this file
+logger = newlog(__file__)
+
+class EventScheduler():
+	""" Waits on SDL input, named timer deadlines and wakeups from other threads """
+
+	def __init__(self):
+
+		# A private SDL event type used as our wakeup channel. SDL_WaitEventTimeout() cannot
+		# select() on a file descriptor, but SDL_PushEvent() is thread safe, so any other thread
+		# (touchscreen, radio) can use it to unblock the main loop.
+		self.event_type = SDL_RegisterEvents(1)
+		if self.event_type == 0xFFFFFFFF:
+			logger.warn("Unable to register a private SDL event type, using SDL_USEREVENT")
+			self.event_type = SDL_USEREVENT
+
+		# Only one wakeup event needs to be queued at a time
+		self.pending = threading.Event()
+
+		# Timers are name : [deadline, interval], interval is None for one-shot timers
+		self.timers = {}
+
+	def wake(self):
+		""" Unblock the main loop - safe to call from any thread """
+
+		if not self.pending.is_set():
+			self.pending.set()
+			event = SDL_Event()
+			event.type = self.event_type
+			SDL_PushEvent(ctypes.byref(event))
+
+	def isWakeup(self, event):
+		""" Is this SDL event one of our own wakeup events? If so, re-arm the wakeup channel """
+
+		if event.type == self.event_type:
+			self.pending.clear()
+			return True
+		return False
+
+	def every(self, name, interval):
+		""" Fire a named timer every interval seconds, starting interval seconds from now """
+
+		self.timers[name] = [time.monotonic() + interval, interval]
+
+	def after(self, name, delay):
+		""" Fire a named timer once, delay seconds from now. Replaces any timer of the same name """
+
+		self.timers[name] = [time.monotonic() + delay, None]
+
+	def cancel(self, name):
+		""" Remove a named timer, if it exists """
+
+		if name in self.timers:
+			del self.timers[name]
+
+	def timeout(self):
+		""" Milliseconds until the next timer deadline, or None if no timers are set """
+
+		if len(self.timers) == 0:
+			return None
+		deadline = min(t[0] for t in self.timers.values())
+		return max(0, int(math.ceil((deadline - time.monotonic()) * 1000)))
+
+	def wait(self, event):
+		""" Block until an SDL event arrives (returns True) or the next timer is due (returns False) """
+
+		timeout = self.timeout()
+		if timeout is None:
+			return bool(SDL_WaitEvent(ctypes.byref(event)))
+		else:
+			return bool(SDL_WaitEventTimeout(ctypes.byref(event), timeout))
+
+	def due(self):
+		""" Return the names of all timers whose deadline has passed, rescheduling any repeating ones """
+
+		now = time.monotonic()
+		fired = []
+		for name in list(self.timers.keys()):
+			deadline, interval = self.timers[name]
+			if deadline <= now:
+				fired.append(name)
+				if interval is None:
+					del self.timers[name]
+				else:
+					# Don't try to catch up on missed intervals, just schedule the next one
+					self.timers[name][0] = max(deadline + interval, now)
+		return fired
@@ -22,19 +22,30 @@ import os
 import sys
 import time
 import timeit
-import ctypes
+import argparse
+import json
 from types import SimpleNamespace
 
 # Locals
 from lib import config
-from lib.newlog import newlog
-from lib.buttons import getAllButtons, getPages, getButtonPower, setButtonPower
+from lib import metrics
+from lib.newlog import newlog, newlogClose
+from lib.buttons import getRegistry, getPages, getButtonPower, compilePlans
+from lib.layout import LayoutError
+from lib.radio import RadioWorker
+from lib.collector import PowerCollector
+from lib.history import HistoryStore
+from lib.sampler import SystemSampler
 from lib.pitft_touchscreen import pitft_touchscreen
+from lib.gestures import GestureRecogniser, POINTER_DOWN, POINTER_MOVE, POINTER_UP, GESTURE_TAP, GESTURE_LONG_PRESS, GESTURE_SWIPE_LEFT, GESTURE_SWIPE_RIGHT
+from lib.scheduler import EventScheduler
+from lib.replay import InputRecorder, InputReplayer, actionLatencies
+from lib.fakeradio import FakeEnergenie
 
 # SDL routines
 from sdl2 import *
 from lib.gfx import gfxInit, gfxClose, gfxSplashScreen
-from lib.render import renderPage, renderStatus, renderConfirmWindow, renderPowerMon, renderFlash
+from lib.render import renderPage, renderStatus, renderConfirmWindow, renderPowerMon, renderFlash, renderRadioJob
 
 # Set up a logger for this file
 logger = newlog(__file__)
@@ -80,15 +91,15 @@ class dummyDevice():
 def load_energenie(elib = False):
 	
 	energenie_monitors = []
-	energenie_buttons = []
+	registry = getRegistry()
+	registry.devices = {}
 	
 	if elib:
 		elib.init()
-		# Load all energenie sockets
-		for b in getAllButtons():
-			b['device'] = elib.Devices.ENER002((b['remote'], b['socket']))
-			energenie_buttons.append(b)
-			logger.debug("Adding device %s.%s" % (str(hex(b['remote'])), b['socket']))
+		# Load all energenie sockets - one device for each remote and socket, however many buttons use it
+		for (remote, socket) in registry.sockets():
+			registry.devices[(remote, socket)] = elib.Devices.ENER002((remote, socket))
+			logger.debug("Adding device %s.%s" % (str(hex(remote)), socket))
 			
 		# Load all energenie power monitor devices
 		for k in config.POWER_MONITORS:
@@ -97,7 +108,7 @@ def load_energenie(elib = False):
 			energenie_monitors.append(d)
 			logger.debug("Adding monitor %s" % (config.POWER_MONITORS[k]['text']))
 			
-		logger.info("Added %s Energenie power socket devices" % len(energenie_buttons))
+		logger.info("Added %s Energenie power socket devices" % len(registry.devices))
 		logger.info("Added %s Energenie power monitor devices" % len(energenie_monitors))
 	else:
 		logger.warn("Energenie radio functions not available")
@@ -112,16 +123,43 @@ def load_energenie(elib = False):
 		
 	energenie = {
 		'lib' : elib,
-		'buttons' : energenie_buttons,
+		'registry' : registry,
 		'monitors' : energenie_monitors,
 	}
 	
+	# Resolve every button's power actions up front, so a click doesn't have to
+	compilePlans(registry)
+	
 	return energenie
 
-def sdlRFController():
+def stopServices(energenie = None, radio = None, ts = None, recorder = None, sampler = None, collector = None, history = None):
+	""" Stop the background threads and close any open files - before exiting, or restarting """
+	
+	# Stop radio, once anything already queued has been sent
+	radio.stop()
+	if energenie['lib']:
+		logger.info("Shutting down energenie library")
+		# Don't pull the library out from under a worker that is still transmitting
+		with radio.lock:
+			energenie['lib'].finished()
+	
+	# Stop touchscreen
+	if ts:
+		logger.info("Shutting down touchscreen library")
+		ts.stop()
+	
+	if recorder:
+		recorder.close()
+	
+	sampler.stop()
+	collector.stop()
+	if history:
+		history.close()
+
+def sdlRFController(record = None, replay = None, speed = 1.0, fake_radio = False, report = None):
 	
 	# SDL only listens for these types of input, all others are ignored
-	sdl_detected_events = [SDL_KEYDOWN, SDL_MOUSEBUTTONDOWN, SDL_FINGERDOWN, SDL_FINGERMOTION, SDL_QUIT]
+	sdl_detected_events = [SDL_KEYDOWN, SDL_MOUSEBUTTONDOWN, SDL_MOUSEBUTTONUP, SDL_MOUSEMOTION, SDL_FINGERDOWN, SDL_FINGERMOTION, SDL_FINGERUP, SDL_QUIT]
 	
 	# Defaults for first page shown
 	running = True
@@ -147,9 +185,15 @@ def sdlRFController():
 	window.clear()
 	window.update()
 	
-	# Try to init touchscreen
+	# Everything that can wake the main loop up goes through the scheduler
+	scheduler = EventScheduler()
+	
+	# Try to init touchscreen - or play back a recording in its place
 	try:
-		ts = pitft_touchscreen()
+		if replay:
+			ts = InputReplayer(replay, speed = speed, wakeup = scheduler.wake)
+		else:
+			ts = pitft_touchscreen(wakeup = scheduler.wake)
 		if ts.is_enabled():
 			logger.info("Touchscreen input enabled")
 			ts.start()
@@ -165,7 +209,46 @@ def sdlRFController():
 	energenie_buttons = []
 	energenie_monitors = []
 	
-	energenie = load_energenie(elib)
+	if fake_radio:
+		lib = FakeEnergenie(send_time = config.FAKE_RADIO_SEND_TIME)
+	else:
+		lib = elib
+	try:
+		energenie = load_energenie(lib)
+	except LayoutError as e:
+		logger.fatal("Unable to load the button layout - Exit")
+		logger.fatal(e)
+		if ts:
+			ts.stop()
+		gfxClose()
+		newlogClose()
+		return 1
+	
+	# All power commands are sent from the radio worker thread
+	radio = RadioWorker(energenie = energenie, wakeup = scheduler.wake)
+	radio.start()
+	
+	# Power monitor readings are kept on disk, so that they survive a restart - but only real
+	# ones, the dummy monitors and the fake radio just make readings up
+	history = None
+	if energenie['lib'] and (energenie['lib'] is elib):
+		try:
+			history = HistoryStore()
+		except Exception as e:
+			logger.warn("Power history not available")
+			logger.warn(e)
+			history = None
+	else:
+		logger.info("Power history not kept, the power monitor readings are not real")
+	
+	# Power monitor broadcasts are received in the background, sharing the radio
+	collector = PowerCollector(energenie = energenie, lock = radio.lock, wakeup = scheduler.wake, history = history)
+	collector.restore()
+	collector.start()
+	
+	# System information for the status screen is also read in the background
+	sampler = SystemSampler()
+	sampler.start()
 	
 	# Show page 1
 	renderPage(window = window, page = page)
@@ -174,10 +257,17 @@ def sdlRFController():
 	# SDL event handler
 	sdl_event = SDL_Event()
 	for t in sdl_detected_events:
-		logger.debug("SDL event type [%s]" % t)
+		logger.debug("SDL event type [%s]", t)
+	
+	# Touchscreen and mouse input, turned into taps, long presses and swipes
+	gestures = GestureRecogniser()
+	gesture = None
 	
-	# TS / Evdev
-	ts_event = False
+	# Keep a copy of every input, so that the session can be replayed later
+	if record:
+		recorder = InputRecorder(record)
+	else:
+		recorder = None
 	
 	# Default switch mode
 	power_mode = "ON"
@@ -187,70 +277,115 @@ def sdlRFController():
 	clicked = False
 	redraw = False
 	loop_count = 0
-	power_count = 0
-	old_button = {'name' : None}
-	old_time = time.time()
-	last_ts = time.time()
 	graph_mode = None
-		
-	# Open up the radio device
-	radio = None
+	graph_metric = config.CHART_DEFAULT_METRIC
 		
 	# Event handler
 	while running:
 		
-		ignore_loop = False
-		power_count += 1
+		# Block until there is SDL input, a wakeup from the touchscreen
+		# or radio threads, or until the next timer is due
+		have_event = scheduler.wait(sdl_event)
+		
+		# Latencies of whatever this input leads to are measured from here
+		input_time = metrics.clock()
+		
+		# Our own wakeup events carry no input - they just get us to look
+		# at the touchscreen queue below
+		if have_event and scheduler.isWakeup(sdl_event):
+			have_event = False
 		
-		# Sleep a minimum amount of time each loop - we don't want to 
-		# peg the cpu at 100% just looping...
-		time.sleep(config.REFRESH_TIME)
+		if have_event:
+			sdl_type = sdl_event.type
+			if sdl_type in sdl_detected_events:
+				metrics.count("input_sdl")
+			if recorder:
+				recorder.sdl(sdl_event)
+		else:
+			sdl_type = None
+		
+		# Only keyboard events carry a valid key symbol
+		if sdl_type == SDL_KEYDOWN:
+			keypress = sdl_event.key.keysym.sym
+		else:
+			keypress = None
 		
-		# Dump any cached surfaces or fonts
-		if loop_count > config.CACHE_CLEAR_TIME:
-			window.clearCache()	
-			loop_count = 0
+		timers = scheduler.due()
 		
-		if power_count > config.POWER_LISTEN_TIME:
-			# Read any broadcast power events and update data
-			if energenie['lib']:
-				try:
-					logger.debug("Get latest broadcast readings")
-					energenie['lib'].loop()
-					for d in energenie['monitors']:
-						try:
-							pwr = d.get_power()
-							logger.debug(pwr)
-						except:
-							logger.debug("No power readings for %s" % d)
-							pass
-				except Exception as e:
-					logger.warn("Error while running Energenie loop")
-					logger.warn(e)
-					logger.warn("Reloading energenie library...")
-					energenie = load_energenie(elib = elib)
-			power_count = 0
+		# Continuously updated screens ask to be redrawn on a timer
+		if "redraw" in timers:
+			redraw = True
 		
-		# Reset any touchscreen event
-		ts_event = False
+		# Move any running effects (button flashes, screen transitions) on
+		if window.timeline.advance():
+			window.update()
 		
-		# Read any available touchscreen events
+		# The collector stops listening if the energenie library fails, until it is reloaded
+		if collector.failed.is_set():
+			logger.warn("Reloading energenie library...")
+			with radio.lock:
+				energenie = load_energenie(elib = lib)
+				radio.energenie = energenie
+			collector.reload(energenie)
+		
+		# Show the progress of any power commands sent by the radio worker
+		jobs = radio.completed()
+		if len(jobs) > 0:
+			for job in jobs:
+				if job.status == "failed":
+					logger.warn("Power %s command failed for [%s]", job.state, job.button.text)
+				renderRadioJob(window, job = job)
+			window.update()
+		
+		# Turn touchscreen input into gestures
 		if ts:
-			while not ts.queue_empty():
-				for e in ts.get_event():
-					ts_event = e
-					logger.debug("Touch event [%s]" % ts_event)
-					# Map x and y coordinates
-					if 'y' in ts_event.keys():
-						if config.TOUCH['axis_reversed']:
-							window.touch_y_raw = ts_event['x']
-						else:
-							window.touch_y_raw = ts_event['y']
-					if 'x' in ts_event.keys():
-						if config.TOUCH['axis_reversed']:
-							window.touch_x_raw = ts_event['y']
-						else:
-							window.touch_x_raw = ts_event['x']
+			e = ts.get_event()
+			while e is not None:
+				logger.debug("Touch event [%s]", e, extra = {'repeating' : True})
+				metrics.count("input_touch")
+				if recorder:
+					recorder.touch(e)
+				# Map x and y coordinates
+				if config.TOUCH['axis_reversed']:
+					window.touch_y_raw = e.x
+					window.touch_x_raw = e.y
+				else:
+					window.touch_y_raw = e.y
+					window.touch_x_raw = e.x
+				window.touchRead(e)
+				gestures.feed(kind = e.kind, x = window.mouse_x.value, y = window.mouse_y.value, timestamp = e.time)
+				e = ts.get_event()
+		
+		# SDL mouse and touch input goes through the same recogniser. Mouse events which SDL
+		# makes up from touches are skipped, as the touches themselves are used.
+		if (sdl_type in [SDL_MOUSEBUTTONDOWN, SDL_MOUSEBUTTONUP]) and (sdl_event.button.which != SDL_TOUCH_MOUSEID):
+			if sdl_type == SDL_MOUSEBUTTONDOWN:
+				kind = POINTER_DOWN
+			else:
+				kind = POINTER_UP
+			gestures.feed(kind = kind, x = sdl_event.button.x, y = sdl_event.button.y, timestamp = sdl_event.button.timestamp / 1000)
+		if (sdl_type == SDL_MOUSEMOTION) and (sdl_event.motion.which != SDL_TOUCH_MOUSEID) and sdl_event.motion.state:
+			gestures.feed(kind = POINTER_MOVE, x = sdl_event.motion.x, y = sdl_event.motion.y, timestamp = sdl_event.motion.timestamp / 1000)
+		if sdl_type in [SDL_FINGERDOWN, SDL_FINGERMOTION, SDL_FINGERUP]:
+			if sdl_type == SDL_FINGERDOWN:
+				kind = POINTER_DOWN
+			elif sdl_type == SDL_FINGERMOTION:
+				kind = POINTER_MOVE
+			else:
+				kind = POINTER_UP
+			gestures.feed(kind = kind, x = int(sdl_event.tfinger.x * config.SCREEN_W), y = int(sdl_event.tfinger.y * config.SCREEN_H), timestamp = sdl_event.tfinger.timestamp / 1000)
+		
+		# Handle one gesture each time round, coming straight back if there are more
+		gesture = gestures.next()
+		if gestures.pending():
+			scheduler.wake()
+		if gesture is not None:
+			metrics.count("gesture_%s" % gesture.kind)
+		
+		# Come back when a finger which is still down has been held long enough to be a long press
+		delay = gestures.deadline()
+		if delay is not None:
+			scheduler.after("gesture", delay)
 		
 		#############################################################
 		#
@@ -258,11 +393,11 @@ def sdlRFController():
 		#
 		#############################################################
 		
-		# Read an SDL event, if there is one, or proceed to process a touchscreen event
-		if (SDL_PollEvent(ctypes.byref(sdl_event))) or (ts_event != False):
+		# Process an SDL event, if there is one, or proceed to process a gesture
+		if have_event or (gesture is not None):
 			loop_count += 1
 			
-			if (sdl_event and (sdl_event.type)) == SDL_QUIT:
+			if sdl_type == SDL_QUIT:
 				################################################
 				#
 				# Handle the quit signal tasks (control-c, close of terminal, window etc)
@@ -272,75 +407,32 @@ def sdlRFController():
 				running = False
 				break				
 				
-			if (sdl_event and (sdl_event.type in sdl_detected_events)) or (ts_event):
+			if (sdl_type in sdl_detected_events) or (gesture is not None):
 				################################################
 				#
-				# Handle keyboard or mouse input
+				# Handle keyboard or touch input
 				#
 				################################################
 				
+				# Only a key or a gesture does anything - other pointer input just builds up gestures
+				button = False
+				clicked = False
+				
 				# SDL Keyboard
-				if (sdl_event and (sdl_event.type == SDL_KEYDOWN)):
+				if sdl_type == SDL_KEYDOWN:
 					logger.debug("SDL Keyboard input")
-					button = False
-					clicked = False
-					
-				# SDL Mouse click
-				if (sdl_event and (sdl_event.type == SDL_MOUSEBUTTONDOWN)):
-					window.mouseRead(sdl_event)
-					button = window.boxPressed()
-					if button:
-						clicked = button['name']
-					else:
-						clicked = False
-					logger.debug("SDL Mouse input [box:%s]" % clicked)
-					
-				# SDL touch 
-				if (sdl_event and (sdl_event.type == SDL_FINGERDOWN)):
-					window.mouseRead(sdl_event)
-					button = window.boxPressed()
-					if button:
-						clicked = button['name']
-					else:
-						clicked = False
-					logger.debug("SDL Touch input [box:%s]" % clicked)
-					
-				# Linux evdev touchscreen
-				if (ts_event):
-					ts_interval = (ts_event['time'] - last_ts)
-					if ts_interval < config.BUTTON_BOUNCE_TIME:
-						logger.debug("Ignoring touchscreen input [%.2fs]" % ts_interval)
-						ts_event = False
-						ignore_loop = True
-					else:
-						ignore_loop = False
-						window.touchRead(ts_event)
+				
+				# Taps and long presses click whatever is under the finger, swipes are handled on their own
+				if gesture is not None:
+					if gesture.kind in [GESTURE_TAP, GESTURE_LONG_PRESS]:
+						window.mouse_x.value = gesture.x
+						window.mouse_y.value = gesture.y
 						button = window.boxPressed()
 						if button:
 							clicked = button['name']
-						else:
-							clicked = False
-						logger.debug("Touchscreen input [box:%s]" % clicked)
-						
-						# Debounce check - only allow multiple clicks to the
-						# same button after a minimum time delay, to reduce 
-						# button bouncing.
-						if (button) and ('name' in button.keys()):
-							if (old_button) and ('name' in old_button.keys()):
-								if button['name'] == old_button['name']:
-									double_click_time = time.time() - old_time
-									if double_click_time < config.BUTTON_BOUNCE_TIME:
-										# Break from loop and do no further processing of this button click
-										logger.warn("Ignoring touchscreen input - possible button bounce [%.2fs < %ss]" % (double_click_time, config.BUTTON_BOUNCE_TIME))
-										ts_event = False
-										ignore_loop = True
-									else:
-										logger.debug("Accepting touchscreen input - long double click [%.2fs]" % double_click_time)
-							
-						if ignore_loop == False:
-							old_button = button
-							old_time = time.time()
-							last_ts = ts_event['time']
+					else:
+						clicked = gesture.kind
+					logger.debug("Gesture input [%s] [box:%s]", gesture.kind, clicked)
 					
 				#############################################################
 				#
@@ -348,119 +440,126 @@ def sdlRFController():
 				#
 				#############################################################
 				
-				if ignore_loop == False:
-					
-					# We clicked on a device button, so send a power signal to that device (and any child devices defined in its' poweron or poweroff fields)
-					if clicked == "deviceClick":
-						# Flash the button to indicate click
-						renderPage(window, page = page, button_clicked = button, flash = True, power_mode = power_mode)
-						
-						# Run the device RF power command
-						logger.info("Calling radio functions for button [%s:%s:%s remote:%s socket:%s]" % (page, button['align'], button['number'], str(hex(button['remote'])), button['socket']))
-						setButtonPower(energenie = energenie, button = button, state = power_mode)
-						redraw = False
+				# We clicked on a device button, so send a power signal to that device (and any child devices defined in its' poweron or poweroff fields)
+				if clicked == "deviceClick":
+					# Flash the button to indicate click
+					renderPage(window, page = page, button_clicked = button, flash = True, power_mode = power_mode)
 					
-					# Show the 'do you want to restart' overlay message
-					if (clicked == "btn_restart"):
-						old_screen = screen
-						renderConfirmWindow(window = window, header = "Application Restart", text = "This will restart the application.\nAre you sure?")
-						screen = "restart"
-						redraw = False
+					# Queue the device RF power command - the radio worker sends it
+					device = button['button']
+					logger.info("Calling radio functions for button [%s:%s:%s remote:%#x socket:%s]", page, device.align, device.number, device.remote, device.socket, extra = {'fields' : {'page' : page, 'button' : device.text, 'remote' : device.remote, 'socket' : device.socket, 'state' : power_mode}})
+					renderRadioJob(window, job = radio.submit(button = device, state = power_mode, input_time = input_time))
+					window.update()
+					redraw = False
+				
+				# Show the 'do you want to restart' overlay message
+				if (clicked == "btn_restart"):
+					old_screen = screen
+					renderConfirmWindow(window = window, header = "Application Restart", text = "This will restart the application.\nAre you sure?")
+					screen = "restart"
+					redraw = False
+				
+				# Restart application
+				if (screen == "restart") and (clicked == "btn_confirm"):
+					logger.info("Restarting application")
+					stopServices(energenie = energenie, radio = radio, ts = ts, recorder = recorder, sampler = sampler, collector = collector, history = history)
+					if config.METRICS:
+						metrics.dump()
+					newlogClose()
+					python = sys.executable
+					os.execl(python, python, *sys.argv)
 					
-					# Restart application
-					if (screen == "restart") and (clicked == "btn_confirm"):
-						logger.info("Restarting application")
-						python = sys.executable
-						os.execl(python, python, *sys.argv)
-						
-					# Cancel restart overlay
-					if (clicked == "btn_cancel"):
-						screen = old_screen
-						redraw = True
+				# Cancel restart overlay
+				if (clicked == "btn_cancel"):
+					screen = old_screen
+					redraw = True
+				
+				if (clicked == "btn_power"):
+					# Flash the button to indicate click
+					renderFlash(window, page = page, button_clicked = button, power_mode = power_mode, screen = screen, collector = collector, graph_mode = graph_mode, graph_metric = graph_metric, sampler = sampler)
 					
-					if (clicked == "btn_power"):
-						# Flash the button to indicate click
-						renderFlash(window, page = page, button_clicked = button, power_mode = power_mode, screen = screen)
+					# Change power button mode
+					if power_mode == "ON":
+						power_mode = "OFF"
+					else:
+						power_mode = "ON"
 						
-						# Change power button mode
-						if power_mode == "ON":
-							power_mode = "OFF"
-						else:
-							power_mode = "ON"
-							
-						# Redraw screen
-						redraw = True
-					
-					# If we clicked the status/config button/key, toggle between status/config screen on/off.
-					if (sdl_event and (sdl_event.key.keysym.sym == SDLK_s)) or (clicked == "btn_config"):
-						button = window.boxPressedByName(name = "btn_config")		
-						if (screen != "status"):
-							# Draw status screen
-							renderFlash(window, page = page, button_clicked = button, power_mode = power_mode, screen = screen, energenie = energenie, graph_mode = graph_mode)
-							renderStatus(window, button_clicked = button, flash = False, power_mode = power_mode)
-							screen = "status"
-							redraw = True
-						else:
-							# Go back to main pages
-							renderPage(window, page = page, button_clicked = button, flash = True, power_mode = power_mode)
-							screen = "page"
-							redraw = True
-					
-					# If we clicked the power monitor button/key, toggle between power monitor screen on/off.
-					if (sdl_event and (sdl_event.key.keysym.sym == SDLK_p)) or (clicked == "btn_meter"):
-						button = window.boxPressedByName(name = "btn_meter")	
-						if (screen != "monitor"):
-							# Flash the button to indicate click and change to the power monitor screen
-							renderFlash(window, page = page, button_clicked = button, power_mode = power_mode, screen = screen)
-							renderPowerMon(window, page = page, button_clicked = button, flash = False, power_mode = power_mode, energenie = energenie, graph_mode = graph_mode)
-							screen = "monitor"
-							redraw = True
-						else:
-							# Flash the button to indicate click and change back to the button page
-							renderPage(window, page = page, button_clicked = button, flash = True, power_mode = power_mode)
-							screen = "page"
-							redraw = True
-					
-					# Toggle the type of information shown in the power monitor screen - text numbers or scrolling chart, etc
-					if (screen == "monitor") and (clicked in ["btn_graph", "btn_graph_numbers"]):
-						graph_mode = clicked
-						redraw = True
-					
-					# If we pressed the keyboard Q/q key, exit from the running application
-					if (sdl_event and (sdl_event.key.keysym.sym == SDLK_q)):
-						logger.warn("Got quit signal")
-						running = False
-					
-					# If we pressed the right cursor key, or clicked on the right button, scroll one page right
-					if (screen == "page") and ((sdl_event and (sdl_event.key.keysym.sym == SDLK_RIGHT)) or (clicked == "btn_fwd")):
+					# Redraw screen once the flash is over
+					scheduler.after("redraw", window.timeline.remaining())
+				
+				# If we clicked the status/config button/key, toggle between status/config screen on/off.
+				if (keypress == SDLK_s) or (clicked == "btn_config"):
+					button = window.boxPressedByName(name = "btn_config")		
+					if (screen != "status"):
+						# Draw status screen
+						renderFlash(window, page = page, button_clicked = button, power_mode = power_mode, screen = screen, collector = collector, graph_mode = graph_mode, graph_metric = graph_metric, sampler = sampler)
+						screen = "status"
+					else:
+						# Go back to main pages
+						renderFlash(window, page = page, button_clicked = button, power_mode = power_mode, screen = screen, collector = collector, graph_mode = graph_mode, graph_metric = graph_metric, sampler = sampler)
+						screen = "page"
+					transition = config.TRANSITION_SCREEN
+					scheduler.after("redraw", window.timeline.remaining())
+				
+				# If we clicked the power monitor button/key, toggle between power monitor screen on/off.
+				if (keypress == SDLK_p) or (clicked == "btn_meter"):
+					button = window.boxPressedByName(name = "btn_meter")	
+					if (screen != "monitor"):
+						# Flash the button to indicate click and change to the power monitor screen
+						renderFlash(window, page = page, button_clicked = button, power_mode = power_mode, screen = screen, collector = collector, graph_mode = graph_mode, graph_metric = graph_metric, sampler = sampler)
+						screen = "monitor"
+					else:
+						# Flash the button to indicate click and change back to the button page
+						renderFlash(window, page = page, button_clicked = button, power_mode = power_mode, screen = screen, collector = collector, graph_mode = graph_mode, graph_metric = graph_metric, sampler = sampler)
+						screen = "page"
+					transition = config.TRANSITION_SCREEN
+					scheduler.after("redraw", window.timeline.remaining())
+				
+				# Toggle the type of information shown in the power monitor screen - text numbers or scrolling chart, etc
+				if (screen == "monitor") and (clicked in ["btn_graph", "btn_graph_numbers"]):
+					graph_mode = clicked
+					redraw = True
+				
+				# Choose which reading is plotted on the chart
+				if (screen == "monitor") and (clicked in config.CHART_METRICS.keys()):
+					graph_metric = clicked
+					redraw = True
+				
+				# If we pressed the keyboard Q/q key, exit from the running application
+				if keypress == SDLK_q:
+					logger.warn("Got quit signal")
+					running = False
+				
+				# If we pressed the right cursor key, clicked on the right button or swiped left, scroll one page right
+				if (screen == "page") and ((keypress == SDLK_RIGHT) or (clicked == "btn_fwd") or (clicked == GESTURE_SWIPE_LEFT)):
+					# A swipe needs no flash, it moves straight on to the next page
+					if clicked != GESTURE_SWIPE_LEFT:
 						button = window.boxPressedByName(name = "btn_fwd")
 						renderPage(window, page = page, button_clicked = button, flash = True, power_mode = power_mode)
-						if page < getPages()[-1]:
-							page += 1
-						else:
-							page = 1
-						redraw = True
-					
-					# If we pressed the left cursor key, or clicked on the left button, scroll one page left
-					if (screen == "page") and ((sdl_event and (sdl_event.key.keysym.sym == SDLK_LEFT)) or (clicked == "btn_back")):
+					if page < getPages()[-1]:
+						page += 1
+					else:
+						page = 1
+					transition = config.TRANSITION_PAGE_FORWARD
+					scheduler.after("redraw", window.timeline.remaining())
+				
+				# If we pressed the left cursor key, clicked on the left button or swiped right, scroll one page left
+				if (screen == "page") and ((keypress == SDLK_LEFT) or (clicked == "btn_back") or (clicked == GESTURE_SWIPE_RIGHT)):
+					if clicked != GESTURE_SWIPE_RIGHT:
 						button = window.boxPressedByName(name = "btn_back")
 						renderPage(window, page = page, button_clicked = button, flash = True, power_mode = power_mode)
-						if page > 1:
-							page -= 1
-						else:
-							page = getPages()[-1]
-						redraw = True
-							
-					#########################################
-					#
-					# End of all user-defined actions
-					#
-					#########################################
-					
-					ts_event = False
-		else:
-			# If no input, sleep again for a short time
-			time.sleep(config.REFRESH_TIME)
+					if page > 1:
+						page -= 1
+					else:
+						page = getPages()[-1]
+					transition = config.TRANSITION_PAGE_BACK
+					scheduler.after("redraw", window.timeline.remaining())
+						
+				#########################################
+				#
+				# End of all user-defined actions
+				#
+				#########################################
 			
 		######################################################
 		#
@@ -469,27 +568,40 @@ def sdlRFController():
 		#
 		######################################################
 		if redraw:
+			# Keep the outgoing screen if we are going to transition from it
+			if transition is not None:
+				window.prepareTransition(transition)
+			
 			# Re-render the main device button page
 			if screen == "page":
 				# This redraws once and waits for input
 				renderPage(window, page = page, button_clicked = button, flash = False, power_mode = power_mode)
-				redraw = False
+				scheduler.cancel("redraw")
 				
 			# Re-render the status/sysinfo page
 			if screen == "status":
 				# This redraws continuously
-				renderStatus(window, button_clicked = button, flash = False, power_mode = power_mode)
+				renderStatus(window, button_clicked = button, flash = False, power_mode = power_mode, sampler = sampler)
 				
 			# Re-render the power monitor page
 			if screen == "monitor":
 				# This redraws continuously
-				renderPowerMon(window, button_clicked = button, flash = False, power_mode = power_mode, energenie = energenie, graph_mode = graph_mode)
+				renderPowerMon(window, button_clicked = button, flash = False, power_mode = power_mode, collector = collector, graph_mode = graph_mode, graph_metric = graph_metric)
 			
 			# Flush updated screen buffer to display
-			window.update(transition = transition)
-
-			# We're not bothered about high fps refresh, so sleep again
-			time.sleep(config.REFRESH_TIME)
+			window.update()
+			
+			redraw = False
+			transition = None
+			
+			# Live screens are redrawn again once the refresh timer is due,
+			# rather than on every pass of the loop
+			if screen in ["status", "monitor"]:
+				scheduler.after("redraw", config.SCREEN_REFRESH_TIME)
+		
+		# Wake up again when the next effect needs to be moved on
+		if window.timeline.busy():
+			scheduler.after("effects", window.timeline.next())
 	
 	logger.info("=======================")
 	logger.info("Exit status.......")
@@ -497,33 +609,55 @@ def sdlRFController():
 	logger.info("Button: %s" % button)
 	logger.info("Clicked: %s" % clicked)
 	logger.info("Graph mode: %s" % graph_mode)
+	logger.info("Graph metric: %s" % graph_metric)
 	logger.info("Screen: %s" % screen)
 	logger.info("Page: %s" % page)
 	logger.info("Loop count: %s" % loop_count)
-	logger.info("Power count: %s" % power_count)
-	logger.info("TS Event: %s" % ts_event)
+	logger.info("Gesture: %s" % gesture)
 	logger.info("SDL Event: %s" % sdl_event)
 	logger.info("=======================")
 	
-	# Stop radio
-	if energenie['lib']:
-		logger.info("Shutting down energenie library")
-		energenie['lib'].finished()
+	stopServices(energenie = energenie, radio = radio, ts = ts, recorder = recorder, sampler = sampler, collector = collector, history = history)
 	
-	# Stop touchscreen
-	if ts:
-		logger.info("Shutting down touchscreen library")
-		ts.stop()
+	if config.METRICS:
+		metrics.dump()
+	
+	# How long each replayed input took to reach the radio
+	if replay and fake_radio and ts:
+		latencies = sorted(actionLatencies(ts.actions, [s[0] for s in lib.sends]))
+		if len(latencies) > 0:
+			logger.info("Input to radio latency for %s of %s actions: p50 %.1fms, p95 %.1fms, max %.1fms" % (len(latencies), len(ts.actions), latencies[int(len(latencies) * 0.50)] * 1000, latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, latencies[-1] * 1000))
+		else:
+			logger.info("No replayed actions reached the radio")
+		if report:
+			with open(report, 'w') as f:
+				json.dump({
+					'recording' : replay,
+					'speed' : speed,
+					'actions' : len(ts.actions),
+					'sends' : [list(s) for s in lib.sends],
+					'latencies' : latencies,
+				}, f, indent = 2)
+			logger.info("Wrote replay report to %s" % report)
 	
 	# Clean up the SDL and TTF libraries
 	logger.info("Shutting down SDL library")
+	window.clearCache()
 	gfxClose()
 		
 	# Finally exit the application
 	return 0
 	
 if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = "Energenie radio controlled socket interface")
+	parser.add_argument('--record', metavar = 'FILE', help = "record all input to FILE")
+	parser.add_argument('--replay', metavar = 'FILE', help = "play input back from FILE instead of the touchscreen")
+	parser.add_argument('--speed', type = float, default = 1.0, help = "replay speed, 2 is twice as fast (default 1)")
+	parser.add_argument('--fake-radio', action = 'store_true', help = "record power commands instead of transmitting them")
+	parser.add_argument('--report', metavar = 'FILE', help = "write replay latencies as JSON to FILE (needs --replay and --fake-radio)")
+	args = parser.parse_args()
+	
 	logger.info("Calling sdlRFController()")
-	sdlRFController()
+	status = sdlRFController(record = args.record, replay = args.replay, speed = args.speed, fake_radio = args.fake_radio, report = args.report)
 	logger.info("Return from sdlRFController()")
-	sys.exit()
+	sys.exit(status)